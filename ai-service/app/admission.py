@@ -0,0 +1,141 @@
+"""
+Admission control: shed load with 503 + Retry-After instead of queueing
+every request until they all time out.
+
+Each API endpoint has its own budget, so a burst of audio uploads can't
+starve text chat. A budget allows up to ADMIT_<ENDPOINT>_MAX requests in
+flight, scaled down while the endpoint's recent latency (an EWMA of admitted
+requests) is over its target:
+
+    limit = max(1, ADMIT_<ENDPOINT>_MAX * min(1, target / recent latency))
+
+so when Whisper or Gemini slow down, fewer requests are let in at once and
+the ones admitted still finish in bounded time. Audio endpoints are also
+refused while more than ADMIT_STT_QUEUE_MAX transcriptions are waiting for
+a Whisper slot. Retry-After is the endpoint's recent latency, rounded up.
+
+Gemini calls have a budget of their own, "llm" (ADMIT_LLM_MAX /
+ADMIT_LLM_TARGET_SECONDS). It counts the calls still running, including
+those whose request was already answered with a local reply. While it is
+full, chat and diary requests are refused instead of piling more calls onto
+a slow Gemini.
+"""
+
+import math
+import os
+import threading
+from typing import Optional
+
+from prometheus_client import Counter, Gauge
+
+# EWMA weight of the newest latency sample
+_ALPHA = 0.2
+
+REJECTED = Counter(
+    "ai_admission_rejected_total",
+    "Requests refused with 503 by admission control, by endpoint and reason.",
+    ["endpoint", "reason"],
+)
+LIMIT = Gauge(
+    "ai_admission_limit",
+    "Current in-flight limit of each endpoint's budget (summed over workers).",
+    ["endpoint"],
+    multiprocess_mode="livesum",
+)
+LATENCY = Gauge(
+    "ai_admission_latency_seconds",
+    "Recent (EWMA) latency of admitted requests, by endpoint (slowest worker).",
+    ["endpoint"],
+    multiprocess_mode="livemax",
+)
+
+ADMIT_STT_QUEUE_MAX = int(os.getenv("ADMIT_STT_QUEUE_MAX", "16"))
+
+
+class Budget:
+    def __init__(self, endpoint: str, max_in_flight: int, target_seconds: float):
+        self.endpoint = endpoint
+        self.max_in_flight = max_in_flight
+        self.target_seconds = target_seconds
+        self.in_flight = 0
+        self.latency = 0.0  # EWMA; 0 until the first request completes
+        self._lock = threading.Lock()
+        LIMIT.labels(endpoint=endpoint).set(max_in_flight)
+        LATENCY.labels(endpoint=endpoint).set(0)
+
+    @classmethod
+    def from_env(cls, endpoint: str, max_in_flight: int, target_seconds: float):
+        prefix = f"ADMIT_{endpoint.upper()}"
+        return cls(
+            endpoint,
+            int(os.getenv(f"{prefix}_MAX", str(max_in_flight))),
+            float(os.getenv(f"{prefix}_TARGET_SECONDS", str(target_seconds))),
+        )
+
+    def limit(self) -> int:
+        if self.latency <= self.target_seconds:
+            return self.max_in_flight
+        scaled = self.max_in_flight * self.target_seconds / self.latency
+        return max(1, math.floor(scaled))
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.latency or self.target_seconds))
+
+    def try_enter(self) -> bool:
+        with self._lock:
+            if self.in_flight >= self.limit():
+                return False
+            self.in_flight += 1
+            return True
+
+    def full(self) -> bool:
+        with self._lock:
+            return self.in_flight >= self.limit()
+
+    def enter(self):
+        """Count work that was already admitted, even over the limit."""
+        with self._lock:
+            self.in_flight += 1
+
+    def leave(self, seconds: float):
+        with self._lock:
+            self.in_flight -= 1
+            if self.latency:
+                self.latency += _ALPHA * (seconds - self.latency)
+            else:
+                self.latency = seconds
+            # Gauges are written, not read on scrape: in multiprocess mode
+            # /metrics may be served by another worker
+            LIMIT.labels(endpoint=self.endpoint).set(self.limit())
+            LATENCY.labels(endpoint=self.endpoint).set(self.latency)
+
+
+# Defaults: text chat is cheap and waits on Gemini; audio holds Whisper
+BUDGETS = {
+    "chat": Budget.from_env("chat", 32, 10.0),
+    "chat_audio": Budget.from_env("chat_audio", 16, 30.0),
+    "transcribe": Budget.from_env("transcribe", 16, 15.0),
+    "generate_diary": Budget.from_env("generate_diary", 8, 30.0),
+}
+STT_ENDPOINTS = {"chat_audio", "transcribe"}
+# Gemini calls in flight; entered by main around every call
+LLM = Budget.from_env("llm", 32, 10.0)
+LLM_ENDPOINTS = {"chat", "chat_audio", "generate_diary"}
+
+
+def admit(endpoint: str, stt_waiting: int = 0) -> Optional[int]:
+    """
+    Enter endpoint's budget. Returns None when admitted (call
+    BUDGETS[endpoint].leave() when done), else the Retry-After seconds.
+    """
+    budget = BUDGETS[endpoint]
+    if endpoint in STT_ENDPOINTS and stt_waiting >= ADMIT_STT_QUEUE_MAX:
+        REJECTED.labels(endpoint=endpoint, reason="stt_queue").inc()
+        return budget.retry_after()
+    if endpoint in LLM_ENDPOINTS and LLM.full():
+        REJECTED.labels(endpoint=endpoint, reason="llm").inc()
+        return LLM.retry_after()
+    if not budget.try_enter():
+        REJECTED.labels(endpoint=endpoint, reason="in_flight").inc()
+        return budget.retry_after()
+    return None
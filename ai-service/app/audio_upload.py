@@ -0,0 +1,88 @@
+"""
+Bounded handling of uploaded audio before it reaches Whisper.
+
+save_upload() copies an UploadFile to a temp file in CHUNK_SIZE pieces,
+sniffing the first bytes for a known audio container (415 otherwise) and
+stopping at AUDIO_MAX_BYTES (413). check_duration() then rejects recordings
+longer than the caller's cap using the container's timestamps, which is
+cheap next to decoding.
+"""
+
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+from fastapi import HTTPException, UploadFile
+
+AUDIO_MAX_BYTES = int(os.getenv("AUDIO_MAX_BYTES", str(25 * 1024 * 1024)))
+AUDIO_MAX_SECONDS = int(os.getenv("AUDIO_MAX_SECONDS", "600"))
+
+CHUNK_SIZE = 64 * 1024
+SNIFF_BYTES = 12
+
+
+def sniff_audio(head: bytes) -> Optional[str]:
+    """Container name for the first bytes of an audio file, or None.
+
+    Kept in sync with web-app/audio_upload.py.
+    """
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm"  # EBML: WebM / Matroska
+    if head[:4] == b"OggS":
+        return "ogg"
+    if head[:4] == b"fLaC":
+        return "flac"
+    if head[4:8] == b"ftyp":
+        return "mp4"  # MP4 / M4A / 3GP
+    if head[:3] == b"ID3":
+        return "mp3"
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        # MPEG audio frame sync; 0xFFF* also covers ADTS AAC
+        return "aac" if head[1] & 0xF6 == 0xF0 else "mp3"
+    return None
+
+
+async def save_upload(file: UploadFile, max_bytes: Optional[int] = None) -> str:
+    """Write the upload to a temp file (WhisperModel needs a path); returns it."""
+    max_bytes = max_bytes or AUDIO_MAX_BYTES
+    head = await file.read(SNIFF_BYTES)
+    fmt = sniff_audio(head)
+    if fmt is None:
+        raise HTTPException(status_code=415, detail="Not a supported audio format")
+
+    try:
+        suffix = Path(file.filename or "").suffix or f".{fmt}"
+    except Exception:
+        suffix = f".{fmt}"
+
+    size = len(head)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+        try:
+            tmp.write(head)
+            while chunk := await file.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"Audio upload exceeds {max_bytes // (1024 * 1024)} MB limit",
+                    )
+                tmp.write(chunk)
+        except BaseException:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+    return tmp.name
+
+
+def check_duration(seconds: Optional[float], max_seconds: Optional[int]):
+    """Raise 415 for unreadable audio, 413 for audio over the cap."""
+    limit = min(max_seconds or AUDIO_MAX_SECONDS, AUDIO_MAX_SECONDS)
+    if seconds is None:
+        raise HTTPException(status_code=415, detail="Could not read audio")
+    if seconds > limit:
+        raise HTTPException(
+            status_code=413, detail=f"Audio is longer than {limit} s"
+        )
@@ -1,68 +1,259 @@
 from datetime import datetime, timezone
-from pymongo import MongoClient
-from typing import Dict, Any
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import AsyncMongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from typing import Dict, Any, List, Optional, Tuple
 import os
 
+from .mongo_monitoring import event_listeners
+
 # ----------------------------------------
 # MongoDB Connection 
 # ----------------------------------------
+# Uses PyMongo's native asyncio client so awaiting a query never blocks the
+# event loop; every function in this module is a coroutine.
+#
 # Priority:
 #   1. Use MONGO_URI from environment (Docker)
 #   2. Fallback to localhost for local development
+#
+# Pool size / timeouts come from the MONGO_* env vars below (same names as
+# web-app's). Time spent in MongoDB is recorded per call as the mongo_*
+# stages of ai_stage_duration_seconds, and per command / pool checkout by
+# the listeners in mongo_monitoring.
 # ----------------------------------------
 
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 DB_NAME = "ai_diary"
 
+# env var -> AsyncMongoClient option; only variables that are set are passed
+POOL_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": "maxPoolSize",
+    "MONGO_MIN_POOL_SIZE": "minPoolSize",
+    "MONGO_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS",
+    "MONGO_CONNECT_TIMEOUT_MS": "connectTimeoutMS",
+    "MONGO_SOCKET_TIMEOUT_MS": "socketTimeoutMS",
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": "serverSelectionTimeoutMS",
+}
+
+
+def client_options() -> Dict[str, Any]:
+    options: Dict[str, Any] = {
+        option: int(os.environ[env])
+        for env, option in POOL_OPTIONS.items()
+        if os.getenv(env)
+    }
+    options["event_listeners"] = event_listeners()
+    return options
+
+
 print(">>> Using MongoDB URI:", MONGO_URI)
 
-client = MongoClient(MONGO_URI)
+client = AsyncMongoClient(MONGO_URI, **client_options())
 db = client[DB_NAME]
 
-# conversations collection
+# conversations collection (legacy per-user, per-day conversations)
 conversations = db["conversations"]
 
+# ----------------------------------------
+# Shared conversation store
+# ----------------------------------------
+# web-app's diary_db.conversations, keyed by the conversation id web-app
+# hands out. When a caller passes that id, the turn is written there once
+# and web-app does not write it again.
+# ----------------------------------------
+SHARED_DB_NAME = os.getenv("CONVERSATIONS_DB", "diary_db")
+shared_conversations = client[SHARED_DB_NAME]["conversations"]
+
 
 # ----------------------------------------
-# Create or get today's active conversation
+# Per-user Whisper language
 # ----------------------------------------
-def create_or_get_conversation(user_id: str) -> Dict[str, Any]:
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+# One document per user: the last STT_LANGUAGE_PIN_AFTER confident language
+# detections, the language pinned once they all agree, and an optional
+# override set by the user. Pinning lets transcription skip detection.
+# ----------------------------------------
+stt_languages = db["stt_languages"]
+
+STT_LANGUAGE_MIN_PROBABILITY = float(os.getenv("STT_LANGUAGE_MIN_PROBABILITY", "0.8"))
+STT_LANGUAGE_PIN_AFTER = int(os.getenv("STT_LANGUAGE_PIN_AFTER", "3"))
+# Share of turns for a pinned user that run detection anyway (see main)
+STT_LANGUAGE_RECHECK_RATE = float(os.getenv("STT_LANGUAGE_RECHECK_RATE", "0.05"))
 
-    conv = conversations.find_one({
-        "user_id": user_id,
-        "date": today,
-        "status": "active",
-    })
-
-    if conv:
-        return conv
-
-    new_conv = {
-        "user_id": user_id,
-        "date": today,
-        "messages": [],
-        "status": "active",
-        "created_at": datetime.now(timezone.utc),
-    }
 
-    result = conversations.insert_one(new_conv)
-    new_conv["_id"] = result.inserted_id
-    return new_conv
+def _collection(shared: bool):
+    return shared_conversations if shared else conversations
 
 
+# ----------------------------------------
+# Look up a web-app conversation owned by user_id
+# ----------------------------------------
+async def get_shared_conversation(
+    conversation_id: str, user_id: str
+) -> Optional[Dict[str, Any]]:
+    try:
+        oid = ObjectId(conversation_id)
+        owner = ObjectId(user_id)
+    except (InvalidId, TypeError):
+        return None
+
+    # Unknown and foreign conversations look the same to the caller
+    return await shared_conversations.find_one(
+        {"_id": oid, "user_id": owner},
+        {"_id": 1, "user_id": 1, "status": 1},
+    )
+
 
 # ----------------------------------------
-# Append message to conversation
+# Indexes
+# ----------------------------------------
+async def ensure_indexes():
+    # At most one active conversation per user per day; this is what makes
+    # the upsert below safe when requests race
+    await conversations.create_index(
+        [("user_id", 1), ("date", 1)],
+        unique=True,
+        partialFilterExpression={"status": "active"},
+        name="one_active_conversation_per_day",
+    )
+
+
+# ----------------------------------------
+# Create or get today's active conversation
 # ----------------------------------------
-def append_message(conv_id, role: str, text: str):
-    message = {
-        "role": role,
-        "text": text,
-        "timestamp": datetime.now(timezone.utc),
+async def create_or_get_conversation(user_id: str) -> Dict[str, Any]:
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    flt = {"user_id": user_id, "date": today, "status": "active"}
+    update = {
+        "$setOnInsert": {
+            "messages": [],
+            "created_at": datetime.now(timezone.utc),
+        }
     }
 
-    conversations.update_one(
+    # One round trip: returns the existing conversation or creates it
+    for attempt in range(2):
+        try:
+            return await conversations.find_one_and_update(
+                flt,
+                update,
+                projection={"messages": 0},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Two upserts raced and the other one inserted first; the retry
+            # matches the document it created
+            if attempt:
+                raise
+
+
+# ----------------------------------------
+# Append a turn's messages to a conversation
+# ----------------------------------------
+async def append_messages(
+    conv_id,
+    messages: List[Tuple[str, str]],
+    shared: bool = False,
+    turn_id: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Write [(role, text), ...] with a single $push/$each; returns the messages.
+
+    With a turn_id (web-app's ID for the turn), the messages are tagged with
+    it and only pushed if the conversation has no message with that turn_id
+    yet, so web-app's fallback write and ours can't both store the same turn.
+    """
+    now = datetime.now(timezone.utc)
+    docs = [{"role": role, "text": text, "timestamp": now} for role, text in messages]
+    flt: Dict[str, Any] = {"_id": conv_id}
+    if turn_id is not None:
+        for doc in docs:
+            doc["turn_id"] = turn_id
+        flt["messages.turn_id"] = {"$ne": turn_id}
+
+    await _collection(shared).update_one(
+        flt,
+        {"$push": {"messages": {"$each": docs}}},
+    )
+    return docs
+
+
+# ----------------------------------------
+# Read the last `limit` messages of a conversation
+# ----------------------------------------
+async def get_recent_messages(
+    conv_id, limit: int, shared: bool = False
+) -> List[Dict[str, Any]]:
+    # $slice keeps the payload bounded no matter how long the conversation is
+    conv = await _collection(shared).find_one(
         {"_id": conv_id},
-        {"$push": {"messages": message}},
+        {"messages": {"$slice": -limit}},
+    )
+    return conv.get("messages", []) if conv else []
+
+
+# ----------------------------------------
+# Per-user Whisper language
+# ----------------------------------------
+async def get_stt_language(user_id: str) -> Dict[str, Any]:
+    """The user's language document ({} if none): override, pinned, recent."""
+    doc = await stt_languages.find_one({"_id": user_id})
+    return doc or {}
+
+
+async def set_stt_language_override(user_id: str, language: Optional[str]):
+    """Set (or with None, clear) the user's language override."""
+    await stt_languages.update_one(
+        {"_id": user_id},
+        {"$set": {"override": language, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+
+
+async def record_detected_language(
+    user_id: str, language: str, probability: float
+) -> None:
+    """
+    Remember a language Whisper detected for this user.
+
+    Low-confidence detections (typically very short clips) are ignored. The
+    pinned language is recomputed in the same update: it is set when the
+    last STT_LANGUAGE_PIN_AFTER detections agree and cleared when they don't.
+    """
+    if probability < STT_LANGUAGE_MIN_PROBABILITY:
+        return
+
+    detection = {"language": language, "probability": probability}
+    recent = {
+        "$slice": [
+            {"$concatArrays": [{"$ifNull": ["$recent", []]}, [detection]]},
+            -STT_LANGUAGE_PIN_AFTER,
+        ]
+    }
+    agreed = {
+        "$and": [
+            {"$eq": [{"$size": "$recent"}, STT_LANGUAGE_PIN_AFTER]},
+            {
+                "$allElementsTrue": [
+                    {
+                        "$map": {
+                            "input": "$recent",
+                            "in": {"$eq": ["$$this.language", language]},
+                        }
+                    }
+                ]
+            },
+        ]
+    }
+    # An update pipeline, so the new detection and the pin are one atomic write
+    await stt_languages.update_one(
+        {"_id": user_id},
+        [
+            {"$set": {"recent": recent, "updated_at": datetime.now(timezone.utc)}},
+            {"$set": {"pinned": {"$cond": [agreed, language, None]}}},
+        ],
+        upsert=True,
     )
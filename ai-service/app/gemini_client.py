@@ -1,11 +1,13 @@
 import google.generativeai as genai
 from .config import GEMINI_API_KEY
+from .gemini_policy import call_with_policy
+from .instrumentation import fallback
 import json
 
 genai.configure(api_key=GEMINI_API_KEY)
 
 
-def generate_cheerful_reply(user_text: str) -> str:
+async def generate_cheerful_reply(user_text: str) -> str:
     prompt = f"""
     You are a cheerful, warm, slightly humorous diary assistant.
     Respond casually and kindly, as if comforting a friend.
@@ -15,11 +17,13 @@ def generate_cheerful_reply(user_text: str) -> str:
     """
 
     model = genai.GenerativeModel("gemini-2.5-flash-lite")
-    response = model.generate_content(prompt)
+    response = await call_with_policy(
+        "cheerful_reply", lambda: model.generate_content(prompt)
+    )
     return response.text.strip()
 
 
-def generate_diary(
+async def generate_diary(
     messages: list,
     theme: str = None,
     style: str = None,
@@ -88,7 +92,9 @@ Respond ONLY with valid JSON in this exact format (no markdown, no extra text):
 """
 
     model = genai.GenerativeModel("gemini-2.5-flash-lite")
-    response = model.generate_content(prompt)
+    response = await call_with_policy(
+        "diary", lambda: model.generate_content(prompt)
+    )
 
     # Parse response
     try:
@@ -124,6 +130,7 @@ Respond ONLY with valid JSON in this exact format (no markdown, no extra text):
 
     except (json.JSONDecodeError, KeyError, AttributeError):
         # Fallback if JSON parsing fails
+        fallback("diary_json_parse")
         return {
             "title": "Today's Diary",
             "content": (
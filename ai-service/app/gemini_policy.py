@@ -0,0 +1,231 @@
+"""
+Retry, backoff and hedging policy for Gemini calls.
+
+gemini_client wraps every generate_content() in call_with_policy(). Errors are
+classified by their HTTP status: 429 (rate_limited) and 500/502/503/504
+(server_error) are retried up to GEMINI_MAX_ATTEMPTS times in total, after a
+full-jitter exponential backoff
+
+    sleep = uniform(0, min(GEMINI_BACKOFF_MAX_SECONDS,
+                           GEMINI_BACKOFF_BASE_SECONDS * 2 ** retry))
+
+Anything else (bad request, blocked prompt, bad key) fails at once. No retry
+is started if its backoff would run past the request's X-Deadline-Ms.
+
+The SDK call is blocking, so every attempt runs on a thread of its own
+limiter; the waits between attempts are asyncio sleeps and hold no thread.
+
+With GEMINI_HEDGE=1, an attempt still running after the p95 of recent
+successful attempts of the same call gets a duplicate request; the first one
+to succeed wins. The other can't be interrupted: it is left to finish in its
+thread and counted in ai_gemini_hedge_losers_total. Hedging waits for
+GEMINI_HEDGE_MIN_SAMPLES latencies before it kicks in. No hedge is sent
+after a 429 (a duplicate would only add to the rate limit) or while
+GEMINI_HEDGE_MAX hedges are already running in this worker; those are
+counted in ai_gemini_hedges_skipped_total{call,reason}.
+
+Every attempt is recorded in ai_gemini_attempts_total{call,kind,outcome} and
+ai_gemini_attempt_seconds{call}; kind is primary, retry or hedge.
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional, TypeVar
+
+import anyio
+from google.api_core import exceptions as google_exceptions
+from prometheus_client import Counter, Histogram
+
+from .admission import LLM
+from .instrumentation import BUCKETS, log, time_left
+
+GEMINI_MAX_ATTEMPTS = int(os.getenv("GEMINI_MAX_ATTEMPTS", "3"))
+GEMINI_BACKOFF_BASE_SECONDS = float(os.getenv("GEMINI_BACKOFF_BASE_SECONDS", "0.5"))
+GEMINI_BACKOFF_MAX_SECONDS = float(os.getenv("GEMINI_BACKOFF_MAX_SECONDS", "8"))
+GEMINI_HEDGE = os.getenv("GEMINI_HEDGE", "0") == "1"
+GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+GEMINI_HEDGE_MAX = int(os.getenv("GEMINI_HEDGE_MAX", "4"))
+
+# HTTP status -> retry reason
+RETRYABLE = {
+    429: "rate_limited",
+    500: "server_error",
+    502: "server_error",
+    503: "server_error",
+    504: "server_error",
+}
+
+ATTEMPTS = Counter(
+    "ai_gemini_attempts_total",
+    "Gemini requests by call, kind (primary, retry, hedge) and outcome "
+    "(ok, rate_limited, server_error, error).",
+    ["call", "kind", "outcome"],
+)
+ATTEMPT_SECONDS = Histogram(
+    "ai_gemini_attempt_seconds",
+    "Duration of each Gemini request, successful or not.",
+    ["call"],
+    buckets=BUCKETS,
+)
+HEDGE_WINS = Counter(
+    "ai_gemini_hedge_wins_total",
+    "Hedged Gemini attempts whose duplicate answered first.",
+    ["call"],
+)
+HEDGE_LOSERS = Counter(
+    "ai_gemini_hedge_losers_total",
+    "Hedged Gemini attempts left running after the other one answered.",
+    ["call"],
+)
+HEDGES_SKIPPED = Counter(
+    "ai_gemini_hedges_skipped_total",
+    "Hedges not sent, by reason: rate_limited (the last attempt got a 429) "
+    "or limit (GEMINI_HEDGE_MAX already running).",
+    ["call", "reason"],
+)
+
+T = TypeVar("T")
+
+# One thread per call the llm budget admits, plus the hedges
+_threads = anyio.CapacityLimiter(LLM.max_in_flight + GEMINI_HEDGE_MAX)
+
+# Hedges still running, and attempts that lost a race (kept referenced
+# until their thread returns)
+_hedges_running = 0
+_losers = set()
+
+
+class _Latencies:
+    """Recent successful attempt durations of one call, for the hedge delay."""
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < GEMINI_HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+_latencies = {}
+
+
+def classify(exc: BaseException) -> Optional[str]:
+    """"rate_limited" or "server_error" for retryable errors, else None."""
+    if isinstance(exc, google_exceptions.GoogleAPICallError):
+        return RETRYABLE.get(exc.code)
+    return None
+
+
+def backoff(retry: int) -> float:
+    cap = min(GEMINI_BACKOFF_MAX_SECONDS, GEMINI_BACKOFF_BASE_SECONDS * 2**retry)
+    return random.uniform(0, cap)
+
+
+def _attempt(call: str, kind: str, fn: Callable[[], T]) -> T:
+    start = time.perf_counter()
+    try:
+        result = fn()
+    except Exception as e:
+        ATTEMPTS.labels(call=call, kind=kind, outcome=classify(e) or "error").inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        ATTEMPT_SECONDS.labels(call=call).observe(elapsed)
+    ATTEMPTS.labels(call=call, kind=kind, outcome="ok").inc()
+    _latencies.setdefault(call, _Latencies()).add(elapsed)
+    return result
+
+
+async def _run(call: str, kind: str, fn: Callable[[], T]) -> T:
+    # The thread keeps the request ID and deadline (anyio copies the context)
+    return await anyio.to_thread.run_sync(_attempt, call, kind, fn, limiter=_threads)
+
+
+def _hedge_done(task):
+    global _hedges_running
+    _hedges_running -= 1
+
+
+def _abandon(call: str, task: asyncio.Future):
+    HEDGE_LOSERS.labels(call=call).inc()
+    _losers.add(task)
+    # Retrieve its outcome so a late error isn't reported as unhandled
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    task.add_done_callback(_losers.discard)
+
+
+async def _hedged_attempt(
+    call: str, kind: str, fn: Callable[[], T], after: Optional[str] = None
+) -> T:
+    """
+    One attempt, plus a hedge if it runs past the p95. after is the retry
+    reason of the previous attempt, if any.
+    """
+    global _hedges_running
+    delay = _latencies.setdefault(call, _Latencies()).p95()
+    if delay is None:
+        return await _run(call, kind, fn)
+
+    first = asyncio.ensure_future(_run(call, kind, fn))
+    done, _ = await asyncio.wait([first], timeout=delay)
+    if done:
+        return first.result()
+
+    skip = None
+    if after == "rate_limited":
+        skip = "rate_limited"
+    elif _hedges_running >= GEMINI_HEDGE_MAX:
+        skip = "limit"
+    if skip is not None:
+        HEDGES_SKIPPED.labels(call=call, reason=skip).inc()
+        return await first
+
+    _hedges_running += 1
+    hedge = asyncio.ensure_future(_run(call, "hedge", fn))
+    hedge.add_done_callback(_hedge_done)
+    pending = {first, hedge}
+    error = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for other in pending:
+                    _abandon(call, other)
+                if future is hedge:
+                    HEDGE_WINS.labels(call=call).inc()
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+async def call_with_policy(call: str, fn: Callable[[], T]) -> T:
+    """Run fn() (one blocking Gemini request) with retries and optional hedging."""
+    reason = None
+    for retry in range(GEMINI_MAX_ATTEMPTS):
+        kind = "primary" if retry == 0 else "retry"
+        try:
+            if GEMINI_HEDGE:
+                return await _hedged_attempt(call, kind, fn, after=reason)
+            return await _run(call, kind, fn)
+        except Exception as e:
+            reason = classify(e)
+            if reason is None or retry + 1 >= GEMINI_MAX_ATTEMPTS:
+                raise
+            sleep = backoff(retry)
+            left = time_left()
+            if left is not None and sleep >= left:
+                raise
+            log(f"Gemini {call} {reason}, retry {retry + 1} in {sleep:.2f}s")
+            await asyncio.sleep(sleep)
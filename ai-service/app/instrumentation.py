@@ -0,0 +1,176 @@
+"""
+Per-stage latency, fallback and in-flight metrics for the API endpoints.
+
+An endpoint decorated with @instrumented("chat_audio") counts as in flight
+while it runs and records a "total" stage; inside it, `with stage("stt"):`
+records that stage under the same endpoint label. The current endpoint is
+kept in a context variable, so helpers shared by several endpoints (and code
+run through run_in_threadpool) are attributed to the right one.
+
+begin_request() also starts collecting the request's stage timings for its
+Server-Timing header and sets the request ID that log() prefixes lines with.
+When the caller sends X-Deadline-Ms (how long it will wait), it also sets the
+request's deadline; check_deadline() between stages raises DeadlineExceeded
+once it has passed, so no more work is spent on an answer nobody will read.
+"""
+
+import asyncio
+import functools
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Seconds; from a MongoDB round trip up to a 60 s audio turn
+BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+STAGE_SECONDS = Histogram(
+    "ai_stage_duration_seconds",
+    "Time spent in each stage of an API request.",
+    ["endpoint", "stage"],
+    buckets=BUCKETS,
+)
+FALLBACKS = Counter(
+    "ai_fallbacks_total",
+    "Degraded results returned instead of a normal one, by reason.",
+    ["reason"],
+)
+IN_FLIGHT = Gauge(
+    "ai_requests_in_flight",
+    "Requests currently being handled, by endpoint.",
+    ["endpoint"],
+    multiprocess_mode="livesum",
+)
+DEADLINES_EXCEEDED = Counter(
+    "ai_deadline_exceeded_total",
+    "Requests abandoned because the caller's deadline passed, by the stage "
+    "that was about to start.",
+    ["endpoint", "stage"],
+)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+DEADLINE_HEADER = "X-Deadline-Ms"
+# Caller-supplied IDs end up in logs and headers, so keep them boring
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+_endpoint: ContextVar[str] = ContextVar("endpoint", default="")
+_request_id: ContextVar[str] = ContextVar("request_id", default="-")
+_timings: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar(
+    "timings", default=None
+)
+# time.monotonic() value after which the caller has given up
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def begin_request(
+    incoming_id: Optional[str], deadline_ms: Optional[str] = None
+) -> str:
+    """Set the request ID (the caller's, or a new one) and deadline, and start
+    collecting stage timings. Returns the ID."""
+    rid = incoming_id if incoming_id and _REQUEST_ID_RE.match(incoming_id) else None
+    rid = rid or uuid.uuid4().hex
+    _request_id.set(rid)
+    _timings.set([])
+    try:
+        _deadline.set(time.monotonic() + max(0, int(deadline_ms)) / 1000)
+    except (TypeError, ValueError):
+        _deadline.set(None)
+    return rid
+
+
+def time_left() -> Optional[float]:
+    """Seconds until the caller's deadline (<= 0 once passed), or None."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def check_deadline(next_stage: str):
+    """Raise DeadlineExceeded if the caller has already given up."""
+    left = time_left()
+    if left is not None and left <= 0:
+        deadline_exceeded(next_stage)
+
+
+def deadline_exceeded(next_stage: str):
+    DEADLINES_EXCEEDED.labels(endpoint=_endpoint.get(), stage=next_stage).inc()
+    log(f"deadline passed, skipping {next_stage}")
+    raise DeadlineExceeded(next_stage)
+
+
+def request_id() -> str:
+    return _request_id.get()
+
+
+def log(*args):
+    print(f"[{_request_id.get()}]", *args)
+
+
+def server_timing() -> str:
+    """Server-Timing header value for the stages recorded so far, e.g.
+    "stt;dur=812.4, gemini_reply;dur=640.2". Repeated stages are summed."""
+    totals = {}
+    for name, seconds in _timings.get() or ():
+        totals[name] = totals.get(name, 0.0) + seconds
+    return ", ".join(f"{name};dur={s * 1000:.1f}" for name, s in totals.items())
+
+
+@contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(endpoint=_endpoint.get(), stage=name).observe(elapsed)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+def fallback(reason: str):
+    FALLBACKS.labels(reason=reason).inc()
+    log("fallback:", reason)
+
+
+def instrumented(endpoint: str):
+    """Decorator for sync or async endpoint functions."""
+
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                token = _endpoint.set(endpoint)
+                try:
+                    with IN_FLIGHT.labels(endpoint=endpoint).track_inprogress():
+                        with stage("total"):
+                            return await fn(*args, **kwargs)
+                finally:
+                    _endpoint.reset(token)
+
+        else:
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                token = _endpoint.set(endpoint)
+                try:
+                    with IN_FLIGHT.labels(endpoint=endpoint).track_inprogress():
+                        with stage("total"):
+                            return fn(*args, **kwargs)
+                finally:
+                    _endpoint.reset(token)
+
+        return wrapper
+
+    return decorate
@@ -0,0 +1,138 @@
+"""
+Reply-latency SLO: answer from a local template when Gemini is slow.
+
+reply_within_slo() starts the Gemini call and waits up to
+GEMINI_REPLY_SLO_SECONDS (or less, if the caller's X-Deadline-Ms comes
+sooner). If Gemini misses it, the user gets a short template reply picked by
+the mood of their message instead of a long pause, and the Gemini call is
+left to finish in its worker thread. What happens to its late result is set
+by GEMINI_LATE_REPLY:
+
+    drop   (default) log and discard it
+    save   add it to the conversation as a follow-up AI message, so the next
+           turn and the diary see what Gemini had to say
+
+The mood is the caller's: web-app scores each text message with its word
+lexicon (web-app/mood_lexicon.py) and sends the result along. Requests
+without one, such as audio turns, get the neutral templates. The share of hedged replies is
+ai_reply_hedges_total{outcome="local"} / ai_reply_hedges_total.
+"""
+
+import asyncio
+import os
+import random
+from typing import Awaitable, Callable, Optional, Tuple
+
+from prometheus_client import Counter
+
+from .instrumentation import fallback, log, time_left
+
+GEMINI_REPLY_SLO_SECONDS = float(os.getenv("GEMINI_REPLY_SLO_SECONDS", "6"))
+GEMINI_LATE_REPLY = os.getenv("GEMINI_LATE_REPLY", "drop")
+
+# Left for the MongoDB write after the reply when the caller sets a deadline
+DEADLINE_HEADROOM_SECONDS = 0.5
+
+HEDGES = Counter(
+    "ai_reply_hedges_total",
+    "Chat replies by source: gemini (within the SLO) or local (template).",
+    ["outcome"],
+)
+LATE_REPLIES = Counter(
+    "ai_late_replies_total",
+    "Gemini replies that arrived after a local reply was sent, by what "
+    "happened to them: dropped, saved or failed.",
+    ["outcome"],
+)
+
+TEMPLATES = {
+    "positive": (
+        "That sounds wonderful! I'm really glad today gave you something to smile about.",
+        "I love hearing that. Moments like this are worth writing down.",
+        "That's great news, you deserve days like this.",
+    ),
+    "negative": (
+        "That sounds really hard. I'm here, and it's okay to take it one step at a time.",
+        "I'm sorry today was rough. Thank you for telling me about it.",
+        "That's a lot to carry. Be gentle with yourself tonight.",
+    ),
+    "neutral": (
+        "Thanks for sharing that with me. How are you feeling about it?",
+        "Got it, I'm listening. Tell me more whenever you like.",
+        "Noted! What else has been on your mind today?",
+    ),
+}
+
+# Gemini calls still running after their request got a local reply
+_late = set()
+
+
+def local_reply(mood: Optional[str] = None) -> str:
+    return random.choice(TEMPLATES.get(mood, TEMPLATES["neutral"]))
+
+
+def reply_slo() -> float:
+    """Seconds to wait for Gemini: the SLO, capped by the caller's deadline."""
+    left = time_left()
+    if left is None:
+        return GEMINI_REPLY_SLO_SECONDS
+    return max(0.0, min(GEMINI_REPLY_SLO_SECONDS, left - DEADLINE_HEADROOM_SECONDS))
+
+
+async def reply_within_slo(
+    call: Awaitable[str], mood: Optional[str] = None
+) -> Tuple[str, Optional[asyncio.Future]]:
+    """
+    Gemini's reply if it arrives within reply_slo(), else a local one.
+
+    Returns (reply, late) where late is the still-running Gemini call when
+    the local reply was used; hand it to settle_late_reply() once the turn
+    is stored. Errors from Gemini within the SLO propagate as before.
+    """
+    if GEMINI_REPLY_SLO_SECONDS <= 0:
+        return await call, None
+
+    task = asyncio.ensure_future(call)
+    try:
+        # shield: on timeout Gemini keeps running for settle_late_reply()
+        reply = await asyncio.wait_for(asyncio.shield(task), reply_slo())
+    except asyncio.TimeoutError:
+        HEDGES.labels(outcome="local").inc()
+        fallback("gemini_slow")
+        _late.add(task)
+        task.add_done_callback(_late.discard)
+        return local_reply(mood), task
+    HEDGES.labels(outcome="gemini").inc()
+    return reply, None
+
+
+def settle_late_reply(
+    late: Optional[asyncio.Future], save: Callable[[str], Awaitable]
+):
+    """Drop the late Gemini reply, or pass it to save() when it arrives."""
+    if late is None:
+        return
+
+    def done(task):
+        error = "cancelled" if task.cancelled() else task.exception()
+        if error is not None:
+            LATE_REPLIES.labels(outcome="failed").inc()
+            log("late Gemini reply failed:", error)
+        elif GEMINI_LATE_REPLY == "save":
+            _late.add(asyncio.ensure_future(_save(save, task.result())))
+        else:
+            LATE_REPLIES.labels(outcome="dropped").inc()
+
+    late.add_done_callback(done)
+
+
+async def _save(save, reply):
+    try:
+        await save(reply)
+    except Exception as e:
+        LATE_REPLIES.labels(outcome="failed").inc()
+        log("could not save late Gemini reply:", e)
+    else:
+        LATE_REPLIES.labels(outcome="saved").inc()
+    finally:
+        _late.discard(asyncio.current_task())
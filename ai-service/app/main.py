@@ -4,18 +4,66 @@ warnings.filterwarnings(
     "ignore", category=UserWarning, module="multiprocessing.resource_tracker"
 )
 
+import asyncio
 import os
-import tempfile
-from pathlib import Path
-from typing import List, Dict, Optional
-
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query
-from pydantic import BaseModel
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import List, Dict, Literal, Optional
+
+from fastapi import FastAPI, UploadFile, File, Header, HTTPException, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    generate_latest,
+    multiprocess,
+)
+from pydantic import BaseModel, Field
 
 # Assuming these modules exist and are correct
-from app.db import create_or_get_conversation, append_message, conversations
-from app.services.stt_service import transcribe_audio
+from app.db import (
+    STT_LANGUAGE_RECHECK_RATE,
+    create_or_get_conversation,
+    append_messages,
+    ensure_indexes,
+    get_recent_messages,
+    get_shared_conversation,
+    get_stt_language,
+    record_detected_language,
+    set_stt_language_override,
+)
+from app.services.stt_scheduler import scheduler as stt_scheduler
+from app.services.stt_service import (
+    STT_DEFAULT_TIERS,
+    SttUnavailable,
+    is_supported_language,
+    probe_duration,
+    server_waiting,
+    shutdown_pool,
+    transcribe,
+    uses_stt_server,
+)
 from .gemini_client import generate_cheerful_reply, generate_diary
+from . import admission, local_reply, profiling
+from .audio_upload import check_duration, save_upload
+from .instrumentation import (
+    DEADLINE_HEADER,
+    REQUEST_ID_HEADER,
+    DeadlineExceeded,
+    begin_request,
+    check_deadline,
+    deadline_exceeded,
+    fallback,
+    instrumented,
+    log,
+    request_id,
+    server_timing,
+    stage,
+    time_left,
+)
 
 
 # ========= Pydantic Models =========
@@ -24,11 +72,26 @@ from .gemini_client import generate_cheerful_reply, generate_diary
 class ChatRequest(BaseModel):
     user_id: str
     text: str
+    # web-app's conversation id; when set the turn is stored in that conversation
+    conversation_id: Optional[str] = None
+    # Opt-in: also return the last N messages of the conversation
+    history_limit: int = Field(0, ge=0, le=200)
+    # web-app's ID for this turn; a turn already stored under it isn't pushed again
+    turn_id: Optional[str] = Field(None, max_length=64)
+    # web-app's lexicon mood of text; picks the local reply if Gemini is slow
+    mood: Optional[Literal["positive", "negative", "neutral"]] = None
 
 
 class ChatResponse(BaseModel):
     reply: str
-    history: List[Dict]
+    transcript: str
+    # Only the messages written by this turn (user + AI)
+    messages: List[Dict]
+    history: Optional[List[Dict]] = None
+    conversation_id: Optional[str] = None
+    # True when the turn was written to the shared conversation store,
+    # so the caller must not write it again
+    persisted: bool = False
 
 
 class DiaryPreferences(BaseModel):
@@ -54,9 +117,154 @@ class TranscribeResponse(BaseModel):
     text: str
 
 
+class SttLanguageRequest(BaseModel):
+    # Whisper language code, or null to go back to detection/pinning
+    language: Optional[str] = None
+
+
+class SttLanguageResponse(BaseModel):
+    override: Optional[str] = None
+    pinned: Optional[str] = None
+    # Last confident detections: [{"language": "en", "probability": 0.97}, ...]
+    recent: List[Dict] = []
+
+
 # ========= FastAPI app =========
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        # Don't refuse to start if Mongo is briefly unavailable
+        print("Error creating indexes:", e)
+    yield
+    # Stop the long-audio transcription workers, if any were started
+    shutdown_pool()
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # Drop this worker's live gauges (in-flight, queue depth) from /metrics
+        multiprocess.mark_process_dead(os.getpid())
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+async def profile_request(request: Request, call_next):
+    """
+    Profile requests picked by profiling.wanted(). Sampling rather than
+    cProfile, because most of the time is spent in thread-pool threads
+    (Whisper, Gemini) that a cProfile on the event loop would not see.
+    """
+    if not profiling.wanted(request.headers.get(profiling.PROFILE_HEADER)):
+        return await call_next(request)
+    session = profiling.start()
+    if session is None:
+        return await call_next(request)
+    try:
+        response = await call_next(request)
+    finally:
+        name = await run_in_threadpool(profiling.finish, session, request_id())
+    response.headers[profiling.PROFILE_ID_HEADER] = name
+    return response
+
+
+# Only installed when profiling is configured. Registered before
+# request_context, which makes it the inner middleware, so the request ID is
+# already set when it runs.
+if profiling.ENABLED:
+    app.middleware("http")(profile_request)
+
+
+# Budgeted endpoints, by path (POST only)
+ADMISSION_ENDPOINTS = {
+    "/api/chat": "chat",
+    "/api/chat/audio": "chat_audio",
+    "/api/transcribe": "transcribe",
+    "/api/generate-diary": "generate_diary",
+}
+
+
+async def _stt_waiting() -> int:
+    """Transcriptions queued for Whisper: in the STT server (all workers'),
+    or in this process."""
+    if uses_stt_server():
+        return await run_in_threadpool(server_waiting)
+    return stt_scheduler.waiting
+
+
+async def _gemini(call):
+    """Await a Gemini call, counted in the llm budget until it returns, even
+    if its request has been answered."""
+    admission.LLM.enter()
+    start = time.perf_counter()
+    try:
+        return await call
+    finally:
+        admission.LLM.leave(time.perf_counter() - start)
+
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    """
+    Refuse work the service can't finish in time (see admission) with 503 +
+    Retry-After. Runs before the body is read, so a refused upload costs
+    nothing. Registered between profiling and request_context, so refusals
+    are still logged with their request ID.
+    """
+    endpoint = (
+        ADMISSION_ENDPOINTS.get(request.url.path)
+        if request.method == "POST"
+        else None
+    )
+    if endpoint is None:
+        return await call_next(request)
+
+    stt_waiting = 0
+    if endpoint in admission.STT_ENDPOINTS:
+        stt_waiting = await _stt_waiting()
+    retry_after = admission.admit(endpoint, stt_waiting)
+    if retry_after is not None:
+        log("admission: rejected", endpoint)
+        return JSONResponse(
+            {"detail": "Service overloaded, retry later"},
+            status_code=503,
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    start = time.perf_counter()
+    try:
+        return await call_next(request)
+    finally:
+        admission.BUDGETS[endpoint].leave(time.perf_counter() - start)
+
+
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    """
+    Tag the request with web-app's X-Request-ID (or a new one), log it, and
+    report the stage timings in a Server-Timing header.
+    """
+    rid = begin_request(
+        request.headers.get(REQUEST_ID_HEADER), request.headers.get(DEADLINE_HEADER)
+    )
+    start = time.perf_counter()
+    response = await call_next(request)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    response.headers[REQUEST_ID_HEADER] = rid
+    timing = server_timing()
+    if timing:
+        response.headers["Server-Timing"] = timing
+    log(request.method, request.url.path, response.status_code, f"{elapsed_ms:.1f}ms")
+    return response
+
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded_handler(request: Request, exc: DeadlineExceeded):
+    # The caller has already timed out, so this mostly shows up in logs
+    return JSONResponse(
+        {"detail": f"Deadline exceeded before {exc}"}, status_code=504
+    )
 
 
 @app.get("/health")
@@ -64,150 +272,354 @@ def health():
     return {"status": "ok"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_endpoint():
+    # With several workers (see serve.py) each one writes its samples to
+    # PROMETHEUS_MULTIPROC_DIR, so any worker can answer for all of them
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return PlainTextResponse(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/debug/profiles")
+def list_profiles(x_profile: Optional[str] = Header(None)):
+    if not profiling.authorized(x_profile):
+        raise HTTPException(status_code=404)
+    return {"profiles": profiling.list_profiles()}
+
+
+@app.get("/debug/profiles/{name}")
+def download_profile(name: str, x_profile: Optional[str] = Header(None)):
+    path = profiling.profile_path(name) if profiling.authorized(x_profile) else None
+    if path is None:
+        raise HTTPException(status_code=404)
+    return FileResponse(path, filename=name)
+
+
 @app.post("/api/chat", response_model=ChatResponse)
-def chat(req: ChatRequest):
+@instrumented("chat")
+async def chat(req: ChatRequest):
     """
     Text-only chat endpoint:
-    - JSON: { "user_id": "...", "text": "..." }
+    - JSON: { "user_id": "...", "text": "...", "conversation_id": "...",
+              "history_limit": 0 }
     - Generate a cheerful reply using Gemini
-    - Write user/AI messages to Mongo and return the full history
+    - Write user/AI messages to Mongo and return the messages of this turn
+      (plus the last `history_limit` messages when asked for)
     """
-    # 1. Find or create "today's" active conversation
-    conv = create_or_get_conversation(req.user_id)
+    # 1. Find the shared conversation, or "today's" legacy one
+    conv_id, shared = await _open_conversation(req.user_id, req.conversation_id)
+
+    # 2. Generate AI reply (Gemini cheerful), or a local one if Gemini misses
+    #    the reply SLO
+    check_deadline("gemini_reply")
+    with stage("gemini_reply"):
+        ai_reply, late = await local_reply.reply_within_slo(
+            _gemini(generate_cheerful_reply(req.text)), req.mood
+        )
+
+    # 3. Write the user and AI messages to MongoDB in one update, unless the
+    #    caller gave up meanwhile and will never show this reply
+    check_deadline("mongo_append")
+    with stage("mongo_append"):
+        messages = await append_messages(
+            conv_id,
+            [("user", req.text), ("ai", ai_reply)],
+            shared=shared,
+            turn_id=req.turn_id,
+        )
+    _settle_late_reply(late, conv_id, shared)
+
+    # 4. Return AI reply + this turn's messages
+    return await _chat_response(
+        conv_id, shared, req.text, messages, req.history_limit
+    )
+
+
+def _settle_late_reply(late, conv_id, shared):
+    """Drop or (GEMINI_LATE_REPLY=save) store a reply Gemini sent too late."""
+    local_reply.settle_late_reply(
+        late, lambda text: append_messages(conv_id, [("ai", text)], shared=shared)
+    )
 
-    # 2. Write the user message to MongoDB first
-    append_message(conv["_id"], "user", req.text)
 
-    # 3. Generate AI reply (Gemini cheerful)
-    ai_reply = generate_cheerful_reply(req.text)
+async def _open_conversation(user_id, conversation_id):
+    """Return (conversation _id, shared) for the conversation this turn goes to."""
+    if conversation_id is None:
+        with stage("mongo_conversation"):
+            return (await create_or_get_conversation(user_id))["_id"], False
 
-    # 4. Write the AI message to MongoDB as well
-    append_message(conv["_id"], "ai", ai_reply)
+    with stage("mongo_conversation"):
+        conv = await get_shared_conversation(conversation_id, user_id)
+    if not conv:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return conv["_id"], True
 
-    # 5. Query the latest conversation again to get the full messages array
-    updated_conv = conversations.find_one({"_id": conv["_id"]})
 
-    # 6. Return AI reply + full conversation history
+async def _chat_response(conv_id, shared, transcript, messages, history_limit):
+    history = None
+    if history_limit:
+        with stage("mongo_history"):
+            history = await get_recent_messages(conv_id, history_limit, shared=shared)
     return ChatResponse(
-        reply=ai_reply,
-        history=updated_conv["messages"],
+        reply=messages[-1]["text"],
+        transcript=transcript,
+        messages=messages,
+        history=history,
+        conversation_id=str(conv_id) if shared else None,
+        persisted=shared,
     )
 
 
+async def _user_language(user_id: str) -> Optional[str]:
+    """
+    Language to pin for this user's transcription: their override, else the
+    language pinned from past detections, else None (let Whisper detect).
+    A fraction of pinned turns (STT_LANGUAGE_RECHECK_RATE) detect anyway, so
+    a user who switches language gets unpinned.
+    """
+    try:
+        with stage("mongo_language"):
+            doc = await get_stt_language(user_id)
+    except Exception as e:
+        log("Could not read STT language:", e)
+        return None
+    if doc.get("override"):
+        return doc["override"]
+    if doc.get("pinned") and random.random() >= STT_LANGUAGE_RECHECK_RATE:
+        return doc["pinned"]
+    return None
+
+
+async def _transcribe_upload(
+    file: UploadFile,
+    max_seconds: Optional[int],
+    user_id: Optional[str] = None,
+    language: Optional[str] = None,
+    tier: str = "accurate",
+) -> str:
+    """Save the upload, check its format/size/duration, then run Whisper on it."""
+    if language is not None and not is_supported_language(language):
+        raise HTTPException(status_code=400, detail="Unsupported language")
+
+    with stage("upload"):
+        tmp_path = await save_upload(file)
+    try:
+        with stage("probe"):
+            seconds = await run_in_threadpool(probe_duration, tmp_path)
+        check_duration(seconds, max_seconds)
+
+        if language is None and user_id:
+            language = await _user_language(user_id)
+        detect = language is None
+
+        # Short clips go ahead of long uploads (see stt_scheduler); stop
+        # queueing once the caller's deadline passes. The STT server queues
+        # the requests of every worker itself, and its wait is part of "stt".
+        check_deadline("stt")
+        queue_here = not uses_stt_server()
+        if queue_here:
+            with stage("stt_queue"):
+                try:
+                    await asyncio.wait_for(
+                        stt_scheduler.acquire(seconds), time_left()
+                    )
+                except asyncio.TimeoutError:
+                    deadline_exceeded("stt")
+        # faster-whisper is CPU-bound, run it off the event loop
+        try:
+            with stage("stt"):
+                result = await run_in_threadpool(
+                    transcribe, tmp_path, seconds, language, tier, time_left()
+                )
+        except TimeoutError:
+            # The STT server didn't answer before the caller's deadline, or
+            # within STT_SERVER_TIMEOUT_SECONDS when there is none
+            if time_left() is not None:
+                deadline_exceeded("stt")
+            raise HTTPException(status_code=503, detail="Transcription timed out")
+        except SttUnavailable as e:
+            log("Transcription failed:", e)
+            raise HTTPException(
+                status_code=503,
+                detail="Transcription unavailable, retry later",
+                headers={"Retry-After": "5"},
+            )
+        except Exception as e:
+            log("Transcription failed:", e)
+            raise HTTPException(status_code=500, detail=f"Transcription failed: {e}")
+        finally:
+            if queue_here:
+                stt_scheduler.release()
+    finally:
+        # Delete the temporary file to prevent disk accumulation
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+    if detect and user_id and result.language:
+        try:
+            with stage("mongo_language"):
+                await record_detected_language(
+                    user_id, result.language, result.language_probability
+                )
+        except Exception as e:
+            log("Could not record STT language:", e)
+    return result.text
+
+
 @app.post("/api/chat/audio", response_model=ChatResponse)
+@instrumented("chat_audio")
 async def chat_audio(
     user_id: str = Query(..., description="Current user id"),
+    conversation_id: Optional[str] = Query(
+        None, description="web-app conversation to store the turn in"
+    ),
+    turn_id: Optional[str] = Query(
+        None, max_length=64, description="Store the turn only once under this ID"
+    ),
+    history_limit: int = Query(
+        0, ge=0, le=200, description="Also return the last N messages"
+    ),
+    max_seconds: Optional[int] = Query(
+        None, gt=0, description="Reject recordings longer than this"
+    ),
+    language: Optional[str] = Query(
+        None, description="Whisper language code; skips language detection"
+    ),
+    tier: Optional[Literal["fast", "accurate"]] = Query(
+        None, description="Decoding tier; defaults per endpoint (STT_TIER_*)"
+    ),
+    mood: Optional[Literal["positive", "negative", "neutral"]] = Query(
+        None, description="Mood for the local reply if Gemini is slow"
+    ),
     file: UploadFile = File(...),
 ):
     """
     Audio chat endpoint:
 
     Flask client invocation example:
-      POST http://localhost:8001/api/chat/audio?user_id=...
+      POST http://localhost:8001/api/chat/audio?user_id=...&conversation_id=...
       Content-Type: multipart/form-data
       files["file"] = audio_file
 
     The process flow here is:
-      1. Save the uploaded audio to a temporary file.
+      1. Save the uploaded audio to a temporary file, rejecting non-audio
+         (415) and uploads over the size or duration cap (413).
       2. Call faster-whisper to transcribe to text.
       3. Call Gemini to generate a cheerful reply.
       4. Write user/AI messages to Mongo conversation history.
-      5. Return { reply, history } to the Flask client.
+      5. Return { reply, transcript, messages } to the Flask client
+         (plus history when history_limit > 0).
     """
     # 0. Simple validation
     if not user_id:
         raise HTTPException(status_code=400, detail="Missing user_id")
 
-    # 1. Write the uploaded file to a temporary file (WhisperModel requires a file path)
-    try:
-        suffix = Path(file.filename or "").suffix or ".wav"
-    except Exception:
-        suffix = ".wav"
-
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        raw = await file.read()
-        tmp.write(raw)
-        tmp_path = tmp.name
-
-    # 2. Transcribe audio using faster-whisper
-    try:
-        user_text = transcribe_audio(tmp_path)
-    except Exception as e:
-        # Clean up the temporary file on error
-        try:
-            os.unlink(tmp_path)
-        except OSError:
-            pass
-        raise HTTPException(status_code=500, detail=f"Transcription failed: {e}")
-    finally:
-        # Delete the temporary file after transcription to prevent disk accumulation
-        try:
-            os.unlink(tmp_path)
-        except OSError:
-            pass
+    # Reject an unknown shared conversation before spending time on transcription
+    if conversation_id is not None:
+        conv_id, shared = await _open_conversation(user_id, conversation_id)
+
+    # 1-2. Save, check and transcribe the upload
+    user_text = await _transcribe_upload(
+        file,
+        max_seconds,
+        user_id,
+        language,
+        tier or STT_DEFAULT_TIERS["chat_audio"],
+    )
 
     if not user_text:
+        fallback("empty_transcription")
         user_text = "(empty transcription)"
 
-    # 3. Similar to /api/chat, write user/AI messages to Mongo
-    conv = create_or_get_conversation(user_id)
-    append_message(conv["_id"], "user", user_text)
+    if conversation_id is None:
+        conv_id, shared = await _open_conversation(user_id, None)
 
     # ⭐ Generate cheerful reply using Gemini
-    ai_reply = generate_cheerful_reply(user_text)
-    append_message(conv["_id"], "ai", ai_reply)
+    check_deadline("gemini_reply")
+    with stage("gemini_reply"):
+        ai_reply, late = await local_reply.reply_within_slo(
+            _gemini(generate_cheerful_reply(user_text)), mood
+        )
 
-    # 4. Fetch the latest history
-    updated_conv = conversations.find_one({"_id": conv["_id"]})
+    # 3. Similar to /api/chat, write user/AI messages to Mongo in one update
+    check_deadline("mongo_append")
+    with stage("mongo_append"):
+        messages = await append_messages(
+            conv_id,
+            [("user", user_text), ("ai", ai_reply)],
+            shared=shared,
+            turn_id=turn_id,
+        )
+    _settle_late_reply(late, conv_id, shared)
 
-    # 5. Return to Flask client
-    return ChatResponse(
-        reply=ai_reply,
-        history=updated_conv["messages"],
+    # 4. Return to Flask client
+    return await _chat_response(
+        conv_id, shared, user_text, messages, history_limit
     )
 
 
 @app.post("/api/transcribe", response_model=TranscribeResponse)
+@instrumented("transcribe")
 async def transcribe_audio_endpoint(
+    max_seconds: Optional[int] = Query(
+        None, gt=0, description="Reject recordings longer than this"
+    ),
+    user_id: Optional[str] = Query(
+        None, description="Use and update this user's pinned language"
+    ),
+    language: Optional[str] = Query(
+        None, description="Whisper language code; skips language detection"
+    ),
+    tier: Optional[Literal["fast", "accurate"]] = Query(
+        None, description="Decoding tier; defaults per endpoint (STT_TIER_*)"
+    ),
     file: UploadFile = File(...),
 ):
     """
     Audio transcription endpoint (without chat):
     - Just transcribe audio to text
-    - Used for voice input of diary preferences
+    - Used for voice input of diary preferences, so it defaults to the
+      "fast" tier (STT_TIER_TRANSCRIBE)
     """
-    try:
-        suffix = Path(file.filename or "").suffix or ".wav"
-    except Exception:
-        suffix = ".wav"
-
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        raw = await file.read()
-        tmp.write(raw)
-        tmp_path = tmp.name
-
-    try:
-        text = transcribe_audio(tmp_path)
-    except Exception as e:
-        try:
-            os.unlink(tmp_path)
-        except OSError:
-            pass
-        raise HTTPException(status_code=500, detail=f"Transcription failed: {e}")
-    finally:
-        try:
-            os.unlink(tmp_path)
-        except OSError:
-            pass
+    text = await _transcribe_upload(
+        file, max_seconds, user_id, language, tier or STT_DEFAULT_TIERS["transcribe"]
+    )
 
     if not text:
+        fallback("empty_transcription")
         text = ""
 
     return TranscribeResponse(text=text)
 
 
+@app.get("/api/users/{user_id}/stt-language", response_model=SttLanguageResponse)
+async def get_user_language(user_id: str):
+    """The user's language override, pinned language and recent detections."""
+    doc = await get_stt_language(user_id)
+    return SttLanguageResponse(
+        override=doc.get("override"),
+        pinned=doc.get("pinned"),
+        recent=doc.get("recent", []),
+    )
+
+
+@app.post("/api/users/{user_id}/stt-language", response_model=SttLanguageResponse)
+async def set_user_language(user_id: str, req: SttLanguageRequest):
+    """Set the language used for this user's audio, or clear it with null."""
+    if req.language is not None and not is_supported_language(req.language):
+        raise HTTPException(status_code=400, detail="Unsupported language")
+    await set_stt_language_override(user_id, req.language)
+    return await get_user_language(user_id)
+
+
 @app.post("/api/generate-diary", response_model=DiaryResponse)
-def generate_diary_endpoint(req: DiaryRequest):
+@instrumented("generate_diary")
+async def generate_diary_endpoint(req: DiaryRequest):
     """
     Generate a diary entry based on conversation messages and user preferences.
 
@@ -253,9 +665,16 @@ def generate_diary_endpoint(req: DiaryRequest):
         style = req.preferences.style
         custom_instructions = req.preferences.custom_instructions
 
-    result = generate_diary(
-        req.messages, theme=theme, style=style, custom_instructions=custom_instructions
-    )
+    check_deadline("gemini_diary")
+    with stage("gemini_diary"):
+        result = await _gemini(
+            generate_diary(
+                req.messages,
+                theme=theme,
+                style=style,
+                custom_instructions=custom_instructions,
+            )
+        )
 
     return DiaryResponse(
         title=result["title"],
@@ -0,0 +1,156 @@
+"""
+Driver-level MongoDB metrics for the AsyncMongoClient in db.py.
+
+- CommandTimer records ai_mongo_command_duration_seconds per database,
+  collection and command, and logs a "Slow MongoDB command" line (with the
+  request ID) for commands slower than MONGO_SLOW_MS.
+- PoolMonitor records how long a coroutine waits to check a connection out
+  of the pool, checkout failures, and open / checked-out connection gauges.
+
+The mongo_* stages of ai_stage_duration_seconds time whole db.py calls per
+endpoint; these break the same time down by collection and show when it is
+spent waiting for the pool. web-app has the same listeners under mongo_*
+names. With more than one worker, samples go to PROMETHEUS_MULTIPROC_DIR
+like every other ai-service metric.
+"""
+
+import os
+import threading
+from typing import Any, Dict, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+from pymongo import monitoring
+
+from .instrumentation import BUCKETS, log
+
+SLOW_MS = float(os.getenv("MONGO_SLOW_MS", "100"))
+
+COMMAND_SECONDS = Histogram(
+    "ai_mongo_command_duration_seconds",
+    "MongoDB command latency as seen by the driver.",
+    ["database", "collection", "command"],
+    buckets=BUCKETS,
+)
+COMMAND_FAILURES = Counter(
+    "ai_mongo_command_failures_total",
+    "MongoDB commands that returned an error.",
+    ["database", "collection", "command"],
+)
+CHECKOUT_WAIT_SECONDS = Histogram(
+    "ai_mongo_pool_checkout_wait_seconds",
+    "Time spent waiting to check a connection out of the pool.",
+    buckets=BUCKETS,
+)
+CHECKOUT_FAILURES = Counter(
+    "ai_mongo_pool_checkout_failures_total",
+    "Connection checkouts that failed, by reason.",
+    ["reason"],
+)
+CONNECTIONS_OPEN = Gauge(
+    "ai_mongo_pool_connections_open",
+    "Connections currently open in the pool.",
+    multiprocess_mode="livesum",
+)
+CONNECTIONS_CHECKED_OUT = Gauge(
+    "ai_mongo_pool_connections_checked_out",
+    "Connections currently checked out of the pool.",
+    multiprocess_mode="livesum",
+)
+
+# Commands whose first value isn't a collection name
+_NO_COLLECTION = {"getMore": "collection"}
+
+
+def _collection_of(command: Dict[str, Any]) -> str:
+    if not command:
+        return ""
+    name = next(iter(command))
+    if name in _NO_COLLECTION:
+        value = command.get(_NO_COLLECTION[name])
+    else:
+        value = command[name]
+    return value if isinstance(value, str) else ""
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Times every command; succeeded/failed events don't carry the command
+    body, so the collection is remembered from the started event."""
+
+    def __init__(self, slow_ms: float = SLOW_MS):
+        self.slow_ms = slow_ms
+        self._pending: Dict[Tuple[Any, int], Tuple[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        key = (event.connection_id, event.request_id)
+        with self._lock:
+            self._pending[key] = (event.database_name, _collection_of(event.command))
+
+    def _finish(self, event):
+        with self._lock:
+            database, collection = self._pending.pop(
+                (event.connection_id, event.request_id),
+                (event.database_name, ""),
+            )
+        labels = dict(
+            database=database, collection=collection, command=event.command_name
+        )
+        COMMAND_SECONDS.labels(**labels).observe(event.duration_micros / 1e6)
+        return labels
+
+    def succeeded(self, event):
+        labels = self._finish(event)
+        ms = event.duration_micros / 1000
+        if ms >= self.slow_ms:
+            log(
+                f"Slow MongoDB command: {labels['command']} "
+                f"{labels['database']}.{labels['collection']} took {ms:.1f} ms"
+            )
+
+    def failed(self, event):
+        labels = self._finish(event)
+        COMMAND_FAILURES.labels(**labels).inc()
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        CONNECTIONS_OPEN.inc()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        CONNECTIONS_OPEN.dec()
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        if event.duration is not None:
+            CHECKOUT_WAIT_SECONDS.observe(event.duration)
+        CHECKOUT_FAILURES.labels(reason=event.reason).inc()
+
+    def connection_checked_out(self, event):
+        if event.duration is not None:
+            CHECKOUT_WAIT_SECONDS.observe(event.duration)
+        CONNECTIONS_CHECKED_OUT.inc()
+
+    def connection_checked_in(self, event):
+        CONNECTIONS_CHECKED_OUT.dec()
+
+
+def event_listeners():
+    """Fresh listeners for one client."""
+    return [CommandTimer(), PoolMonitor()]
@@ -0,0 +1,149 @@
+"""
+Opt-in per-request profiling.
+
+Disabled unless PROFILE_TOKEN or PROFILE_SAMPLE_RATE is set; the services
+only install their profiling hooks when ENABLED is true, so a disabled
+profiler costs nothing per request.
+
+A request is profiled when it carries ``X-Profile: <PROFILE_TOKEN>`` or is
+picked by PROFILE_SAMPLE_RATE (0-1). Only one request is profiled at a time
+per process; others run normally. Profiles are written to PROFILE_DIR (the
+newest PROFILE_KEEP are kept), named after the request ID, and returned in
+the X-Profile-Id response header. They can be downloaded from
+/debug/profiles/<id> with the same X-Profile header.
+
+A background thread samples the stacks of every thread each
+PROFILE_INTERVAL_MS, which also catches work handed to thread pools (Whisper,
+Gemini); profiles are saved as <id>.folded (collapsed stacks, for
+flamegraph.pl / speedscope).
+
+web-app answers to the same variables, header and /debug/profiles endpoints,
+but its requests run on one thread, so it uses Werkzeug's cProfile
+middleware instead of this module (see web-app/profiling.py).
+"""
+
+import hmac
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+from collections import Counter as _Counter
+from typing import List, Optional
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+TOKEN = os.getenv("PROFILE_TOKEN", "")
+SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR") or os.path.join(
+    tempfile.gettempdir(), "profiles"
+)
+KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+
+ENABLED = bool(TOKEN) or SAMPLE_RATE > 0
+
+_NAME_RE = re.compile(r"^[A-Za-z0-9._-]{1,64}\.folded$")
+
+# Overlapping sessions would mix their stacks
+_busy = threading.Lock()
+
+
+def authorized(header_value: Optional[str]) -> bool:
+    return bool(TOKEN) and hmac.compare_digest(header_value or "", TOKEN)
+
+
+def wanted(header_value: Optional[str]) -> bool:
+    """Should this request be profiled?"""
+    if authorized(header_value):
+        return True
+    return SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE
+
+
+class SamplingSession:
+    suffix = ".folded"
+
+    def __init__(self, interval: float = INTERVAL):
+        self.interval = interval
+        self.stacks = _Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                        f":{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def start():
+    """Start a profiling session, or return None if one is already running."""
+    if not _busy.acquire(blocking=False):
+        return None
+    try:
+        return SamplingSession()
+    except Exception:
+        _busy.release()
+        raise
+
+
+def finish(session, request_id: str) -> str:
+    """Stop the session, save it as <request_id><suffix> and return that name."""
+    try:
+        session.stop()
+    finally:
+        _busy.release()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{request_id}{session.suffix}"
+    session.save(os.path.join(PROFILE_DIR, name))
+    _prune()
+    return name
+
+
+def _prune():
+    names = list_profiles()
+    for name in names[KEEP:]:
+        try:
+            os.unlink(os.path.join(PROFILE_DIR, name))
+        except OSError:
+            pass
+
+
+def list_profiles() -> List[str]:
+    """Saved profile names, newest first."""
+    try:
+        entries = [e for e in os.scandir(PROFILE_DIR) if _NAME_RE.match(e.name)]
+    except FileNotFoundError:
+        return []
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    return [e.name for e in entries]
+
+
+def profile_path(name: str) -> Optional[str]:
+    """Path of a saved profile, or None for unknown / malformed names."""
+    if not _NAME_RE.match(name):
+        return None
+    path = os.path.join(PROFILE_DIR, name)
+    return path if os.path.isfile(path) else None
@@ -0,0 +1,141 @@
+"""
+Entry point for the ai-service container (the Dockerfile's CMD).
+
+    python -m app.serve
+
+Runs uvicorn with WEB_CONCURRENCY workers (default 1). With more than one
+worker, the Whisper model is not loaded per worker: the STT server
+(app.services.stt_server) is started first, loads the model once, and the
+workers send it transcription requests over a Unix socket. If the STT server
+exits it is restarted, backing off exponentially (up to RESTART_BACKOFF_MAX
+seconds) while it keeps failing; meanwhile workers answer audio requests with
+503. With a single worker the model lives in-process.
+
+With more than one worker, every process (workers and STT server) writes its
+metric samples to PROMETHEUS_MULTIPROC_DIR, which is emptied at startup, so
+/metrics on any worker reports all of them.
+
+    WEB_CONCURRENCY      uvicorn worker processes (default 1)
+    STT_SERVER_THREADS   transcriptions the STT server decodes in parallel
+    HOST / PORT          bind address (default 0.0.0.0:8000)
+    PROMETHEUS_MULTIPROC_DIR
+                         metric sample directory (default: one under the
+                         system temp dir)
+"""
+
+import os
+import secrets
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import uvicorn
+
+STARTUP_TIMEOUT = 300  # first start may download the model
+RESTART_BACKOFF_MAX = 60
+
+
+def _start_stt_server(address):
+    proc = subprocess.Popen([sys.executable, "-m", "app.services.stt_server"])
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    # The server only creates the socket once the model is loaded
+    while not os.path.exists(address):
+        if proc.poll() is not None:
+            _mark_process_dead(proc.pid)
+            raise RuntimeError(f"STT server exited with status {proc.returncode}")
+        if time.monotonic() > deadline:
+            proc.kill()
+            proc.wait()
+            _mark_process_dead(proc.pid)
+            raise RuntimeError("STT server did not start in time")
+        time.sleep(0.2)
+    return proc
+
+
+def _supervise(state, address):
+    # While the STT server is down, workers answer audio requests with 503
+    delay = 0
+    while True:
+        started = time.monotonic()
+        code = state["proc"].wait()
+        if state["stopping"]:
+            return
+        _mark_process_dead(state["proc"].pid)
+        # Restart at once after a long run, back off if it keeps failing
+        if time.monotonic() - started > RESTART_BACKOFF_MAX:
+            delay = 0
+        print(f"STT server exited with status {code}; restarting in {delay}s")
+        while True:
+            time.sleep(delay)
+            delay = min(max(1, delay * 2), RESTART_BACKOFF_MAX)
+            if state["stopping"]:
+                return
+            # A stale socket would look like a ready server
+            if os.path.exists(address):
+                os.unlink(address)
+            try:
+                state["proc"] = _start_stt_server(address)
+                break
+            except RuntimeError as e:
+                print(f"STT server restart failed: {e}; retrying in {delay}s")
+        if state["stopping"]:
+            # main() may have stopped the previous process meanwhile
+            state["proc"].terminate()
+
+
+def _reset_metrics_dir():
+    # Must be set before any process imports prometheus_client; samples left
+    # by a previous run would be summed into this one's
+    path = os.environ.setdefault(
+        "PROMETHEUS_MULTIPROC_DIR",
+        os.path.join(tempfile.gettempdir(), "ai-service-metrics"),
+    )
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def _mark_process_dead(pid):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(pid)
+
+
+def main():
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "8000"))
+
+    if workers > 1:
+        _reset_metrics_dir()
+
+    state = None
+    if workers > 1 and not os.getenv("STT_SERVER_ADDRESS"):
+        address = os.path.join(
+            tempfile.gettempdir(), f"ai-service-stt-{os.getpid()}.sock"
+        )
+        # Inherited by the STT server and every uvicorn worker
+        os.environ["STT_SERVER_ADDRESS"] = address
+        os.environ.setdefault("STT_SERVER_AUTHKEY", secrets.token_hex(16))
+        try:
+            state = {"proc": _start_stt_server(address), "stopping": False}
+        except RuntimeError as e:
+            raise SystemExit(str(e))
+        threading.Thread(
+            target=_supervise, args=(state, address), daemon=True
+        ).start()
+
+    try:
+        uvicorn.run("app.main:app", host=host, port=port, workers=workers)
+    finally:
+        if state is not None:
+            state["stopping"] = True
+            state["proc"].terminate()
+            state["proc"].wait(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Shortest-job-first admission to Whisper.
+
+At most STT_CONCURRENCY transcriptions run at once. When a slot frees up,
+the waiting job with the lowest score goes next, where
+
+    score = audio seconds - STT_AGING_RATE * seconds waited
+
+so a 5 s voice turn overtakes a queued 10-minute upload, but the upload
+gains priority while it waits and can't be starved: with the default rate of
+1.0, a job that has waited as long as its own audio competes like a 0 s clip.
+
+Durations come from probe_duration() (the container header), before any
+decoding. Queue waits are exported per size class as stt_queue_wait_seconds.
+
+SttScheduler queues the requests of one uvicorn worker. With several workers
+the STT server owns the model, and it queues the requests of all of them
+with ThreadedSttScheduler (one thread per connection, STT_SERVER_THREADS
+slots), so the bound and the order hold across workers.
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from prometheus_client import Gauge, Histogram
+
+STT_CONCURRENCY = int(os.getenv("STT_CONCURRENCY", "2"))
+STT_AGING_RATE = float(os.getenv("STT_AGING_RATE", "1.0"))
+
+# Upper bounds (audio seconds) of the size classes used as metric labels
+SIZE_CLASSES = (("short", 30.0), ("medium", 120.0), ("long", float("inf")))
+
+QUEUE_WAIT = Histogram(
+    "stt_queue_wait_seconds",
+    "Time a transcription waited for a Whisper slot, by audio size class.",
+    ["size"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+QUEUE_DEPTH = Gauge(
+    "stt_queue_depth",
+    "Transcriptions waiting for a Whisper slot.",
+    multiprocess_mode="livesum",
+)
+RUNNING = Gauge(
+    "stt_running",
+    "Transcriptions currently holding a Whisper slot.",
+    multiprocess_mode="livesum",
+)
+
+
+def size_class(seconds: Optional[float]) -> str:
+    seconds = seconds or 0.0
+    for name, upper in SIZE_CLASSES:
+        if seconds < upper:
+            return name
+    return SIZE_CLASSES[-1][0]
+
+
+@dataclass
+class _Waiter:
+    duration: float
+    enqueued: float
+    # asyncio.Future or concurrent.futures.Future; set once it gets a slot
+    future: object = field(repr=False)
+
+
+class _ShortestJobFirst:
+    """Slot accounting and hand-over order shared by both schedulers."""
+
+    def __init__(self, slots: int, aging_rate: float):
+        self.slots = slots
+        self.aging_rate = aging_rate
+        self._free = slots
+        self._waiting: List[_Waiter] = []
+        self._clock = time.monotonic
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def _score(self, waiter: _Waiter, now: float) -> float:
+        return waiter.duration - self.aging_rate * (now - waiter.enqueued)
+
+    def _started(self, duration: Optional[float], start: float) -> float:
+        waited = self._clock() - start
+        QUEUE_WAIT.labels(size=size_class(duration)).observe(waited)
+        RUNNING.inc()
+        return waited
+
+    def _hand_over(self):
+        now = self._clock()
+        while self._waiting:
+            waiter = min(self._waiting, key=lambda w: self._score(w, now))
+            self._waiting.remove(waiter)
+            QUEUE_DEPTH.dec()
+            if not waiter.future.done():
+                waiter.future.set_result(None)
+                return
+        self._free += 1
+
+
+class SttScheduler(_ShortestJobFirst):
+    """
+    Slots for concurrent transcriptions, handed out shortest job first.
+
+        await scheduler.acquire(seconds)
+        try:
+            ...transcribe...
+        finally:
+            scheduler.release()
+
+    Must be used from a single event loop.
+    """
+
+    def __init__(
+        self, slots: int = STT_CONCURRENCY, aging_rate: float = STT_AGING_RATE
+    ):
+        super().__init__(slots, aging_rate)
+
+    async def acquire(self, duration: Optional[float]) -> float:
+        """Wait for a slot; returns the seconds spent waiting."""
+        start = self._clock()
+        if self._free > 0 and not self._waiting:
+            self._free -= 1
+        else:
+            waiter = _Waiter(
+                duration or 0.0, start, asyncio.get_running_loop().create_future()
+            )
+            self._waiting.append(waiter)
+            QUEUE_DEPTH.inc()
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                # Client went away. If the slot was handed over at the same
+                # moment, pass it on instead of leaking it.
+                if waiter in self._waiting:
+                    self._waiting.remove(waiter)
+                    QUEUE_DEPTH.dec()
+                elif not waiter.future.cancelled():
+                    self._hand_over()
+                raise
+        return self._started(duration, start)
+
+    def release(self):
+        """Give the slot to the best-scoring waiter, or free it."""
+        RUNNING.dec()
+        self._hand_over()
+
+
+class ThreadedSttScheduler(_ShortestJobFirst):
+    """
+    SttScheduler for callers on different threads (the STT server's
+    connection handlers):
+
+        if scheduler.acquire(seconds, timeout) is None:
+            ...gave up waiting...
+        try:
+            ...transcribe...
+        finally:
+            scheduler.release()
+    """
+
+    def __init__(self, slots: int, aging_rate: float = STT_AGING_RATE):
+        super().__init__(slots, aging_rate)
+        self._lock = threading.Lock()
+
+    def acquire(
+        self, duration: Optional[float], timeout: Optional[float] = None
+    ) -> Optional[float]:
+        """Block for a slot; the seconds waited, or None if timeout ran out."""
+        start = self._clock()
+        with self._lock:
+            if self._free > 0 and not self._waiting:
+                self._free -= 1
+                return self._started(duration, start)
+            waiter = _Waiter(duration or 0.0, start, concurrent.futures.Future())
+            self._waiting.append(waiter)
+            QUEUE_DEPTH.inc()
+        try:
+            waiter.future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            with self._lock:
+                if waiter in self._waiting:
+                    self._waiting.remove(waiter)
+                    QUEUE_DEPTH.dec()
+                    return None
+            # Handed the slot just as the wait ran out: keep it
+        return self._started(duration, start)
+
+    def release(self):
+        RUNNING.dec()
+        with self._lock:
+            self._hand_over()
+
+
+# One scheduler for the process; the endpoints share the Whisper slots
+scheduler = SttScheduler()
@@ -0,0 +1,96 @@
+"""
+Shared STT server: one process holds the Whisper model for every uvicorn
+worker.
+
+uvicorn starts its workers with the "spawn" method, so a model loaded before
+they start would not be inherited, and each worker would load and hold its
+own copy. Instead app.serve starts this server first; it loads the model
+once (with STT_SERVER_THREADS CTranslate2 workers, so that many
+transcriptions decode in parallel) and then listens on STT_SERVER_ADDRESS.
+Workers with STT_SERVER_ADDRESS set send each request as
+("transcribe", path, duration, language, tier, timeout) and get back
+("ok", Transcription), ("error", message), or ("timeout", message) when no
+slot came free within timeout seconds. Long recordings are chunked here, by
+this process's pool.
+
+Requests from all workers share STT_SERVER_THREADS slots, handed out
+shortest job first (stt_scheduler.ThreadedSttScheduler); the rest wait here.
+("waiting",) returns how many are waiting, for the workers' admission
+control.
+
+    STT_SERVER_ADDRESS=/tmp/stt.sock python -m app.services.stt_server
+"""
+
+import os
+import threading
+from multiprocessing.connection import Listener
+
+from . import stt_service
+from .stt_scheduler import ThreadedSttScheduler
+
+STT_SERVER_THREADS = int(
+    os.getenv("STT_SERVER_THREADS", str(max(1, (os.cpu_count() or 1) // 2)))
+)
+
+
+def _handle(conn, scheduler):
+    with conn:
+        try:
+            request = conn.recv()
+            if request[0] == "waiting":
+                conn.send(scheduler.waiting)
+                return
+            _, path, duration, language, tier, timeout = request
+            # The worker stops waiting after timeout; don't decode for nobody
+            if scheduler.acquire(duration, timeout) is None:
+                conn.send(("timeout", f"no STT slot within {timeout:.1f}s"))
+                return
+            try:
+                result = stt_service.transcribe_local(path, duration, language, tier)
+            finally:
+                scheduler.release()
+            conn.send(("ok", tuple(result)))
+        except (EOFError, BrokenPipeError):
+            pass  # the worker went away
+        except Exception as e:
+            print("STT server: transcription failed:", e)
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+def serve(
+    address: str,
+    threads: int = STT_SERVER_THREADS,
+    authkey: bytes = stt_service.STT_SERVER_AUTHKEY,
+    ready: threading.Event = None,
+):
+    # Load before listening, so the socket appearing means "ready". The
+    # cores are split between the decoding threads rather than each using all
+    stt_service.preload(
+        num_workers=threads, cpu_threads=max(1, (os.cpu_count() or 1) // threads)
+    )
+
+    scheduler = ThreadedSttScheduler(slots=threads)
+
+    if os.path.exists(address):
+        os.unlink(address)
+    with Listener(address, family="AF_UNIX", authkey=authkey) as listener:
+        print(f"STT server on {address} ({threads} decoding threads)")
+        if ready is not None:
+            ready.set()
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # Failed handshake (wrong authkey) or a client that hung up
+                print("STT server: rejected connection:", e)
+                continue
+            # Cheap: handlers past the first `threads` wait in the scheduler
+            threading.Thread(
+                target=_handle, args=(conn, scheduler), daemon=True
+            ).start()
+
+
+if __name__ == "__main__":
+    if not stt_service.STT_SERVER_ADDRESS:
+        raise SystemExit("STT_SERVER_ADDRESS is not set")
+    serve(stt_service.STT_SERVER_ADDRESS)
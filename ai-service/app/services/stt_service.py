@@ -1,34 +1,336 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.connection import Client
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 from pathlib import Path
-from typing import Union
+from typing import NamedTuple, Optional, Union
 
-from faster_whisper import WhisperModel
+import av
+import numpy as np
+from faster_whisper import WhisperModel, decode_audio
+
+# Long recordings (at least STT_CHUNK_THRESHOLD_SECONDS; 0 disables) are cut
+# at silences into chunks of at most STT_CHUNK_SECONDS and transcribed in
+# parallel by STT_WORKERS processes, each with its own model.
+STT_CHUNK_THRESHOLD_SECONDS = float(os.getenv("STT_CHUNK_THRESHOLD_SECONDS", "120"))
+STT_CHUNK_SECONDS = float(os.getenv("STT_CHUNK_SECONDS", "60"))
+STT_WORKERS = int(os.getenv("STT_WORKERS", str(max(2, (os.cpu_count() or 1) // 2))))
+
+# Decoding options per latency tier. "accurate" is faster-whisper's default
+# (beam search of 5, timestamps, conditioning on the previous window's text);
+# "fast" decodes greedily, without timestamp tokens or that conditioning.
+STT_TIERS = {
+    "fast": {
+        "beam_size": 1,
+        "without_timestamps": True,
+        "condition_on_previous_text": False,
+    },
+    "accurate": {},
+}
+# Tier used when a request doesn't pick one, per endpoint
+STT_DEFAULT_TIERS = {
+    "chat_audio": os.getenv("STT_TIER_CHAT_AUDIO", "accurate"),
+    "transcribe": os.getenv("STT_TIER_TRANSCRIBE", "fast"),
+}
+
+# When set, transcription is done by the shared STT server listening on this
+# Unix socket (see stt_server and app.serve) instead of a model loaded in
+# this process. The socket is only reachable with STT_SERVER_AUTHKEY.
+STT_SERVER_ADDRESS = os.getenv("STT_SERVER_ADDRESS")
+STT_SERVER_AUTHKEY = os.getenv("STT_SERVER_AUTHKEY", "").encode() or None
+# How long a worker waits for the STT server when the caller set no deadline
+STT_SERVER_TIMEOUT_SECONDS = float(os.getenv("STT_SERVER_TIMEOUT_SECONDS", "300"))
+
+SAMPLE_RATE = 16000
+# A chunk boundary is the quietest 20 ms frame in the last quarter of the chunk
+_FRAME_SECONDS = 0.02
+_CUT_SEARCH = 0.25
 
 # Lazily load the global model to avoid reloading on every request
 _model: WhisperModel | None = None
 
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+def _load_model(**kwargs) -> WhisperModel:
+    # Start with the tiny/cpu version for speed and low resource usage
+    # Can be switched to "base" / "small" later
+    return WhisperModel("tiny", device="cpu", compute_type="float32", **kwargs)
+
 
 def get_model() -> WhisperModel:
     global _model
     if _model is None:
-        # Start with the tiny/cpu version for speed and low resource usage
-        # Can be switched to "base" / "small" later
-        _model = WhisperModel("tiny", device="cpu", compute_type="float32")
+        _model = _load_model()
     return _model
 
 
-def transcribe_audio(path: Union[str, Path]) -> str:
-    """
-    Given an audio file path, returns the recognized text (simply concatenating all segments).
+def preload(**kwargs) -> WhisperModel:
+    """Load the model now (with extra WhisperModel options) instead of lazily."""
+    global _model
+    _model = _load_model(**kwargs)
+    return _model
+
+
+class SttUnavailable(Exception):
+    """The STT server can't be reached (e.g. it is restarting)."""
+
+
+class Transcription(NamedTuple):
+    text: str
+    # The language Whisper decoded in; when none was passed in this is the
+    # detected one, with the detector's probability (1.0 otherwise)
+    language: Optional[str]
+    language_probability: float
+
+
+# Language codes a multilingual Whisper model accepts. faster-whisper only
+# exposes them on a loaded model (WhisperModel.supported_languages), and with
+# several workers the model lives in the STT server, so the list is kept here.
+WHISPER_LANGUAGES = frozenset(
     """
-    model = get_model()
-    audio_path = str(path)
+    af am ar as az ba be bg bn bo br bs ca cs cy da de el en es et eu fa fi
+    fo fr gl gu ha haw he hi hr ht hu hy id is it ja jw ka kk km kn ko la lb
+    ln lo lt lv mg mi mk ml mn mr ms mt my ne nl nn no oc pa pl ps pt ro ru
+    sa sd si sk sl sn so sq sr su sv sw ta te tg th tk tl tr tt uk ur uz vi
+    yi yo zh yue
+    """.split()
+)
 
-    segments, info = model.transcribe(audio_path)
+
+def is_supported_language(code: str) -> bool:
+    return code in WHISPER_LANGUAGES
+
+
+def _transcribe(
+    audio, language: Optional[str] = None, tier: str = "accurate"
+) -> Transcription:
+    """Run Whisper on a path or 16 kHz float32 array; segments joined with spaces."""
+    # With language=None Whisper first runs language detection on the
+    # opening 30 s; passing it skips that pass
+    segments, info = get_model().transcribe(
+        audio, language=language, **STT_TIERS[tier]
+    )
 
     pieces: list[str] = []
     for seg in segments:
         # seg.text is already the result for this segment, e.g., " I went for a run today"
         pieces.append(seg.text)
 
-    text = " ".join(pieces).strip()
-    return text
\ No newline at end of file
+    return Transcription(
+        " ".join(pieces).strip(), info.language, info.language_probability
+    )
+
+
+def transcribe(
+    path: Union[str, Path],
+    duration: Optional[float] = None,
+    language: Optional[str] = None,
+    tier: str = "accurate",
+    timeout: Optional[float] = None,
+) -> Transcription:
+    """
+    Transcribe an audio file, detecting the language unless one is given.
+    tier is a key of STT_TIERS.
+
+    Recordings of STT_CHUNK_THRESHOLD_SECONDS or more go through
+    transcribe_chunked(). Pass duration if it's already known to skip probing.
+
+    With the STT server, timeout bounds the wait for it (queue included;
+    default STT_SERVER_TIMEOUT_SECONDS) and TimeoutError is raised once it
+    passes. An in-process transcription can't be interrupted and ignores it.
+    """
+    if STT_SERVER_ADDRESS:
+        return _remote_transcribe(path, duration, language, tier, timeout)
+    return transcribe_local(path, duration, language, tier)
+
+
+def transcribe_local(
+    path: Union[str, Path],
+    duration: Optional[float] = None,
+    language: Optional[str] = None,
+    tier: str = "accurate",
+) -> Transcription:
+    """transcribe() with this process's own model."""
+    if duration is None:
+        duration = probe_duration(path)
+    if (
+        STT_CHUNK_THRESHOLD_SECONDS > 0
+        and duration is not None
+        and duration >= STT_CHUNK_THRESHOLD_SECONDS
+    ):
+        return transcribe_chunked(path, language, tier)
+    return _transcribe(str(path), language, tier)
+
+
+def transcribe_audio(
+    path: Union[str, Path],
+    duration: Optional[float] = None,
+    language: Optional[str] = None,
+    tier: str = "accurate",
+) -> str:
+    """
+    Given an audio file path, returns the recognized text (simply concatenating all segments).
+    """
+    return transcribe(path, duration, language, tier).text
+
+
+def uses_stt_server() -> bool:
+    """True when transcriptions (and their queue) live in the STT server."""
+    return bool(STT_SERVER_ADDRESS)
+
+
+def _connect():
+    return Client(STT_SERVER_ADDRESS, family="AF_UNIX", authkey=STT_SERVER_AUTHKEY)
+
+
+def server_waiting() -> int:
+    """Transcriptions queued in the STT server, from every worker (0 if it
+    can't be reached; the transcription itself will report that)."""
+    try:
+        with _connect() as conn:
+            conn.send(("waiting",))
+            if conn.poll(1.0):
+                return conn.recv()
+    except (OSError, EOFError):
+        pass
+    return 0
+
+
+def _remote_transcribe(path, duration, language, tier, timeout) -> Transcription:
+    """
+    Ask the STT server to transcribe path. Only the path crosses the socket;
+    the server reads the file from the same filesystem. The server gives up
+    queueing once timeout passes, too.
+    """
+    if timeout is None:
+        timeout = STT_SERVER_TIMEOUT_SECONDS
+    try:
+        conn = _connect()
+    except OSError as e:
+        raise SttUnavailable(f"STT server unreachable: {e}") from e
+    with conn:
+        conn.send(("transcribe", str(path), duration, language, tier, timeout))
+        if not conn.poll(max(0.0, timeout)):
+            raise TimeoutError(f"STT server did not answer within {timeout:.1f}s")
+        try:
+            status, result = conn.recv()
+        except EOFError:
+            raise SttUnavailable("STT server closed the connection") from None
+    if status == "timeout":
+        raise TimeoutError(result)
+    if status != "ok":
+        raise RuntimeError(result)
+    return Transcription(*result)
+
+
+# ========= Long-audio mode =========
+
+
+def split_at_silence(
+    audio: np.ndarray, max_seconds: float = STT_CHUNK_SECONDS, sr: int = SAMPLE_RATE
+) -> list[tuple[int, int]]:
+    """
+    (start, end) sample ranges covering audio, none longer than max_seconds.
+
+    Each cut is placed in the quietest 20 ms frame (lowest mean energy) of the
+    last quarter of the window, so it falls between words rather than inside one.
+    """
+    max_len = int(max_seconds * sr)
+    frame = int(_FRAME_SECONDS * sr)
+    bounds = []
+    start = 0
+    while len(audio) - start > max_len:
+        lo = start + int(max_len * (1 - _CUT_SEARCH))
+        n_frames = (start + max_len - lo) // frame
+        frames = audio[lo : lo + n_frames * frame].reshape(n_frames, frame)
+        quietest = int(np.argmin(np.square(frames).mean(axis=1)))
+        cut = lo + quietest * frame + frame // 2
+        bounds.append((start, cut))
+        start = cut
+    bounds.append((start, len(audio)))
+    return bounds
+
+
+def _init_worker(cpu_threads: int):
+    global _model
+    _model = _load_model(cpu_threads=cpu_threads)
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """The shared transcription process pool, started on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Split the cores between workers instead of each one using all of them
+            cpu_threads = max(1, (os.cpu_count() or 1) // STT_WORKERS)
+            _pool = ProcessPoolExecutor(
+                max_workers=STT_WORKERS,
+                # CTranslate2's threads don't survive fork()
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(cpu_threads,),
+            )
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+def transcribe_chunked(
+    path: Union[str, Path], language: Optional[str] = None, tier: str = "accurate"
+) -> Transcription:
+    """
+    Decode, split at silences, transcribe chunks in parallel, join in order.
+
+    Without a language each chunk detects its own; the most confident
+    detection is reported for the whole recording.
+    """
+    audio = decode_audio(str(path), sampling_rate=SAMPLE_RATE)
+    chunks = [audio[start:end] for start, end in split_at_silence(audio)]
+    try:
+        parts = list(
+            get_pool().map(partial(_transcribe, language=language, tier=tier), chunks)
+        )
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM); start a fresh pool for the next request
+        shutdown_pool()
+        raise
+    best = max(parts, key=lambda part: part.language_probability)
+    return Transcription(
+        " ".join(part.text for part in parts if part.text),
+        best.language,
+        best.language_probability,
+    )
+
+
+def probe_duration(path: Union[str, Path]) -> Optional[float]:
+    """
+    Length of the recording in seconds, from the container header or, when
+    that is missing (e.g. MediaRecorder WebM), from packet timestamps.
+    Demuxes without decoding. Returns None if the file can't be read as audio.
+    """
+    try:
+        with av.open(str(path)) as container:
+            if container.duration:
+                return container.duration / av.time_base
+            stream = container.streams.audio[0]
+            end = 0.0
+            for packet in container.demux(stream):
+                if packet.pts is not None:
+                    end = max(
+                        end,
+                        float((packet.pts + (packet.duration or 0)) * packet.time_base),
+                    )
+            return end
+    except (av.FFmpegError, IndexError):
+        return None
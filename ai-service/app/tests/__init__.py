@@ -0,0 +1,6 @@
+from prometheus_client import REGISTRY
+
+
+def sample(name, **labels):
+    """Current value of one metric sample, 0 if it was never recorded."""
+    return REGISTRY.get_sample_value(name, labels) or 0
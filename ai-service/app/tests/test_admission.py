@@ -0,0 +1,98 @@
+from unittest.mock import patch
+
+from fastapi.testclient import TestClient
+
+from app import admission
+from app.admission import Budget
+from app.main import app
+from app.tests import sample
+
+client = TestClient(app)
+
+
+def test_limit_shrinks_while_latency_is_over_target():
+    budget = Budget("test_shrink", max_in_flight=10, target_seconds=2.0)
+    assert budget.limit() == 10
+
+    budget.latency = 4.0
+    assert budget.limit() == 5
+    budget.latency = 1000.0
+    assert budget.limit() == 1  # always lets something through
+
+
+def test_budget_tracks_in_flight_and_latency():
+    budget = Budget("test_track", max_in_flight=2, target_seconds=10.0)
+
+    assert budget.try_enter() and budget.try_enter()
+    assert not budget.try_enter()
+
+    budget.leave(1.0)
+    assert budget.latency == 1.0
+    budget.leave(6.0)
+    assert budget.latency == 2.0  # EWMA, alpha 0.2
+    assert budget.in_flight == 0
+    assert budget.retry_after() == 2
+
+
+def test_full_budget_returns_503_with_retry_after():
+    budget = admission.BUDGETS["chat"]
+    before = sample("ai_admission_rejected_total", endpoint="chat", reason="in_flight")
+
+    with patch.object(budget, "in_flight", budget.max_in_flight):
+        r = client.post("/api/chat", json={"user_id": "u1", "text": "hi"})
+
+    assert r.status_code == 503
+    assert int(r.headers["Retry-After"]) >= 1
+    assert "X-Request-ID" in r.headers
+    assert sample("ai_admission_rejected_total", endpoint="chat", reason="in_flight") == before + 1
+
+
+def test_chat_and_diary_refused_while_gemini_calls_are_at_the_limit():
+    before = sample("ai_admission_rejected_total", endpoint="chat", reason="llm")
+
+    with patch.object(admission.LLM, "in_flight", admission.LLM.max_in_flight):
+        r = client.post("/api/chat", json={"user_id": "u1", "text": "hi"})
+        diary = client.post("/api/generate-diary", json={"messages": []})
+        # Transcription doesn't call Gemini
+        assert admission.admit("transcribe") is None
+        admission.BUDGETS["transcribe"].leave(0.1)
+
+    assert r.status_code == 503
+    assert diary.status_code == 503
+    assert int(r.headers["Retry-After"]) >= 1
+    assert sample("ai_admission_rejected_total", endpoint="chat", reason="llm") == before + 1
+
+
+def test_audio_refused_while_stt_queue_is_long():
+    with patch("app.main.stt_scheduler") as sched, \
+         patch("app.main.transcribe") as mock_stt:
+        sched.waiting = admission.ADMIT_STT_QUEUE_MAX
+        r = client.post(
+            "/api/transcribe",
+            files={"file": ("a.wav", b"RIFF....WAVE", "audio/wav")},
+        )
+
+    assert r.status_code == 503
+    mock_stt.assert_not_called()
+    # Text chat has its own budget and isn't affected by the STT queue
+    assert admission.BUDGETS["chat"].in_flight == 0
+
+
+def test_audio_refused_while_stt_server_queue_is_long():
+    # With several workers the queue that counts is the STT server's
+    with patch("app.main.uses_stt_server", return_value=True), \
+         patch("app.main.server_waiting", return_value=admission.ADMIT_STT_QUEUE_MAX), \
+         patch("app.main.transcribe") as mock_stt:
+        r = client.post(
+            "/api/chat/audio?user_id=u1",
+            files={"file": ("a.wav", b"RIFF....WAVE", "audio/wav")},
+        )
+
+    assert r.status_code == 503
+    mock_stt.assert_not_called()
+
+
+def test_admission_state_in_metrics():
+    text = client.get("/metrics").text
+    assert 'ai_admission_limit{endpoint="chat_audio"}' in text
+    assert 'ai_admission_latency_seconds{endpoint="generate_diary"}' in text
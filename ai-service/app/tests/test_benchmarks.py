@@ -0,0 +1,16 @@
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "benchmarks")
+)
+
+import bench_async_db  # noqa: E402
+
+
+def test_async_db_benchmark_runs():
+    # Keeps the benchmark in step with main's Gemini and Mongo call signatures
+    args = SimpleNamespace(requests=4, concurrency=2, db_ms=1.0, llm_ms=1.0)
+    for mode in ("blocking", "async"):
+        assert bench_async_db.bench(mode, args) > 0
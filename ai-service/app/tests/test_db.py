@@ -1,33 +1,133 @@
-from unittest.mock import MagicMock, patch
+import asyncio
+from unittest.mock import AsyncMock, patch
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 from app import db
-from datetime import datetime, timezone
 
-def test_create_or_get_conversation_new():
-    fake_collection = MagicMock()
-    fake_collection.find_one.return_value = None
-    fake_collection.insert_one.return_value.inserted_id = "fakeid"
+def test_create_or_get_conversation_single_upsert():
+    fake_collection = AsyncMock()
+    fake_collection.find_one_and_update.return_value = {
+        "_id": "fakeid", "user_id": "user123", "status": "active"
+    }
 
     with patch.object(db, "conversations", fake_collection):
-        conv = db.create_or_get_conversation("user123")
+        conv = asyncio.run(db.create_or_get_conversation("user123"))
 
-    assert conv["user_id"] == "user123"
     assert conv["_id"] == "fakeid"
-    assert conv["status"] == "active"
+    fake_collection.find_one_and_update.assert_awaited_once()
+    fake_collection.find_one.assert_not_called()
+    fake_collection.insert_one.assert_not_called()
 
-def test_create_or_get_conversation_existing():
+    flt, update = fake_collection.find_one_and_update.call_args[0]
+    kwargs = fake_collection.find_one_and_update.call_args[1]
+    assert flt["user_id"] == "user123"
+    assert flt["status"] == "active"
+    assert "$setOnInsert" in update
+    assert kwargs["upsert"] is True
+
+def test_create_or_get_conversation_retries_lost_upsert_race():
     fake_conv = {"_id": "abc", "user_id": "u1"}
-    fake_collection = MagicMock()
-    fake_collection.find_one.return_value = fake_conv
+    fake_collection = AsyncMock()
+    fake_collection.find_one_and_update.side_effect = [
+        DuplicateKeyError("E11000"), fake_conv
+    ]
 
     with patch.object(db, "conversations", fake_collection):
-        conv = db.create_or_get_conversation("u1")
+        conv = asyncio.run(db.create_or_get_conversation("u1"))
 
     assert conv == fake_conv
+    assert fake_collection.find_one_and_update.await_count == 2
+
+def test_ensure_indexes_unique_partial():
+    fake_collection = AsyncMock()
+
+    with patch.object(db, "conversations", fake_collection):
+        asyncio.run(db.ensure_indexes())
+
+    kwargs = fake_collection.create_index.call_args[1]
+    assert kwargs["unique"] is True
+    assert kwargs["partialFilterExpression"] == {"status": "active"}
+
+def test_append_messages_single_push():
+    fake_collection = AsyncMock()
+
+    with patch.object(db, "conversations", fake_collection):
+        msgs = asyncio.run(
+            db.append_messages("abc123", [("user", "hello"), ("ai", "hi!")])
+        )
+
+    fake_collection.update_one.assert_awaited_once()
+    flt, update = fake_collection.update_one.call_args[0]
+    assert flt == {"_id": "abc123"}
+    assert [m["role"] for m in update["$push"]["messages"]["$each"]] == ["user", "ai"]
+    assert [m["text"] for m in msgs] == ["hello", "hi!"]
+
+def test_append_messages_skips_turn_already_stored():
+    fake_collection = AsyncMock()
+
+    with patch.object(db, "conversations", fake_collection):
+        asyncio.run(db.append_messages("abc123", [("user", "hi")], turn_id="r1"))
+
+    flt, update = fake_collection.update_one.call_args[0]
+    assert flt == {"_id": "abc123", "messages.turn_id": {"$ne": "r1"}}
+    assert update["$push"]["messages"]["$each"][0]["turn_id"] == "r1"
 
-def test_append_message():
-    fake_collection = MagicMock()
+def test_get_recent_messages_uses_slice():
+    fake_collection = AsyncMock()
+    fake_collection.find_one.return_value = {"messages": [{"role": "ai", "text": "x"}]}
 
     with patch.object(db, "conversations", fake_collection):
-        db.append_message("abc123", "user", "hello test")
+        msgs = asyncio.run(db.get_recent_messages("abc123", 5))
+
+    assert msgs == [{"role": "ai", "text": "x"}]
+    fake_collection.find_one.assert_awaited_once_with(
+        {"_id": "abc123"}, {"messages": {"$slice": -5}}
+    )
+
+def test_get_shared_conversation_filters_by_owner():
+    conv_id, owner = ObjectId(), ObjectId()
+    fake_collection = AsyncMock()
+    fake_collection.find_one.return_value = {"_id": conv_id, "user_id": owner}
+
+    with patch.object(db, "shared_conversations", fake_collection):
+        conv = asyncio.run(db.get_shared_conversation(str(conv_id), str(owner)))
+        invalid = asyncio.run(db.get_shared_conversation("not-an-id", str(owner)))
+
+    assert conv["_id"] == conv_id
+    assert invalid is None
+    flt = fake_collection.find_one.call_args[0][0]
+    assert flt == {"_id": conv_id, "user_id": owner}
+
+def test_append_messages_shared_store():
+    legacy, shared = AsyncMock(), AsyncMock()
+
+    with patch.object(db, "conversations", legacy), patch.object(
+        db, "shared_conversations", shared
+    ):
+        asyncio.run(db.append_messages("abc123", [("ai", "hi")], shared=True))
+
+    shared.update_one.assert_awaited_once()
+    legacy.update_one.assert_not_called()
+
+def test_record_detected_language_pins_in_one_update():
+    fake_collection = AsyncMock()
+
+    with patch.object(db, "stt_languages", fake_collection):
+        asyncio.run(db.record_detected_language("u1", "es", 0.95))
+
+    fake_collection.update_one.assert_awaited_once()
+    flt, pipeline = fake_collection.update_one.call_args[0]
+    assert flt == {"_id": "u1"}
+    # Update pipeline: append to recent, then recompute pinned from it
+    assert isinstance(pipeline, list) and len(pipeline) == 2
+    assert "recent" in pipeline[0]["$set"]
+    assert "pinned" in pipeline[1]["$set"]
+    assert fake_collection.update_one.call_args[1]["upsert"] is True
+
+def test_record_detected_language_ignores_low_confidence():
+    fake_collection = AsyncMock()
+
+    with patch.object(db, "stt_languages", fake_collection):
+        asyncio.run(db.record_detected_language("u1", "es", 0.3))
 
-    fake_collection.update_one.assert_called_once()
+    fake_collection.update_one.assert_not_called()
@@ -0,0 +1,97 @@
+"""
+Race tests against a real MongoDB (skipped when none is reachable; CI runs
+them against the mongo service in .github/workflows/ai-service-ci.yml).
+
+Run locally with:  docker run -d -p 27017:27017 mongo:6 && pipenv run pytest
+"""
+import asyncio
+import os
+import uuid
+
+import pytest
+from pymongo import AsyncMongoClient
+from pymongo.errors import PyMongoError
+
+from app import db
+
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+
+
+def run_live(test):
+    """
+    Run test(collection) in one event loop against a throwaway collection,
+    with db.conversations pointed at it.
+    """
+
+    async def runner():
+        client = AsyncMongoClient(MONGO_URI, serverSelectionTimeoutMS=500)
+        try:
+            await client.admin.command("ping")
+        except PyMongoError:
+            await client.close()
+            pytest.skip("MongoDB not reachable")
+
+        coll = client["ai_diary_test"][f"conversations_{uuid.uuid4().hex}"]
+        original = db.conversations
+        db.conversations = coll
+        try:
+            await db.ensure_indexes()
+            await test(coll)
+        finally:
+            db.conversations = original
+            await coll.drop()
+            await client.close()
+
+    asyncio.run(runner())
+
+
+def test_parallel_requests_create_one_active_conversation():
+    async def test(coll):
+        convs = await asyncio.gather(
+            *(db.create_or_get_conversation("racer") for _ in range(64))
+        )
+
+        assert len({c["_id"] for c in convs}) == 1
+        assert await coll.count_documents({"user_id": "racer"}) == 1
+
+    run_live(test)
+
+
+def test_parallel_appends_are_not_lost():
+    async def test(coll):
+        conv = await db.create_or_get_conversation("writer")
+
+        await asyncio.gather(
+            *(
+                db.append_messages(conv["_id"], [("user", f"u{i}"), ("ai", f"a{i}")])
+                for i in range(50)
+            )
+        )
+
+        stored = (await coll.find_one({"_id": conv["_id"]}))["messages"]
+        assert len(stored) == 100
+        # Each turn's pair stays adjacent
+        for user_msg, ai_msg in zip(stored[::2], stored[1::2]):
+            assert user_msg["text"][1:] == ai_msg["text"][1:]
+
+    run_live(test)
+
+
+def test_detected_languages_pin_and_unpin():
+    async def test(coll):
+        original = db.stt_languages
+        db.stt_languages = coll
+        try:
+            for _ in range(db.STT_LANGUAGE_PIN_AFTER):
+                assert (await db.get_stt_language("polyglot")).get("pinned") is None
+                await db.record_detected_language("polyglot", "es", 0.95)
+            assert (await db.get_stt_language("polyglot"))["pinned"] == "es"
+
+            await db.record_detected_language("polyglot", "en", 0.95)
+            doc = await db.get_stt_language("polyglot")
+            assert doc["pinned"] is None
+            assert len(doc["recent"]) == db.STT_LANGUAGE_PIN_AFTER
+        finally:
+            db.stt_languages = original
+
+    run_live(test)
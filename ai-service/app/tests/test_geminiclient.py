@@ -1,12 +1,14 @@
+import asyncio
 from unittest.mock import patch, MagicMock
 from app import gemini_client
+from app.tests import sample
 
 def test_generate_cheerful_reply():
     mock_model = MagicMock()
     mock_model.generate_content.return_value.text = "mock reply"
 
     with patch("app.gemini_client.genai.GenerativeModel", return_value=mock_model):
-        reply = gemini_client.generate_cheerful_reply("hi")
+        reply = asyncio.run(gemini_client.generate_cheerful_reply("hi"))
 
     assert reply == "mock reply"
 
@@ -17,17 +19,158 @@ def test_generate_diary_json_ok():
     )
 
     with patch("app.gemini_client.genai.GenerativeModel", return_value=mock_model):
-        result = gemini_client.generate_diary([{"role": "user", "text": "hello"}])
+        result = asyncio.run(gemini_client.generate_diary([{"role": "user", "text": "hello"}]))
 
     assert result["title"] == "T"
     assert result["mood_score"] == 2
 
 def test_generate_diary_fallback():
+
     mock_model = MagicMock()
     mock_model.generate_content.return_value.text = "INVALID JSON"
+    before = sample("ai_fallbacks_total", reason="diary_json_parse")
 
     with patch("app.gemini_client.genai.GenerativeModel", return_value=mock_model):
-        res = gemini_client.generate_diary([{"role": "user", "text": "hi"}])
+        res = asyncio.run(gemini_client.generate_diary([{"role": "user", "text": "hi"}]))
 
     assert res["title"] == "Today's Diary"
     assert res["mood"] == "neutral"
+    assert sample("ai_fallbacks_total", reason="diary_json_parse") == before + 1
+
+def test_retries_server_errors_then_succeeds(monkeypatch):
+    from google.api_core import exceptions
+    from app import gemini_policy
+
+    monkeypatch.setattr(gemini_policy, "backoff", lambda retry: 0)
+    mock_model = MagicMock()
+    ok = MagicMock(text="mock reply")
+    mock_model.generate_content.side_effect = [
+        exceptions.ServiceUnavailable("busy"),
+        exceptions.ResourceExhausted("quota"),
+        ok,
+    ]
+    retried = sample("ai_gemini_attempts_total", call="cheerful_reply", kind="retry", outcome="ok")
+
+    with patch("app.gemini_client.genai.GenerativeModel", return_value=mock_model):
+        reply = asyncio.run(gemini_client.generate_cheerful_reply("hi"))
+
+    assert reply == "mock reply"
+    assert mock_model.generate_content.call_count == 3
+    assert sample("ai_gemini_attempts_total", call="cheerful_reply", kind="retry", outcome="ok") == retried + 1
+
+def test_does_not_retry_client_errors(monkeypatch):
+    import pytest
+    from google.api_core import exceptions
+    from app import gemini_policy
+
+    monkeypatch.setattr(gemini_policy, "backoff", lambda retry: 0)
+    mock_model = MagicMock()
+    mock_model.generate_content.side_effect = exceptions.InvalidArgument("bad")
+
+    with patch("app.gemini_client.genai.GenerativeModel", return_value=mock_model):
+        with pytest.raises(exceptions.InvalidArgument):
+            asyncio.run(gemini_client.generate_diary([{"role": "user", "text": "hi"}]))
+
+    assert mock_model.generate_content.call_count == 1
+
+def test_gives_up_after_max_attempts(monkeypatch):
+    import pytest
+    from google.api_core import exceptions
+    from app import gemini_policy
+
+    monkeypatch.setattr(gemini_policy, "backoff", lambda retry: 0)
+    fn = MagicMock(side_effect=exceptions.TooManyRequests("slow down"))
+
+    with pytest.raises(exceptions.TooManyRequests):
+        asyncio.run(gemini_policy.call_with_policy("test_give_up", fn))
+
+    assert fn.call_count == gemini_policy.GEMINI_MAX_ATTEMPTS
+    assert sample("ai_gemini_attempts_total", call="test_give_up", kind="retry", outcome="rate_limited") == (
+        gemini_policy.GEMINI_MAX_ATTEMPTS - 1
+    )
+
+def test_backoff_is_jittered_and_capped(monkeypatch):
+    from app import gemini_policy
+
+    monkeypatch.setattr(gemini_policy, "GEMINI_BACKOFF_BASE_SECONDS", 0.5)
+    monkeypatch.setattr(gemini_policy, "GEMINI_BACKOFF_MAX_SECONDS", 4.0)
+    for retry in range(6):
+        assert 0 <= gemini_policy.backoff(retry) <= min(4.0, 0.5 * 2 ** retry)
+
+def test_hedged_request_first_success_wins(monkeypatch):
+    import threading
+    from app import gemini_policy
+
+    monkeypatch.setattr(gemini_policy, "GEMINI_HEDGE", True)
+    latencies = gemini_policy._Latencies()
+    for _ in range(gemini_policy.GEMINI_HEDGE_MIN_SAMPLES):
+        latencies.add(0.01)
+    monkeypatch.setitem(gemini_policy._latencies, "test_hedge", latencies)
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) == 1:
+            release.wait(5)  # the primary hangs
+            return "slow"
+        return "fast"
+
+    wins = sample("ai_gemini_hedge_wins_total", call="test_hedge")
+    losers = sample("ai_gemini_hedge_losers_total", call="test_hedge")
+    try:
+        assert asyncio.run(gemini_policy.call_with_policy("test_hedge", fn)) == "fast"
+    finally:
+        release.set()
+
+    assert len(calls) == 2
+    assert sample("ai_gemini_hedge_wins_total", call="test_hedge") == wins + 1
+    # The hung primary can't be stopped, only counted
+    assert sample("ai_gemini_hedge_losers_total", call="test_hedge") == losers + 1
+
+def _hedging_on(monkeypatch, call):
+    from app import gemini_policy
+
+    monkeypatch.setattr(gemini_policy, "GEMINI_HEDGE", True)
+    monkeypatch.setattr(gemini_policy, "backoff", lambda retry: 0)
+    latencies = gemini_policy._Latencies()
+    for _ in range(gemini_policy.GEMINI_HEDGE_MIN_SAMPLES):
+        latencies.add(0.05)
+    monkeypatch.setitem(gemini_policy._latencies, call, latencies)
+
+def test_no_hedge_after_rate_limit(monkeypatch):
+    import time
+    from google.api_core import exceptions
+    from app import gemini_policy
+
+    _hedging_on(monkeypatch, "test_429")
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) == 1:
+            raise exceptions.TooManyRequests("slow down")
+        time.sleep(0.3)  # the retry runs well past the p95
+        return "ok"
+
+    skipped = sample("ai_gemini_hedges_skipped_total", call="test_429", reason="rate_limited")
+
+    assert asyncio.run(gemini_policy.call_with_policy("test_429", fn)) == "ok"
+
+    assert len(calls) == 2
+    assert sample("ai_gemini_attempts_total", call="test_429", kind="hedge", outcome="ok") == 0
+    assert sample("ai_gemini_hedges_skipped_total", call="test_429", reason="rate_limited") == skipped + 1
+
+def test_hedges_capped_per_worker(monkeypatch):
+    import time
+    from app import gemini_policy
+
+    _hedging_on(monkeypatch, "test_cap")
+    monkeypatch.setattr(gemini_policy, "GEMINI_HEDGE_MAX", 0)
+    fn = MagicMock(side_effect=lambda: time.sleep(0.3) or "ok")
+    skipped = sample("ai_gemini_hedges_skipped_total", call="test_cap", reason="limit")
+
+    assert asyncio.run(gemini_policy.call_with_policy("test_cap", fn)) == "ok"
+
+    assert fn.call_count == 1
+    assert sample("ai_gemini_hedges_skipped_total", call="test_cap", reason="limit") == skipped + 1
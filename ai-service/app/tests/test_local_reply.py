@@ -0,0 +1,132 @@
+import asyncio
+from unittest.mock import AsyncMock, patch
+
+from fastapi.testclient import TestClient
+
+from app import local_reply
+from app.main import app
+from app.tests import sample
+
+client = TestClient(app)
+
+
+def test_local_reply_matches_mood():
+    assert local_reply.local_reply("positive") in local_reply.TEMPLATES["positive"]
+    assert local_reply.local_reply("negative") in local_reply.TEMPLATES["negative"]
+    # No mood from the caller (or an unknown one): neutral
+    assert local_reply.local_reply(None) in local_reply.TEMPLATES["neutral"]
+    assert local_reply.local_reply("elated") in local_reply.TEMPLATES["neutral"]
+
+
+async def _gemini(seconds, text="GEMINI"):
+    await asyncio.sleep(seconds)
+    return text
+
+
+def test_gemini_reply_within_slo(monkeypatch):
+    monkeypatch.setattr(local_reply, "GEMINI_REPLY_SLO_SECONDS", 1.0)
+    before = sample("ai_reply_hedges_total", outcome="gemini")
+
+    reply, late = asyncio.run(local_reply.reply_within_slo(_gemini(0)))
+
+    assert (reply, late) == ("GEMINI", None)
+    assert sample("ai_reply_hedges_total", outcome="gemini") == before + 1
+
+
+def test_slow_gemini_is_hedged_and_late_reply_dropped(monkeypatch):
+    monkeypatch.setattr(local_reply, "GEMINI_REPLY_SLO_SECONDS", 0.01)
+    hedged = sample("ai_reply_hedges_total", outcome="local")
+    dropped = sample("ai_late_replies_total", outcome="dropped")
+    save = AsyncMock()
+
+    async def main():
+        reply, late = await local_reply.reply_within_slo(_gemini(0.1), "positive")
+        assert reply in local_reply.TEMPLATES["positive"]
+        local_reply.settle_late_reply(late, save)
+        await late
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+
+    assert sample("ai_reply_hedges_total", outcome="local") == hedged + 1
+    assert sample("ai_late_replies_total", outcome="dropped") == dropped + 1
+    save.assert_not_called()
+
+
+def test_late_reply_saved(monkeypatch):
+    monkeypatch.setattr(local_reply, "GEMINI_REPLY_SLO_SECONDS", 0.01)
+    monkeypatch.setattr(local_reply, "GEMINI_LATE_REPLY", "save")
+    saved = sample("ai_late_replies_total", outcome="saved")
+    save = AsyncMock()
+
+    async def main():
+        _, late = await local_reply.reply_within_slo(_gemini(0.1, "LATE"))
+        local_reply.settle_late_reply(late, save)
+        await late
+        for _ in range(3):
+            await asyncio.sleep(0)
+
+    asyncio.run(main())
+
+    save.assert_awaited_once_with("LATE")
+    assert sample("ai_late_replies_total", outcome="saved") == saved + 1
+
+
+def test_late_gemini_call_counts_in_llm_budget_until_it_returns(monkeypatch):
+    from app import admission
+    from app.main import _gemini as counted
+
+    monkeypatch.setattr(local_reply, "GEMINI_REPLY_SLO_SECONDS", 0.01)
+    before = admission.LLM.in_flight
+
+    async def main():
+        reply, late = await local_reply.reply_within_slo(
+            counted(_gemini(0.2)), "neutral"
+        )
+        assert reply in local_reply.TEMPLATES["neutral"]
+        # Answered locally, but the call is still running
+        assert admission.LLM.in_flight == before + 1
+        await late
+
+    asyncio.run(main())
+
+    assert admission.LLM.in_flight == before
+
+
+def test_slo_is_capped_by_caller_deadline(monkeypatch):
+    from app.instrumentation import begin_request
+
+    monkeypatch.setattr(local_reply, "GEMINI_REPLY_SLO_SECONDS", 6.0)
+    begin_request(None, "2000")
+    assert 1.0 < local_reply.reply_slo() <= 1.5
+    begin_request(None, "100")
+    assert local_reply.reply_slo() == 0.0
+    begin_request(None)
+    assert local_reply.reply_slo() == 6.0
+
+
+@patch("app.main.append_messages", new_callable=AsyncMock)
+@patch("app.main.create_or_get_conversation", new_callable=AsyncMock)
+@patch("app.main.generate_cheerful_reply")
+def test_chat_answers_locally_when_gemini_is_slow(
+    mock_reply, mock_get_conv, mock_append, monkeypatch
+):
+    monkeypatch.setattr(local_reply, "GEMINI_REPLY_SLO_SECONDS", 0.05)
+    mock_get_conv.return_value = {"_id": "conv123"}
+
+    async def slow_reply(text):
+        return await _gemini(0.3, "TOO LATE")
+
+    mock_reply.side_effect = slow_reply
+    mock_append.side_effect = lambda conv_id, messages, shared=False, turn_id=None: [
+        {"role": role, "text": text} for role, text in messages
+    ]
+
+    r = client.post(
+        "/api/chat", json={"user_id": "u1", "text": "I'm so tired", "mood": "negative"}
+    )
+
+    assert r.status_code == 200
+    assert r.json()["reply"] in local_reply.TEMPLATES["negative"]
+    stored = mock_append.call_args_list[0].args[1]
+    assert stored == [("user", "I'm so tired"), ("ai", r.json()["reply"])]
@@ -1,12 +1,43 @@
 import io
+import os
+import subprocess
+import sys
+import wave
 import pytest
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
+from unittest.mock import AsyncMock, patch, MagicMock
 
 from app.main import app
+from app.services.stt_service import Transcription
+from app.tests import sample
 
 client = TestClient(app)
 
+
+def _wav(seconds=0.5, rate=16000):
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(b"\0\0" * int(seconds * rate))
+    return buf.getvalue()
+
+
+WAV = _wav()
+
+
+def _stt(text, language="en", probability=0.99):
+    return Transcription(text, language, probability)
+
+
+@pytest.fixture(autouse=True)
+def stt_languages():
+    """Per-user language store; no user has a pinned language by default."""
+    with patch("app.main.get_stt_language", AsyncMock(return_value={})) as get, \
+         patch("app.main.record_detected_language", AsyncMock()) as record:
+        yield get, record
+
 # -------------------------------------------------------------------
 # 1. /health
 # -------------------------------------------------------------------
@@ -17,26 +48,51 @@ def test_health():
     assert r.json() == {"status": "ok"}
 
 
+def test_metrics_serves_prometheus_text():
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain")
+    assert "# TYPE ai_stage_duration_seconds histogram" in r.text
+    assert 'ai_admission_limit{endpoint="chat"}' in r.text
+
+
+def test_metrics_sums_worker_processes(tmp_path, monkeypatch):
+    # Two "workers" each refuse a chat; any worker's /metrics sees both
+    worker = (
+        "from prometheus_client import Counter; "
+        "Counter('ai_admission_rejected', '', ['endpoint', 'reason'])"
+        ".labels('chat', 'in_flight').inc()"
+    )
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}
+    for _ in range(2):
+        subprocess.run([sys.executable, "-c", worker], env=env, check=True)
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+
+    text = client.get("/metrics").text
+
+    assert 'ai_admission_rejected_total{endpoint="chat",reason="in_flight"} 2.0' in text
+
+
 # -------------------------------------------------------------------
 # 2. /api/chat (text) — mock Mongo + Gemini
 # -------------------------------------------------------------------
 
-@patch("app.main.append_message")
+def _stored(role, text):
+    return {"role": role, "text": text}
+
+
+def _append(conv_id, messages, shared, turn_id=None):
+    return [_stored(role, text) for role, text in messages]
+
+
+@patch("app.main.append_messages", side_effect=_append)
 @patch("app.main.create_or_get_conversation")
 @patch("app.main.generate_cheerful_reply")
 def test_chat_text(mock_reply, mock_get_conv, mock_append):
     mock_get_conv.return_value = {"_id": "conv123"}
     mock_reply.return_value = "MOCK_AI_REPLY"
 
-    with patch("app.main.conversations.find_one") as mock_find:
-        mock_find.return_value = {
-            "_id": "conv123",
-            "messages": [
-                {"role": "user", "text": "Hello"},
-                {"role": "ai", "text": "MOCK_AI_REPLY"}
-            ]
-        }
-
+    with patch("app.main.get_recent_messages") as mock_recent:
         payload = {"user_id": "u1", "text": "Hello"}
         r = client.post("/api/chat", json=payload)
 
@@ -44,53 +100,247 @@ def test_chat_text(mock_reply, mock_get_conv, mock_append):
     data = r.json()
 
     assert data["reply"] == "MOCK_AI_REPLY"
-    assert len(data["history"]) == 2
+    assert data["transcript"] == "Hello"
+    assert data["messages"] == [_stored("user", "Hello"), _stored("ai", "MOCK_AI_REPLY")]
+    # No history re-read unless asked for
+    assert data["history"] is None
+    mock_recent.assert_not_called()
+
+
+@patch("app.main.append_messages", side_effect=_append)
+@patch("app.main.create_or_get_conversation")
+@patch("app.main.generate_cheerful_reply")
+def test_chat_text_with_history_window(mock_reply, mock_get_conv, mock_append):
+    mock_get_conv.return_value = {"_id": "conv123"}
+    mock_reply.return_value = "MOCK_AI_REPLY"
+
+    with patch("app.main.get_recent_messages") as mock_recent:
+        mock_recent.return_value = [_stored("ai", "earlier"), _stored("ai", "MOCK_AI_REPLY")]
+        r = client.post(
+            "/api/chat", json={"user_id": "u1", "text": "Hello", "history_limit": 2}
+        )
+
+    assert r.status_code == 200
+    assert len(r.json()["history"]) == 2
+    mock_recent.assert_called_once_with("conv123", 2, shared=False)
 
 
 # -------------------------------------------------------------------
 # 3. /api/chat/audio — mock Whisper + Mongo + Gemini
 # -------------------------------------------------------------------
 
-@patch("app.main.append_message")
+@patch("app.main.append_messages", side_effect=_append)
 @patch("app.main.create_or_get_conversation")
 @patch("app.main.generate_cheerful_reply")
-@patch("app.main.transcribe_audio")
+@patch("app.main.transcribe")
 def test_chat_audio(mock_stt, mock_reply, mock_get_conv, mock_append):
 
-    mock_stt.return_value = "USER SAID SOMETHING"
+    mock_stt.return_value = _stt("USER SAID SOMETHING")
     mock_reply.return_value = "MOCK_AUDIO_REPLY"
     mock_get_conv.return_value = {"_id": "c001"}
 
-    with patch("app.main.conversations.find_one") as mock_find:
-        mock_find.return_value = {
-            "_id": "c001",
-            "messages": [
-                {"role": "user", "text": "USER SAID SOMETHING"},
-                {"role": "ai", "text": "MOCK_AUDIO_REPLY"},
-            ],
-        }
-
-        fake_audio = io.BytesIO(b"fake audio")
-        r = client.post(
-            "/api/chat/audio?user_id=u1",
-            files={"file": ("test.wav", fake_audio, "audio/wav")},
-        )
+    fake_audio = io.BytesIO(WAV)
+    r = client.post(
+        "/api/chat/audio?user_id=u1",
+        files={"file": ("test.wav", fake_audio, "audio/wav")},
+    )
 
     assert r.status_code == 200
     data = r.json()
     assert data["reply"] == "MOCK_AUDIO_REPLY"
-    assert len(data["history"]) == 2
+    assert data["transcript"] == "USER SAID SOMETHING"
+    assert len(data["messages"]) == 2
+    assert data["history"] is None
+
+
+@patch("app.main.append_messages", side_effect=_append)
+@patch("app.main.create_or_get_conversation")
+@patch("app.main.generate_cheerful_reply")
+@patch("app.main.transcribe")
+def test_chat_audio_records_stage_metrics(mock_stt, mock_reply, mock_get_conv, mock_append):
+
+    mock_stt.return_value = _stt("")
+    mock_reply.return_value = "MOCK_AUDIO_REPLY"
+    mock_get_conv.return_value = {"_id": "c001"}
+    stages = ["total", "upload", "probe", "stt", "mongo_conversation",
+              "gemini_reply", "mongo_append"]
+    before = {s: sample("ai_stage_duration_seconds_count", endpoint="chat_audio", stage=s) for s in stages}
+    empty = sample("ai_fallbacks_total", reason="empty_transcription")
+
+    r = client.post(
+        "/api/chat/audio?user_id=u1",
+        files={"file": ("test.wav", io.BytesIO(WAV), "audio/wav")},
+    )
+
+    assert r.status_code == 200
+    for s in stages:
+        assert sample("ai_stage_duration_seconds_count", endpoint="chat_audio", stage=s) == before[s] + 1
+    assert sample("ai_fallbacks_total", reason="empty_transcription") == empty + 1
+    assert sample("ai_requests_in_flight", endpoint="chat_audio") == 0
+
+    text = client.get("/metrics").text
+    assert 'ai_stage_duration_seconds_count{endpoint="chat_audio",stage="stt"}' in text
+
+
+@patch("app.main.append_messages", side_effect=_append)
+@patch("app.main.create_or_get_conversation")
+@patch("app.main.generate_cheerful_reply")
+def test_chat_echoes_request_id_and_server_timing(mock_reply, mock_get_conv, mock_append, capsys):
+    mock_get_conv.return_value = {"_id": "conv123"}
+    mock_reply.return_value = "MOCK_AI_REPLY"
+
+    r = client.post(
+        "/api/chat",
+        json={"user_id": "u1", "text": "Hello"},
+        headers={"X-Request-ID": "web-123"},
+    )
+
+    assert r.status_code == 200
+    assert r.headers["X-Request-ID"] == "web-123"
+    timing = r.headers["Server-Timing"]
+    for name in ("mongo_conversation", "gemini_reply", "mongo_append", "total"):
+        assert f"{name};dur=" in timing
+    assert "[web-123] POST /api/chat 200" in capsys.readouterr().out
+
+
+def test_profile_downloads_need_token(tmp_path, monkeypatch):
+    from app import profiling
+
+    monkeypatch.setattr(profiling, "TOKEN", "s3cret")
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    (tmp_path / "abc.folded").write_text("main;run 3\n")
+
+    assert client.get("/debug/profiles").status_code == 404
+    assert client.get("/debug/profiles/abc.folded").status_code == 404
+
+    headers = {"X-Profile": "s3cret"}
+    assert client.get("/debug/profiles", headers=headers).json() == {
+        "profiles": ["abc.folded"]
+    }
+    r = client.get("/debug/profiles/abc.folded", headers=headers)
+    assert r.status_code == 200
+    assert r.text == "main;run 3\n"
+
+
+def test_invalid_request_id_is_replaced():
+    r = client.get("/health", headers={"X-Request-ID": "bad id\twith spaces"})
+    rid = r.headers["X-Request-ID"]
+    assert rid != "bad id\twith spaces"
+    assert len(rid) == 32
+
+
+@patch("app.main.append_messages")
+@patch("app.main.create_or_get_conversation")
+@patch("app.main.generate_cheerful_reply")
+def test_chat_stops_once_deadline_passed(mock_reply, mock_get_conv, mock_append):
+
+    mock_get_conv.return_value = {"_id": "conv123"}
+    before = sample("ai_deadline_exceeded_total", endpoint="chat", stage="gemini_reply")
+
+    r = client.post(
+        "/api/chat",
+        json={"user_id": "u1", "text": "Hello"},
+        headers={"X-Deadline-Ms": "0"},
+    )
+
+    assert r.status_code == 504
+    assert "gemini_reply" in r.json()["detail"]
+    mock_reply.assert_not_called()
+    mock_append.assert_not_called()
+    assert sample("ai_deadline_exceeded_total", endpoint="chat", stage="gemini_reply") == before + 1
+
+
+@patch("app.main.transcribe", side_effect=TimeoutError("no answer"))
+def test_stt_server_timeout_is_504_with_deadline_else_503(mock_stt):
+    with_deadline = client.post(
+        "/api/transcribe",
+        files={"file": ("x.wav", io.BytesIO(WAV), "audio/wav")},
+        headers={"X-Deadline-Ms": "30000"},
+    )
+    without = client.post(
+        "/api/transcribe",
+        files={"file": ("x.wav", io.BytesIO(WAV), "audio/wav")},
+    )
+
+    assert with_deadline.status_code == 504
+    assert without.status_code == 503
+    # The caller's remaining time is what bounds the wait for the STT server
+    assert 0 < mock_stt.call_args_list[0].args[4] <= 30
+    assert mock_stt.call_args_list[1].args[4] is None
+
+
+@patch("app.main.transcribe")
+def test_chat_audio_skips_stt_once_deadline_passed(mock_stt):
+    r = client.post(
+        "/api/chat/audio?user_id=u1",
+        files={"file": ("x.wav", io.BytesIO(WAV), "audio/wav")},
+        headers={"X-Deadline-Ms": "0"},
+    )
+
+    assert r.status_code == 504
+    mock_stt.assert_not_called()
+
+
+# -------------------------------------------------------------------
+# 3b. Shared conversation store (web-app conversation id)
+# -------------------------------------------------------------------
+
+@patch("app.main.append_messages", side_effect=_append)
+@patch("app.main.create_or_get_conversation")
+@patch("app.main.get_shared_conversation")
+@patch("app.main.generate_cheerful_reply")
+def test_chat_writes_to_shared_conversation(
+    mock_reply, mock_shared, mock_legacy, mock_append
+):
+    mock_shared.return_value = {"_id": "webconv1", "user_id": "u1"}
+    mock_reply.return_value = "MOCK_AI_REPLY"
+
+    r = client.post(
+        "/api/chat",
+        json={
+            "user_id": "u1",
+            "text": "Hello",
+            "conversation_id": "webconv1",
+            "turn_id": "turn-1",
+        },
+        headers={"X-Request-ID": "request-1"},
+    )
+
+    assert r.status_code == 200
+    data = r.json()
+    assert data["persisted"] is True
+    assert data["conversation_id"] == "webconv1"
+    mock_shared.assert_called_once_with("webconv1", "u1")
+    mock_legacy.assert_not_called()
+    # The turn is written exactly once, to the shared store
+    mock_append.assert_called_once()
+    assert mock_append.call_args.kwargs["shared"] is True
+    # Keyed on web-app's turn ID (not the request ID), so its fallback write
+    # can't duplicate it
+    assert mock_append.call_args.kwargs["turn_id"] == "turn-1"
+
+
+@patch("app.main.transcribe")
+@patch("app.main.get_shared_conversation", return_value=None)
+def test_chat_audio_unknown_conversation(mock_shared, mock_stt):
+    r = client.post(
+        "/api/chat/audio?user_id=u1&conversation_id=nope",
+        files={"file": ("x.wav", io.BytesIO(WAV), "audio/wav")},
+    )
+
+    assert r.status_code == 404
+    mock_stt.assert_not_called()
 
 
 # -------------------------------------------------------------------
 # 4. /api/chat/audio — STT error branch
 # -------------------------------------------------------------------
 
-@patch("app.main.transcribe_audio")
+@patch("app.main.transcribe")
 def test_chat_audio_stt_error(mock_stt):
     mock_stt.side_effect = Exception("STT FAILED")
 
-    fake_audio = io.BytesIO(b"fake")
+    fake_audio = io.BytesIO(WAV)
     r = client.post(
         "/api/chat/audio?user_id=u1",
         files={"file": ("x.wav", fake_audio, "audio/wav")},
@@ -100,15 +350,169 @@ def test_chat_audio_stt_error(mock_stt):
     assert "Transcription failed" in r.json()["detail"]
 
 
+@patch("app.main.transcribe")
+def test_chat_audio_rejects_non_audio(mock_stt):
+    r = client.post(
+        "/api/chat/audio?user_id=u1",
+        files={"file": ("x.wav", io.BytesIO(b"<html>not audio</html>"), "audio/wav")},
+    )
+
+    assert r.status_code == 415
+    mock_stt.assert_not_called()
+
+
+@patch("app.main.transcribe")
+@patch("app.audio_upload.AUDIO_MAX_BYTES", 1024)
+def test_chat_audio_rejects_oversized_upload(mock_stt):
+    r = client.post(
+        "/api/chat/audio?user_id=u1",
+        files={"file": ("x.wav", io.BytesIO(WAV), "audio/wav")},
+    )
+
+    assert r.status_code == 413
+    mock_stt.assert_not_called()
+
+
+@patch("app.main.transcribe")
+def test_chat_audio_rejects_long_recording(mock_stt):
+    r = client.post(
+        "/api/chat/audio?user_id=u1&max_seconds=1",
+        files={"file": ("x.wav", io.BytesIO(_wav(seconds=2)), "audio/wav")},
+    )
+
+    assert r.status_code == 413
+    assert "longer than 1 s" in r.json()["detail"]
+    mock_stt.assert_not_called()
+
+
+@patch("app.main.append_messages", side_effect=_append)
+@patch("app.main.create_or_get_conversation", return_value={"_id": "c001"})
+@patch("app.main.generate_cheerful_reply", return_value="OK")
+@patch("app.main.transcribe")
+def test_chat_audio_records_detected_language(
+    mock_stt, mock_reply, mock_get_conv, mock_append, stt_languages
+):
+    get, record = stt_languages
+    mock_stt.return_value = _stt("hola", "es", 0.93)
+
+    r = client.post(
+        "/api/chat/audio?user_id=u1",
+        files={"file": ("test.wav", io.BytesIO(WAV), "audio/wav")},
+    )
+
+    assert r.status_code == 200
+    get.assert_awaited_once_with("u1")
+    assert mock_stt.call_args.args[2] is None  # detection ran
+    record.assert_awaited_once_with("u1", "es", 0.93)
+
+
+@patch("app.main.append_messages", side_effect=_append)
+@patch("app.main.create_or_get_conversation", return_value={"_id": "c001"})
+@patch("app.main.generate_cheerful_reply", return_value="OK")
+@patch("app.main.transcribe")
+@patch("app.main.STT_LANGUAGE_RECHECK_RATE", 0)
+def test_chat_audio_uses_pinned_language(
+    mock_stt, mock_reply, mock_get_conv, mock_append, stt_languages
+):
+    get, record = stt_languages
+    get.return_value = {"pinned": "de"}
+    mock_stt.return_value = _stt("hallo", "de", 1.0)
+
+    r = client.post(
+        "/api/chat/audio?user_id=u1",
+        files={"file": ("test.wav", io.BytesIO(WAV), "audio/wav")},
+    )
+
+    assert r.status_code == 200
+    assert mock_stt.call_args.args[2] == "de"
+    record.assert_not_awaited()
+
+
+@patch("app.main.transcribe")
+def test_transcribe_language_param_overrides_user_language(mock_stt, stt_languages):
+    get, record = stt_languages
+    get.return_value = {"override": "de"}
+    mock_stt.return_value = _stt("bonjour", "fr", 1.0)
+
+    r = client.post(
+        "/api/transcribe?user_id=u1&language=fr",
+        files={"file": ("a.wav", io.BytesIO(WAV), "audio/wav")},
+    )
+
+    assert r.status_code == 200
+    assert mock_stt.call_args.args[2] == "fr"
+    get.assert_not_awaited()
+    record.assert_not_awaited()
+
+
+@patch("app.main.transcribe")
+def test_audio_endpoints_default_tiers(mock_stt):
+    mock_stt.return_value = _stt("text")
+
+    client.post(
+        "/api/transcribe", files={"file": ("a.wav", io.BytesIO(WAV), "audio/wav")}
+    )
+    assert mock_stt.call_args.args[3] == "fast"
+
+    client.post(
+        "/api/transcribe?tier=accurate",
+        files={"file": ("a.wav", io.BytesIO(WAV), "audio/wav")},
+    )
+    assert mock_stt.call_args.args[3] == "accurate"
+
+    with patch("app.main.create_or_get_conversation", return_value={"_id": "c1"}), \
+         patch("app.main.append_messages", side_effect=_append), \
+         patch("app.main.generate_cheerful_reply", return_value="OK"):
+        client.post(
+            "/api/chat/audio?user_id=u1",
+            files={"file": ("a.wav", io.BytesIO(WAV), "audio/wav")},
+        )
+    assert mock_stt.call_args.args[3] == "accurate"
+
+
+def test_transcribe_rejects_unknown_tier():
+    r = client.post(
+        "/api/transcribe?tier=turbo",
+        files={"file": ("a.wav", io.BytesIO(WAV), "audio/wav")},
+    )
+    assert r.status_code == 422
+
+
+@patch("app.main.transcribe")
+def test_transcribe_rejects_unknown_language(mock_stt):
+    r = client.post(
+        "/api/transcribe?language=xx",
+        files={"file": ("a.wav", io.BytesIO(WAV), "audio/wav")},
+    )
+
+    assert r.status_code == 400
+    mock_stt.assert_not_called()
+
+
+@patch("app.main.set_stt_language_override", new_callable=AsyncMock)
+def test_set_user_language_override(mock_set, stt_languages):
+    get, _ = stt_languages
+    get.return_value = {"override": "ja", "pinned": "en", "recent": []}
+
+    r = client.post("/api/users/u1/stt-language", json={"language": "ja"})
+
+    assert r.status_code == 200
+    assert r.json() == {"override": "ja", "pinned": "en", "recent": []}
+    mock_set.assert_awaited_once_with("u1", "ja")
+
+    r = client.post("/api/users/u1/stt-language", json={"language": "klingon"})
+    assert r.status_code == 400
+
+
 # -------------------------------------------------------------------
 # 5. /api/transcribe — success
 # -------------------------------------------------------------------
 
-@patch("app.main.transcribe_audio")
+@patch("app.main.transcribe")
 def test_transcribe_ok(mock_stt):
-    mock_stt.return_value = "HELLO WORLD"
+    mock_stt.return_value = _stt("HELLO WORLD")
 
-    fake_audio = io.BytesIO(b"123")
+    fake_audio = io.BytesIO(WAV)
     r = client.post(
         "/api/transcribe",
         files={"file": ("a.wav", fake_audio, "audio/wav")},
@@ -122,11 +526,11 @@ def test_transcribe_ok(mock_stt):
 # 6. /api/transcribe — STT exception
 # -------------------------------------------------------------------
 
-@patch("app.main.transcribe_audio")
+@patch("app.main.transcribe")
 def test_transcribe_error(mock_stt):
     mock_stt.side_effect = Exception("BAD AUDIO")
 
-    fake_audio = io.BytesIO(b"123")
+    fake_audio = io.BytesIO(WAV)
     r = client.post(
         "/api/transcribe",
         files={"file": ("a.wav", fake_audio, "audio/wav")},
@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+from app import db, mongo_monitoring
+from app.tests import sample
+
+
+def _event(**kw):
+    base = {"connection_id": ("mongo", 27017), "request_id": 1,
+            "database_name": "ai_diary"}
+    base.update(kw)
+    return SimpleNamespace(**base)
+
+
+def test_command_timer_labels_by_collection(capsys):
+    timer = mongo_monitoring.CommandTimer(slow_ms=50)
+    labels = dict(database="ai_diary", collection="conversations",
+                  command="find")
+    before = sample("ai_mongo_command_duration_seconds_count", **labels)
+
+    timer.started(_event(command={"find": "conversations"},
+                         command_name="find"))
+    timer.succeeded(_event(command_name="find", duration_micros=80_000))
+
+    assert sample("ai_mongo_command_duration_seconds_count", **labels) == before + 1
+    assert "Slow MongoDB command: find ai_diary.conversations took 80.0 ms" in \
+        capsys.readouterr().out
+
+
+def test_command_timer_getmore_uses_collection_field():
+    timer = mongo_monitoring.CommandTimer(slow_ms=1e9)
+    labels = dict(database="diary_db", collection="conversations",
+                  command="getMore")
+    before = sample("ai_mongo_command_failures_total", **labels)
+
+    timer.started(_event(request_id=2, database_name="diary_db",
+                         command_name="getMore",
+                         command={"getMore": 123, "collection": "conversations"}))
+    timer.failed(_event(request_id=2, database_name="diary_db",
+                        command_name="getMore", duration_micros=10))
+
+    assert sample("ai_mongo_command_failures_total", **labels) == before + 1
+
+
+def test_pool_monitor_tracks_checkouts():
+    pool = mongo_monitoring.PoolMonitor()
+    checked_out = sample("ai_mongo_pool_connections_checked_out")
+    waits = sample("ai_mongo_pool_checkout_wait_seconds_count")
+    failures = sample("ai_mongo_pool_checkout_failures_total", reason="timeout")
+
+    pool.connection_checked_out(SimpleNamespace(duration=0.002))
+    assert sample("ai_mongo_pool_connections_checked_out") == checked_out + 1
+    pool.connection_checked_in(SimpleNamespace())
+    assert sample("ai_mongo_pool_connections_checked_out") == checked_out
+
+    pool.connection_check_out_failed(SimpleNamespace(duration=1.5,
+                                                     reason="timeout"))
+    assert sample("ai_mongo_pool_checkout_wait_seconds_count") == waits + 2
+    assert sample("ai_mongo_pool_checkout_failures_total",
+                  reason="timeout") == failures + 1
+
+
+def test_client_options_registers_listeners(monkeypatch):
+    monkeypatch.setenv("MONGO_MAX_POOL_SIZE", "20")
+    monkeypatch.delenv("MONGO_MIN_POOL_SIZE", raising=False)
+
+    opts = db.client_options()
+
+    assert opts["maxPoolSize"] == 20
+    assert "minPoolSize" not in opts
+    kinds = {type(l) for l in opts["event_listeners"]}
+    assert kinds == {mongo_monitoring.CommandTimer, mongo_monitoring.PoolMonitor}
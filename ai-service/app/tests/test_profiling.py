@@ -0,0 +1,58 @@
+import os
+import time
+
+import pytest
+
+from app import profiling
+
+
+@pytest.fixture
+def profile_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(profiling, "TOKEN", "s3cret")
+    return tmp_path
+
+
+def test_wanted_requires_matching_token(monkeypatch):
+    monkeypatch.setattr(profiling, "TOKEN", "s3cret")
+    monkeypatch.setattr(profiling, "SAMPLE_RATE", 0)
+    assert profiling.wanted("s3cret")
+    assert not profiling.wanted("wrong")
+    assert not profiling.wanted(None)
+
+    monkeypatch.setattr(profiling, "SAMPLE_RATE", 1.0)
+    assert profiling.wanted(None)
+    # Sampling alone does not unlock downloads
+    assert not profiling.authorized(None)
+
+
+def test_sampling_session_saves_folded_stacks(profile_dir):
+    session = profiling.start()
+    assert profiling.start() is None  # one profile at a time
+    time.sleep(0.05)
+    name = profiling.finish(session, "req2")
+
+    assert name == "req2.folded"
+
+    lines = (profile_dir / name).read_text().splitlines()
+    assert lines
+    assert any("test_sampling_session_saves_folded_stacks" in l for l in lines)
+    # The lock is released again
+    profiling.finish(profiling.start(), "req3")
+
+
+def test_old_profiles_are_pruned(profile_dir, monkeypatch):
+    monkeypatch.setattr(profiling, "KEEP", 2)
+    for i in range(4):
+        profiling.finish(profiling.start(), f"r{i}")
+        os.utime(profile_dir / f"r{i}.folded", (i, i))
+
+    assert profiling.list_profiles() == ["r3.folded", "r2.folded"]
+
+
+def test_profile_path_rejects_unknown_names(profile_dir):
+    (profile_dir / "ok.folded").write_text("x")
+    assert profiling.profile_path("ok.folded") == str(profile_dir / "ok.folded")
+    assert profiling.profile_path("../ok.folded") is None
+    assert profiling.profile_path("missing.folded") is None
+    assert profiling.profile_path("ok.prof") is None
@@ -0,0 +1,72 @@
+import threading
+from unittest.mock import patch
+
+from app import serve
+
+
+class FakeProc:
+    def __init__(self, pid, code=1):
+        self.pid = pid
+        self.code = code
+        self.exited = threading.Event()
+        self.terminated = False
+
+    def wait(self, timeout=None):
+        self.exited.wait(timeout)
+        return self.code
+
+    def terminate(self):
+        self.terminated = True
+        self.exited.set()
+
+
+def test_supervisor_retries_failed_restarts_with_backoff(tmp_path):
+    crashed = FakeProc(1)
+    crashed.exited.set()
+    restarted = FakeProc(2)
+    state = {"proc": crashed, "stopping": False}
+    starts = [RuntimeError("exited with status 1")] * 3 + [restarted]
+    sleeps = []
+
+    def start(address):
+        result = starts.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    with patch.object(serve, "_start_stt_server", side_effect=start), patch.object(
+        serve.time, "sleep", side_effect=sleeps.append
+    ):
+        supervisor = threading.Thread(
+            target=serve._supervise, args=(state, str(tmp_path / "stt.sock"))
+        )
+        supervisor.start()
+        for _ in range(100):
+            if state["proc"] is restarted:
+                break
+            restarted.exited.wait(0.01)
+        assert state["proc"] is restarted
+        assert supervisor.is_alive()
+
+        state["stopping"] = True
+        restarted.terminate()
+        supervisor.join(5)
+
+    assert not supervisor.is_alive()
+    assert sleeps == [0, 1, 2, 4]
+
+
+def test_supervisor_stops_retrying_on_shutdown(tmp_path):
+    crashed = FakeProc(1)
+    crashed.exited.set()
+    state = {"proc": crashed, "stopping": False}
+
+    def start(address):
+        state["stopping"] = True
+        raise RuntimeError("did not start in time")
+
+    with patch.object(serve, "_start_stt_server", side_effect=start) as mock_start:
+        with patch.object(serve.time, "sleep"):
+            serve._supervise(state, str(tmp_path / "stt.sock"))
+
+    assert mock_start.call_count == 1
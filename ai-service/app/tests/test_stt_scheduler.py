@@ -0,0 +1,134 @@
+import asyncio
+import threading
+import time
+
+from app.services import stt_scheduler
+from app.services.stt_scheduler import SttScheduler, ThreadedSttScheduler
+from app.tests import sample
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+async def _queue(sched, order, name, duration):
+    await sched.acquire(duration)
+    order.append(name)
+
+
+def test_short_clip_overtakes_queued_long_upload():
+    async def main():
+        sched = SttScheduler(slots=1, aging_rate=1.0)
+        order = []
+        await sched.acquire(10)  # something is running
+
+        long_job = asyncio.create_task(_queue(sched, order, "long", 600))
+        await asyncio.sleep(0)
+        short_job = asyncio.create_task(_queue(sched, order, "short", 5))
+        await asyncio.sleep(0)
+        assert sched.waiting == 2
+
+        sched.release()
+        await asyncio.sleep(0)
+        assert order == ["short"]
+
+        sched.release()
+        await asyncio.gather(long_job, short_job)
+        assert order == ["short", "long"]
+
+    _run(main())
+
+
+def test_aging_prevents_starvation():
+    async def main():
+        now = [0.0]
+        sched = SttScheduler(slots=1, aging_rate=1.0)
+        sched._clock = lambda: now[0]
+        order = []
+        await sched.acquire(10)
+
+        long_job = asyncio.create_task(_queue(sched, order, "long", 100))
+        await asyncio.sleep(0)
+        # The long job has waited longer than its own audio by the time a
+        # short one arrives, so it goes first
+        now[0] = 101.0
+        short_job = asyncio.create_task(_queue(sched, order, "short", 5))
+        await asyncio.sleep(0)
+
+        sched.release()
+        await asyncio.sleep(0)
+        assert order == ["long"]
+
+        sched.release()
+        await asyncio.gather(long_job, short_job)
+
+    _run(main())
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def main():
+        sched = SttScheduler(slots=1)
+        await sched.acquire(1)
+
+        waiter = asyncio.create_task(sched.acquire(1))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        assert sched.waiting == 0
+
+        sched.release()
+        # The slot is free again
+        await asyncio.wait_for(sched.acquire(1), timeout=1)
+
+    _run(main())
+
+
+def test_queue_wait_recorded_by_size_class():
+    before = sample("stt_queue_wait_seconds_count", size="long")
+
+    async def main():
+        sched = SttScheduler(slots=1)
+        await sched.acquire(300)
+        sched.release()
+
+    _run(main())
+
+    assert sample("stt_queue_wait_seconds_count", size="long") == before + 1
+    assert stt_scheduler.size_class(5) == "short"
+    assert stt_scheduler.size_class(None) == "short"
+    assert stt_scheduler.size_class(60) == "medium"
+
+
+def test_threaded_scheduler_hands_slots_out_shortest_first():
+    sched = ThreadedSttScheduler(slots=1)
+    order = []
+    sched.acquire(10)
+
+    def job(name, duration):
+        sched.acquire(duration)
+        order.append(name)
+        sched.release()
+
+    threads = []
+    for name, duration in (("long", 600), ("short", 5)):
+        threads.append(threading.Thread(target=job, args=(name, duration)))
+        threads[-1].start()
+        while sched.waiting < len(threads):
+            time.sleep(0.001)
+
+    sched.release()
+    for t in threads:
+        t.join(5)
+    assert order == ["short", "long"]
+
+
+def test_threaded_scheduler_gives_up_after_timeout():
+    sched = ThreadedSttScheduler(slots=1)
+    sched.acquire(10)
+
+    assert sched.acquire(5, timeout=0.01) is None
+    assert sched.waiting == 0
+
+    sched.release()
+    # The slot wasn't handed to the waiter that gave up
+    assert sched.acquire(5, timeout=0) is not None
@@ -0,0 +1,159 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from unittest.mock import patch
+
+import pytest
+
+from app.services import stt_server, stt_service
+from app.services.stt_service import Transcription
+
+AI_SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+@contextmanager
+def _running_server(threads, transcribe_local):
+    """A live STT server on a temp socket, with the model calls stubbed."""
+    address = os.path.join(tempfile.gettempdir(), f"stt-test-{uuid.uuid4().hex}.sock")
+    ready = threading.Event()
+    with patch.object(stt_service, "preload"), \
+         patch.object(stt_service, "transcribe_local", transcribe_local):
+        threading.Thread(
+            target=stt_server.serve,
+            args=(address, threads, b"secret", ready),
+            daemon=True,
+        ).start()
+        assert ready.wait(5)
+        with patch.object(stt_service, "STT_SERVER_ADDRESS", address), \
+             patch.object(stt_service, "STT_SERVER_AUTHKEY", b"secret"):
+            yield address
+
+
+@pytest.fixture
+def server():
+    calls = []
+
+    def fake_transcribe_local(path, duration, language, tier):
+        calls.append((path, duration, language, tier))
+        if path == "broken.wav":
+            raise ValueError("bad audio")
+        return Transcription(f"text of {path}", language or "en", 0.9)
+
+    with _running_server(2, fake_transcribe_local):
+        yield calls
+
+
+def _wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_transcribe_goes_through_stt_server(server):
+    result = stt_service.transcribe("a.wav", 3.0, "de", "fast")
+
+    assert result == Transcription("text of a.wav", "de", 0.9)
+    assert server == [("a.wav", 3.0, "de", "fast")]
+
+
+def test_stt_server_errors_are_raised_in_the_worker(server):
+    with pytest.raises(RuntimeError, match="bad audio"):
+        stt_service.transcribe("broken.wav", 3.0)
+
+
+def test_stt_server_rejects_wrong_authkey(server):
+    with patch.object(stt_service, "STT_SERVER_AUTHKEY", b"wrong"):
+        with pytest.raises(Exception):
+            stt_service.transcribe("a.wav", 3.0)
+    assert server == []
+
+
+def test_worker_stops_waiting_for_a_busy_server_at_its_timeout():
+    started = []
+    release = threading.Event()
+
+    def fake_transcribe_local(path, duration, language, tier):
+        started.append(path)
+        release.wait(10)
+        return Transcription(f"text of {path}", "en", 0.9)
+
+    with _running_server(1, fake_transcribe_local):
+        busy = threading.Thread(target=stt_service.transcribe, args=("a.wav", 3.0))
+        busy.start()
+        _wait_until(lambda: started)
+
+        t0 = time.monotonic()
+        with pytest.raises(TimeoutError):
+            stt_service.transcribe("b.wav", 3.0, timeout=0.2)
+        assert time.monotonic() - t0 < 2
+        # The server dropped the abandoned request from its queue too
+        _wait_until(lambda: stt_service.server_waiting() == 0)
+
+        release.set()
+        busy.join(5)
+    assert started == ["a.wav"]
+
+
+def test_unreachable_stt_server_is_reported_as_unavailable():
+    missing = os.path.join(tempfile.gettempdir(), f"stt-none-{uuid.uuid4().hex}.sock")
+    with patch.object(stt_service, "STT_SERVER_ADDRESS", missing):
+        with pytest.raises(stt_service.SttUnavailable):
+            stt_service.transcribe("a.wav", 3.0)
+
+
+def test_two_workers_share_slots_shortest_first():
+    """Requests from two worker processes share the server's slots, and a
+    short clip from one goes ahead of a long upload queued by the other."""
+    started = []
+    running = []
+    release = threading.Event()
+
+    def fake_transcribe_local(path, duration, language, tier):
+        running.append(path)
+        started.append((path, len(running)))
+        if path == "first.wav":
+            release.wait(10)
+        running.remove(path)
+        return Transcription(f"text of {path}", "en", 0.9)
+
+    with _running_server(1, fake_transcribe_local) as address:
+        env = {
+            **os.environ,
+            "STT_SERVER_ADDRESS": address,
+            "STT_SERVER_AUTHKEY": "secret",
+        }
+
+        def worker(path, seconds):
+            code = (
+                "from app.services import stt_service; "
+                f"print(stt_service.transcribe({path!r}, {seconds}).text)"
+            )
+            return subprocess.Popen(
+                [sys.executable, "-c", code],
+                env=env,
+                cwd=AI_SERVICE_DIR,
+                stdout=subprocess.PIPE,
+                text=True,
+            )
+
+        first = threading.Thread(target=stt_service.transcribe, args=("first.wav", 3.0))
+        first.start()
+        _wait_until(lambda: started)
+        long_upload = worker("long.wav", 600.0)
+        _wait_until(lambda: stt_service.server_waiting() == 1)
+        short_clip = worker("short.wav", 5.0)
+        _wait_until(lambda: stt_service.server_waiting() == 2)
+
+        release.set()
+        first.join(10)
+        assert long_upload.communicate(timeout=30)[0].strip() == "text of long.wav"
+        assert short_clip.communicate(timeout=30)[0].strip() == "text of short.wav"
+
+    # One slot: never more than one transcription at a time, short clip first
+    assert started == [("first.wav", 1), ("short.wav", 1), ("long.wav", 1)]
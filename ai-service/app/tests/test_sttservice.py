@@ -1,3 +1,4 @@
+from types import SimpleNamespace
 from unittest.mock import patch, MagicMock
 from app.services import stt_service
 
@@ -13,9 +14,117 @@ def test_transcribe_audio():
     fake_model = MagicMock()
     fake_segment = MagicMock()
     fake_segment.text = "hello world"
-    fake_model.transcribe.return_value = ([fake_segment], None)
+    fake_model.transcribe.return_value = (
+        [fake_segment], SimpleNamespace(language="en", language_probability=0.98)
+    )
 
     with patch("app.services.stt_service.get_model", return_value=fake_model):
         text = stt_service.transcribe_audio("fakefile.wav")
 
     assert text == "hello world"
+
+
+def test_split_at_silence_cuts_in_quiet_gaps():
+    import numpy as np
+
+    sr = 1000
+    rng = np.random.default_rng(0)
+    audio = rng.uniform(-0.5, 0.5, 25 * sr).astype(np.float32)
+    # Pauses at 8.5 s and 17 s
+    audio[8400:8600] = 0
+    audio[16900:17100] = 0
+
+    bounds = stt_service.split_at_silence(audio, max_seconds=10, sr=sr)
+
+    assert bounds[0][0] == 0 and bounds[-1][1] == len(audio)
+    assert all(end == nxt for (_, end), (nxt, _) in zip(bounds, bounds[1:]))
+    assert all(end - start <= 10 * sr for start, end in bounds)
+    cuts = [end for _, end in bounds[:-1]]
+    assert len(cuts) == 2
+    assert 8400 <= cuts[0] < 8600 and 16900 <= cuts[1] < 17100
+
+
+def test_split_at_silence_short_audio_is_one_chunk():
+    import numpy as np
+
+    audio = np.zeros(5 * 16000, dtype=np.float32)
+    assert stt_service.split_at_silence(audio, max_seconds=10) == [(0, 80000)]
+
+
+def test_transcribe_audio_short_recording_is_not_chunked():
+    hi = stt_service.Transcription("hi", "en", 0.9)
+    with patch("app.services.stt_service._transcribe", return_value=hi) as one, \
+         patch("app.services.stt_service.transcribe_chunked") as chunked:
+        text = stt_service.transcribe_audio("short.wav", duration=5)
+
+    assert text == "hi"
+    one.assert_called_once_with("short.wav", None, "accurate")
+    chunked.assert_not_called()
+
+
+def test_transcribe_audio_long_recording_stitches_chunks_in_order():
+    import numpy as np
+
+    audio = np.arange(10, dtype=np.float32)
+    pool = MagicMock()
+    # Executor.map preserves input order; the chunk's first sample identifies it
+    pool.map.side_effect = lambda fn, chunks: [
+        stt_service.Transcription(
+            "" if c[0] == 4 else f"part{int(c[0])}", "en", 0.5 + c[0] / 100
+        )
+        for c in chunks
+    ]
+
+    with patch("app.services.stt_service.decode_audio", return_value=audio), \
+         patch("app.services.stt_service.split_at_silence",
+               return_value=[(0, 4), (4, 7), (7, 10)]), \
+         patch("app.services.stt_service.get_pool", return_value=pool):
+        result = stt_service.transcribe(
+            "long.wav", duration=stt_service.STT_CHUNK_THRESHOLD_SECONDS
+        )
+
+    assert result.text == "part0 part7"
+    # The most confident chunk's detection stands for the recording
+    assert result.language_probability == 0.57
+
+
+def test_transcribe_passes_language_to_whisper():
+    fake_model = MagicMock()
+    fake_model.transcribe.return_value = (
+        [], SimpleNamespace(language="de", language_probability=1)
+    )
+
+    with patch("app.services.stt_service.get_model", return_value=fake_model):
+        result = stt_service.transcribe("a.wav", duration=3, language="de")
+
+    assert fake_model.transcribe.call_args.kwargs["language"] == "de"
+    assert result == stt_service.Transcription("", "de", 1)
+
+
+def test_fast_tier_decodes_greedily_without_timestamps():
+    fake_model = MagicMock()
+    fake_model.transcribe.return_value = (
+        [], SimpleNamespace(language="en", language_probability=0.9)
+    )
+
+    with patch("app.services.stt_service.get_model", return_value=fake_model):
+        stt_service.transcribe("a.wav", duration=3, tier="fast")
+        fast = fake_model.transcribe.call_args.kwargs
+        stt_service.transcribe("a.wav", duration=3, tier="accurate")
+        accurate = fake_model.transcribe.call_args.kwargs
+
+    assert fast["beam_size"] == 1
+    assert fast["without_timestamps"] is True
+    assert fast["condition_on_previous_text"] is False
+    # accurate keeps faster-whisper's defaults
+    assert accurate == {"language": None}
+
+
+def test_language_allow_list_matches_multilingual_model():
+    # Read through the public property, without loading a model
+    multilingual = SimpleNamespace(model=SimpleNamespace(is_multilingual=True))
+    languages = stt_service.WhisperModel.supported_languages.fget(multilingual)
+
+    assert stt_service.WHISPER_LANGUAGES == set(languages)
+    assert stt_service.is_supported_language("yue")
+    assert not stt_service.is_supported_language("xx")
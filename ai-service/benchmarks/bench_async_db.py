@@ -0,0 +1,100 @@
+"""
+Benchmark: concurrent /api/chat turns per worker, blocking vs. async Mongo.
+
+Drives the real FastAPI app in-process (httpx ASGI transport, one event
+loop = one uvicorn worker). Mongo round trips are simulated with a fixed
+latency so the numbers isolate the data-access path:
+
+  blocking  each DB call does time.sleep(latency) on the event loop, which is
+            what sync pymongo inside an `async def` endpoint did
+  async     each DB call does `await asyncio.sleep(latency)`, like the
+            AsyncMongoClient-based app/db.py
+
+Gemini is replaced by a request that sleeps --llm-ms, run through the real
+retry policy (so on its thread limiter, like the SDK call).
+
+    cd ai-service && python benchmarks/bench_async_db.py
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from unittest.mock import patch
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import gemini_policy  # noqa: E402
+from app import main as service  # noqa: E402
+
+
+def _fake_db(latency, blocking):
+    async def wait():
+        if blocking:
+            time.sleep(latency)
+        else:
+            await asyncio.sleep(latency)
+
+    async def create_or_get_conversation(user_id):
+        await wait()
+        return {"_id": "conv"}
+
+    async def append_messages(conv_id, messages, shared=False, turn_id=None):
+        await wait()
+        return [{"role": r, "text": t} for r, t in messages]
+
+    return create_or_get_conversation, append_messages
+
+
+async def _run(requests, concurrency):
+    transport = httpx.ASGITransport(app=service.app)
+    sem = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as c:
+
+        async def one(i):
+            async with sem:
+                r = await c.post("/api/chat", json={"user_id": f"u{i}", "text": "hi"})
+                r.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        return time.perf_counter() - start
+
+
+def bench(mode, args):
+    create, append = _fake_db(args.db_ms / 1000, blocking=(mode == "blocking"))
+
+    async def fake_reply(text):
+        return await gemini_policy.call_with_policy(
+            "bench", lambda: time.sleep(args.llm_ms / 1000) or "ok"
+        )
+
+    with patch.object(service, "create_or_get_conversation", create), patch.object(
+        service, "append_messages", append
+    ), patch.object(service, "generate_cheerful_reply", fake_reply):
+        elapsed = asyncio.run(_run(args.requests, args.concurrency))
+    return args.requests / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=40)
+    parser.add_argument("--db-ms", type=float, default=5.0, help="per round trip")
+    parser.add_argument("--llm-ms", type=float, default=50.0)
+    args = parser.parse_args()
+
+    print(
+        f"{args.requests} requests, concurrency {args.concurrency}, "
+        f"{args.db_ms} ms per Mongo round trip, {args.llm_ms} ms LLM"
+    )
+    for mode in ("blocking", "async"):
+        print(f"{mode:>9}: {bench(mode, args):7.1f} req/s")
+
+
+if __name__ == "__main__":
+    main()
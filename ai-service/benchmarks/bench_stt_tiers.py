@@ -0,0 +1,177 @@
+"""
+Benchmark: latency and word error rate of the STT tiers (fast vs. accurate).
+
+Runs app.services.stt_service.transcribe() on every recording in a sample
+set, once per tier, and compares the text with a reference transcript. A
+sample set is either a directory of audio files, each with a .txt file of the
+same stem:
+
+    samples/
+      morning-walk.webm    morning-walk.txt
+      work-rant.wav        work-rant.txt
+
+or a JSON-lines manifest, one recording per line, with paths relative to the
+manifest (so a public corpus can be used in place, without copying it):
+
+    {"audio": "clips/0001.flac", "reference": "he hoped there would be stew", "language": "en"}
+
+Use recordings that look like production traffic (short voice-diary turns
+from the browser's MediaRecorder, in the languages users speak) and
+hand-corrected references. No recordings are bundled with the repository:
+users' diary audio can't be, and the model isn't downloaded at build time.
+
+    cd ai-service && python benchmarks/bench_stt_tiers.py --samples path/to/samples
+    cd ai-service && python benchmarks/bench_stt_tiers.py --samples set.jsonl \
+        --output results.json
+
+--output also writes the numbers, the sample set's size and the machine and
+model they were measured on as JSON, so published results can be traced
+back to a run.
+
+WER is word-level edit distance over reference words, after lowercasing and
+stripping punctuation, summed over the whole set. RTF (real-time factor) is
+transcription time divided by audio length.
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services import stt_service  # noqa: E402
+
+AUDIO_SUFFIXES = {".wav", ".webm", ".ogg", ".flac", ".mp3", ".m4a", ".mp4"}
+
+
+def _words(text):
+    return re.sub(r"[^\w\s']", " ", text.lower()).split()
+
+
+def word_errors(reference, hypothesis):
+    """Substitutions + insertions + deletions turning reference into hypothesis."""
+    ref, hyp = _words(reference), _words(hypothesis)
+    prev = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        cur = [i]
+        for j, h in enumerate(hyp, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (r != h)))
+        prev = cur
+    return prev[-1], len(ref)
+
+
+def load_samples(path, language=None):
+    """[(audio path, reference text, language)] from a directory or manifest."""
+    path = Path(path)
+    samples = []
+    if path.is_dir():
+        for audio in sorted(path.iterdir()):
+            ref = audio.with_suffix(".txt")
+            if audio.suffix.lower() in AUDIO_SUFFIXES and ref.exists():
+                samples.append((audio, ref.read_text().strip(), language))
+        return samples
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                samples.append(
+                    (
+                        path.parent / entry["audio"],
+                        entry["reference"].strip(),
+                        language or entry.get("language"),
+                    )
+                )
+    return samples
+
+
+def run(samples, tiers, runs):
+    # Load the model before timing anything
+    audio, _, language = samples[0]
+    stt_service.transcribe(audio, tier=tiers[0], language=language)
+
+    durations = {
+        audio: stt_service.probe_duration(audio) or 0 for audio, _, _ in samples
+    }
+    total_audio = sum(durations.values())
+    print(f"{len(samples)} samples, {total_audio:.1f} s of audio, {runs} run(s) each\n")
+    print(f"{'tier':10} {'median s':>9} {'p90 s':>7} {'RTF':>6} {'WER':>7}")
+
+    results = {
+        "samples": len(samples),
+        "audio_seconds": round(total_audio, 1),
+        "runs": runs,
+        "tiers": {},
+    }
+    for tier in tiers:
+        latencies = []
+        errors = words = 0
+        for audio, reference, language in samples:
+            for _ in range(runs):
+                t0 = time.perf_counter()
+                result = stt_service.transcribe(audio, durations[audio], language, tier)
+                latencies.append(time.perf_counter() - t0)
+            e, n = word_errors(reference, result.text)
+            errors += e
+            words += n
+
+        latencies.sort()
+        p90 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))]
+        rtf = sum(latencies) / runs / total_audio if total_audio else float("nan")
+        wer = errors / max(words, 1)
+        print(
+            f"{tier:10} {statistics.median(latencies):9.2f} {p90:7.2f}"
+            f" {rtf:6.3f} {wer:7.1%}"
+        )
+        results["tiers"][tier] = {
+            "median_seconds": round(statistics.median(latencies), 3),
+            "p90_seconds": round(p90, 3),
+            "rtf": round(rtf, 4),
+            "wer": round(wer, 4),
+        }
+    return results
+
+
+def environment():
+    import faster_whisper
+
+    return {
+        "model": "tiny (cpu, float32)",
+        "faster_whisper": faster_whisper.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--samples", required=True, help="audio + .txt directory, or a .jsonl manifest"
+    )
+    parser.add_argument("--tiers", default=",".join(stt_service.STT_TIERS))
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "--language",
+        default=None,
+        help="pin the language for every sample (default: the manifest's, else detect)",
+    )
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    samples = load_samples(args.samples, args.language)
+    if not samples:
+        parser.error(f"no audio files with .txt references in {args.samples}")
+    results = run(samples, args.tiers.split(","), args.runs)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), **results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Benchmark: memory per process and transcription throughput vs. WEB_CONCURRENCY.
+
+For each worker count, starts `python -m app.serve` on a free port, waits for
+/health, records the resident memory (VmRSS) of app.serve, every uvicorn
+worker and the STT server, then posts --requests copies of one recording to
+/api/transcribe, --concurrency at a time, and reports requests per second.
+
+    cd ai-service && python benchmarks/bench_workers.py --audio turn.webm \
+        --workers 1 2 4 --output workers.json
+
+Run it on the machine size you deploy to, with the model already downloaded
+(the first start otherwise includes the download), and a recording that
+looks like production traffic. STT_SERVER_THREADS and the other settings are
+taken from the environment. Nothing is measured at build time, and no
+reference numbers ship with the repository: they depend on the CPU count
+and the model.
+"""
+
+import argparse
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+AI_SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_TIMEOUT = 600
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _children(pid):
+    """PIDs of pid's descendants, from /proc."""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # comm may contain spaces; ppid follows the closing paren
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        parents.setdefault(ppid, []).append(int(entry))
+    found, todo = [], [pid]
+    while todo:
+        kids = parents.get(todo.pop(), [])
+        found.extend(kids)
+        todo.extend(kids)
+    return found
+
+
+def _process_memory(pid):
+    """(command line, resident MB) of pid."""
+    with open(f"/proc/{pid}/cmdline", "rb") as f:
+        cmd = f.read().replace(b"\0", b" ").decode(errors="replace").strip()
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return cmd, int(line.split()[1]) / 1024
+    return cmd, 0.0
+
+
+def memory(pid):
+    processes = []
+    for p in [pid] + _children(pid):
+        try:
+            cmd, rss = _process_memory(p)
+        except OSError:
+            continue  # exited meanwhile
+        if "multiprocessing" in cmd and "resource_tracker" in cmd:
+            continue
+        processes.append({"pid": p, "cmd": cmd, "rss_mb": round(rss, 1)})
+    return processes
+
+
+def throughput(base_url, audio, requests_total, concurrency):
+    with open(audio, "rb") as f:
+        data = f.read()
+    name = os.path.basename(audio)
+
+    def one(_):
+        t0 = time.perf_counter()
+        r = requests.post(
+            f"{base_url}/api/transcribe",
+            files={"file": (name, data)},
+            timeout=600,
+        )
+        return r.status_code, time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(requests_total)))
+    wall = time.perf_counter() - t0
+    ok = [s for code, s in results if code == 200]
+    return {
+        "requests": requests_total,
+        "ok": len(ok),
+        "wall_seconds": round(wall, 2),
+        "requests_per_second": round(len(ok) / wall, 3),
+        "mean_latency_seconds": round(sum(ok) / len(ok), 3) if ok else None,
+    }
+
+
+def run_workers(workers, audio, requests_total, concurrency):
+    port = _free_port()
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), PORT=str(port))
+    env["HOST"] = "127.0.0.1"
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "app.serve"], cwd=AI_SERVICE_DIR, env=env
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            if proc.poll() is not None:
+                raise SystemExit(f"app.serve exited with status {proc.returncode}")
+            if time.monotonic() > deadline:
+                raise SystemExit("app.serve did not start in time")
+            try:
+                if requests.get(f"{base_url}/health", timeout=1).ok:
+                    break
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.5)
+        # One request first, so lazy model loading isn't counted
+        throughput(base_url, audio, 1, 1)
+        processes = memory(proc.pid)
+        return {
+            "workers": workers,
+            "processes": processes,
+            "total_rss_mb": round(sum(p["rss_mb"] for p in processes), 1),
+            "throughput": throughput(base_url, audio, requests_total, concurrency),
+        }
+    finally:
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--audio", required=True, help="recording to transcribe")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--output", help="also write the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for n in args.workers:
+        result = run_workers(
+            n, os.path.abspath(args.audio), args.requests, args.concurrency
+        )
+        results.append(result)
+        t = result["throughput"]
+        print(f"WEB_CONCURRENCY={n}")
+        for p in result["processes"]:
+            print(f"  {p['rss_mb']:8.1f} MB  {p['pid']:>7}  {p['cmd'][:60]}")
+        print(f"  {result['total_rss_mb']:8.1f} MB  total")
+        print(
+            f"  {t['requests_per_second']:.2f} req/s, mean {t['mean_latency_seconds']} s,"
+            f" {t['ok']}/{t['requests']} ok"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "machine": {
+                        "platform": platform.platform(),
+                        "cpus": os.cpu_count(),
+                        "python": platform.python_version(),
+                    },
+                    "settings": {
+                        k: os.environ[k]
+                        for k in (
+                            "STT_SERVER_THREADS",
+                            "STT_WORKERS",
+                            "STT_TIER_TRANSCRIBE",
+                        )
+                        if k in os.environ
+                    },
+                    "requests": args.requests,
+                    "concurrency": args.concurrency,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -6,18 +6,45 @@ from flask import (
     session,
     redirect,
     url_for,
+    Response,
+    g,
+    abort,
+    send_file,
+    has_request_context,
 )
 from bson import ObjectId
-from pymongo import MongoClient
-from datetime import datetime
+from werkzeug.exceptions import RequestEntityTooLarge
+from pymongo import MongoClient, ReplaceOne, ReturnDocument
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    generate_latest,
+    multiprocess,
+)
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
 from zoneinfo import ZoneInfo
+import click
+import hashlib
 import requests
 import os
+import re
+import threading
+import time
+import uuid
+
+from audio_upload import AudioUpload, UploadRejected, UploadTooLarge, multipart_body
+import profiling
+from mongo_monitoring import client_options
+from mood_lexicon import analyze_mood_and_summary, message_mood
+from rescore_moods import rescore_moods
 
 AI_SERVICE_BASE = os.environ.get("AI_SERVICE_URL", "http://localhost:8001")
 
 MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/")
-client = MongoClient(MONGO_URI)
+client = MongoClient(MONGO_URI, **client_options())
 db = client["diary_db"]
 
 
@@ -26,77 +53,473 @@ app.secret_key = "dev-secret-key"
 
 
 # ----------------------------
-# Mood + summary heuristics
+# Request IDs and Server-Timing
 # ----------------------------
+#
+# Every request gets an ID (the caller's X-Request-ID if it looks sane, else a
+# new one). ai_post() forwards it to ai-service, whose log lines carry it, and
+# copies ai-service's Server-Timing entries into ours with an "ai-" prefix, so
+# devtools show e.g. "ai;dur=1650, ai-stt;dur=812, ai-gemini_reply;dur=640".
+#
+# It also sends the call's read timeout as X-Deadline-Ms, less the time the
+# request has already taken, so ai-service can stop working on a request once
+# web-app has given up on it and served a fallback.
+
+REQUEST_ID_HEADER = "X-Request-ID"
+DEADLINE_HEADER = "X-Deadline-Ms"
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+@app.before_request
+def _start_request():
+    rid = request.headers.get(REQUEST_ID_HEADER, "")
+    g.request_id = rid if _REQUEST_ID_RE.match(rid) else uuid.uuid4().hex
+    g.request_started = time.perf_counter()
+    g.server_timing = []
+
+
+@app.after_request
+def _finish_request(response):
+    rid = g.get("request_id")
+    if rid is None:
+        return response
+    total_ms = (time.perf_counter() - g.request_started) * 1000
+    timings = g.server_timing + [("app", total_ms)]
+    response.headers[REQUEST_ID_HEADER] = rid
+    response.headers["Server-Timing"] = ", ".join(
+        f"{name};dur={ms:.1f}" for name, ms in timings
+    )
+    return response
+
+
+def _parse_server_timing(value):
+    """[(name, ms)] from a Server-Timing header; entries without dur are skipped."""
+    out = []
+    for entry in (value or "").split(","):
+        name, *params = [p.strip() for p in entry.split(";")]
+        for p in params:
+            if name and p.startswith("dur="):
+                try:
+                    out.append((name, float(p[4:])))
+                except ValueError:
+                    pass
+    return out
+
+
+def _deadline_ms(timeout, in_request):
+    """X-Deadline-Ms for a requests timeout: its read part (timeout may be a
+    (connect, read) tuple), less what this request has already spent."""
+    if isinstance(timeout, tuple):
+        timeout = timeout[1]
+    if not timeout:
+        return None
+    if in_request:
+        timeout -= time.perf_counter() - g.request_started
+    return max(0, int(timeout * 1000))
+
+
+def ai_post(path, request_id=None, **kwargs):
+    """requests.post to ai-service, forwarding the request ID and recording
+    the call (and ai-service's own breakdown) for Server-Timing.
+
+    Background jobs run outside a request: they pass the ID of the request
+    that queued them, and nothing is recorded for Server-Timing."""
+    in_request = has_request_context()
+    rid = request_id or (g.request_id if in_request else uuid.uuid4().hex)
+    headers = {**kwargs.pop("headers", {}), REQUEST_ID_HEADER: rid}
+    deadline_ms = _deadline_ms(kwargs.get("timeout"), in_request)
+    if deadline_ms is not None:
+        headers[DEADLINE_HEADER] = str(deadline_ms)
+    start = time.perf_counter()
+    try:
+        r = requests.post(f"{AI_SERVICE_BASE}{path}", headers=headers, **kwargs)
+    finally:
+        if in_request:
+            g.server_timing.append(("ai", (time.perf_counter() - start) * 1000))
+    if not in_request:
+        return r
+    upstream = getattr(r, "headers", None) or {}
+    for name, ms in _parse_server_timing(upstream.get("Server-Timing")):
+        g.server_timing.append((f"ai-{name}", ms))
+    return r
 
-POSITIVE_WORDS = {
-    "happy",
-    "great",
-    "good",
-    "excited",
-    "relaxed",
-    "fun",
-    "love",
-    "enjoy",
-    "amazing",
-    "wonderful",
-}
-
-NEGATIVE_WORDS = {
-    "sad",
-    "tired",
-    "exhausted",
-    "stress",
-    "stressed",
-    "anxious",
-    "anxiety",
-    "angry",
-    "upset",
-    "bad",
-    "worried",
-    "frustrated",
-    "depressed",
-}
-
-
-def analyze_mood_and_summary(user_texts):
-    full = " ".join(user_texts).lower()
-    pos = sum(full.count(w) for w in POSITIVE_WORDS)
-    neg = sum(full.count(w) for w in NEGATIVE_WORDS)
-    score = pos - neg
-
-    if score > 1:
-        mood = "positive"
-    elif score < -1:
-        mood = "negative"
-        # “neutral” spelled normally
-    else:
-        mood = "neutral"
 
-    if user_texts:
-        summary = user_texts[0].strip()
-        if len(summary) > 220:
-            summary = summary[:217] + "..."
-    else:
-        summary = "You had a short conversation with your AI diary today."
-
-    if "exam" in full or "test" in full:
-        title = "Thinking about exams"
-    elif "travel" in full or "trip" in full:
-        title = "Thinking about a trip"
-    elif mood == "positive":
-        title = "A good day"
-    elif mood == "negative":
-        title = "A tough day"
-    else:
-        title = "A regular day"
+# ----------------------------
+# Indexes
+# ----------------------------
 
-    return {
-        "title": title,
-        "summary": summary,
-        "mood": mood,
-        "mood_score": score,
-    }
+_indexes_ready = False
+
+
+def ensure_indexes():
+    """Create the indexes the diary queries and rollups rely on (idempotent)."""
+    db.diaries.create_index([("user_id", 1), ("entry_date", 1)])
+    db.mood_rollups.create_index([("user_id", 1), ("month", 1)], unique=True)
+    # Finished diary jobs are only needed until the client has polled them
+    db.diary_jobs.create_index("created_at", expireAfterSeconds=DIARY_JOB_TTL)
+
+
+@app.before_request
+def _ensure_indexes_once():
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    try:
+        ensure_indexes()
+        _indexes_ready = True
+    except Exception as e:
+        # Mongo may not be reachable yet; try again on the next request
+        print("Error creating indexes:", e)
+
+
+# ----------------------------
+# Mood analytics rollups
+# ----------------------------
+#
+# One document per (user, month) in db.mood_rollups:
+#   {
+#     "user_id": ObjectId, "month": "2025-01",
+#     "count": 3, "score_sum": 4,
+#     "moods": {"positive": 2, "neutral": 1},
+#     "days": {"15": {"count": 2, "score_sum": 3}, ...},
+#     "rev": 7,
+#   }
+# Writes keep them up to date with $inc, so /mood-stats never scans diaries.
+# "rev" is bumped by every diary write that touches the month, and is what
+# the calendar cache keys its ETags on.
+
+MOODS = ("positive", "negative", "neutral")
+
+
+def _mood_score_value(value):
+    """Coerce a stored mood_score (int, float or numeric string) to a number."""
+    try:
+        score = float(value)
+    except (TypeError, ValueError):
+        return 0
+    return int(score) if score.is_integer() else score
+
+
+def _is_entry_date(value):
+    """True for a "YYYY-MM-DD" string naming a real day."""
+    if not isinstance(value, str):
+        return False
+    try:
+        datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        return False
+    return True
+
+
+def _rollup_key(doc):
+    """Return (month, day) for a diary, or None if it has no usable date."""
+    entry_date = doc.get("entry_date") or doc.get("date")
+    if not _is_entry_date(entry_date):
+        return None
+    return entry_date[:7], entry_date[8:10]
+
+
+def apply_mood_rollup(doc, sign=1):
+    """Add (sign=1) or remove (sign=-1) one diary from its monthly rollup."""
+    key = _rollup_key(doc)
+    if key is None or doc.get("user_id") is None:
+        return
+    month, day = key
+    mood = doc.get("mood") if doc.get("mood") in MOODS else "neutral"
+    score = _mood_score_value(doc.get("mood_score", 0))
+
+    db.mood_rollups.update_one(
+        {"user_id": doc["user_id"], "month": month},
+        {
+            "$inc": {
+                "count": sign,
+                "score_sum": sign * score,
+                f"moods.{mood}": sign,
+                f"days.{day}.count": sign,
+                f"days.{day}.score_sum": sign * score,
+                "rev": 1,
+            },
+            "$set": {"updated_at": datetime.utcnow()},
+        },
+        upsert=True,
+    )
+    invalidate_calendar_cache(doc["user_id"], month)
+
+
+def touch_month(doc):
+    """Bump the month's revision for edits that don't change mood stats."""
+    key = _rollup_key(doc)
+    if key is None or doc.get("user_id") is None:
+        return
+    db.mood_rollups.update_one(
+        {"user_id": doc["user_id"], "month": key[0]},
+        {"$inc": {"rev": 1}, "$set": {"updated_at": datetime.utcnow()}},
+        upsert=True,
+    )
+    invalidate_calendar_cache(doc["user_id"], key[0])
+
+
+def _rollups_differ(old, new):
+    return (
+        _rollup_key(old) != _rollup_key(new)
+        or old.get("mood") != new.get("mood")
+        or _mood_score_value(old.get("mood_score", 0))
+        != _mood_score_value(new.get("mood_score", 0))
+    )
+
+
+def rebuild_mood_rollups(user_id=None):
+    """
+    Recompute rollups from the diaries collection.
+
+    Diaries are streamed with a narrow projection and folded into per-month
+    totals in memory (one small dict per user-month). Each month is then
+    written with an unordered upsert, so a diary saved meanwhile (which
+    upserts the same (user_id, month) document) can't make the rebuild fail
+    on the unique index, and months that no longer have diaries are removed.
+    Returns the number of rollup documents written.
+
+    Run it once when deploying the rollups: until then, deleting or editing
+    a diary from an earlier month upserts negative counts, and mood_stats
+    hides months whose count is not positive.
+    """
+    flt = {"user_id": user_id} if user_id is not None else {}
+    cur = db.diaries.find(
+        flt,
+        {"user_id": 1, "entry_date": 1, "date": 1, "mood": 1, "mood_score": 1},
+    )
+
+    rollups = {}
+    for d in cur:
+        key = _rollup_key(d)
+        if key is None or d.get("user_id") is None:
+            continue
+        month, day = key
+        mood = d.get("mood") if d.get("mood") in MOODS else "neutral"
+        score = _mood_score_value(d.get("mood_score", 0))
+
+        r = rollups.setdefault(
+            (d["user_id"], month),
+            {
+                "user_id": d["user_id"],
+                "month": month,
+                "count": 0,
+                "score_sum": 0,
+                "moods": {},
+                "days": {},
+            },
+        )
+        r["count"] += 1
+        r["score_sum"] += score
+        r["moods"][mood] = r["moods"].get(mood, 0) + 1
+        bucket = r["days"].setdefault(day, {"count": 0, "score_sum": 0})
+        bucket["count"] += 1
+        bucket["score_sum"] += score
+
+    now = datetime.utcnow()
+    ops = [
+        ReplaceOne(
+            {"user_id": r["user_id"], "month": r["month"]},
+            dict(r, rev=0, updated_at=now),
+            upsert=True,
+        )
+        for r in rollups.values()
+    ]
+    if ops:
+        db.mood_rollups.bulk_write(ops, ordered=False)
+
+    months = {}
+    for uid, month in rollups:
+        months.setdefault(uid, []).append(month)
+    for uid, kept in months.items():
+        db.mood_rollups.delete_many({"user_id": uid, "month": {"$nin": kept}})
+    if user_id is None:
+        db.mood_rollups.delete_many({"user_id": {"$nin": list(months)}})
+    elif user_id not in months:
+        db.mood_rollups.delete_many(flt)
+    clear_calendar_cache()
+    return len(ops)
+
+
+# ----------------------------
+# Calendar cache
+# ----------------------------
+#
+# Rendered calendar months are cached per (user, year, month) in-process.
+# Entries are validated against the month's rollup revision (plus its
+# updated_at, which also changes on rebuilds), so a write handled by another
+# worker process is still picked up; writes handled here evict eagerly.
+
+CALENDAR_CACHE_SIZE = int(os.environ.get("CALENDAR_CACHE_SIZE", "1024"))
+
+_calendar_cache = OrderedDict()
+_calendar_cache_lock = threading.Lock()
+
+
+def invalidate_calendar_cache(user_id, month):
+    """Evict one cached month; month is "YYYY-MM"."""
+    key = (str(user_id), int(month[:4]), int(month[5:7]))
+    with _calendar_cache_lock:
+        _calendar_cache.pop(key, None)
+
+
+def clear_calendar_cache():
+    with _calendar_cache_lock:
+        _calendar_cache.clear()
+
+
+def _calendar_etag(uid, year, month):
+    r = db.mood_rollups.find_one(
+        {"user_id": ObjectId(uid), "month": f"{year}-{month:02d}"},
+        {"rev": 1, "updated_at": 1},
+    )
+    version = "0"
+    if r:
+        updated_at = r.get("updated_at")
+        version = f"{r.get('rev', 0)}:{updated_at.isoformat() if updated_at else ''}"
+    raw = f"{uid}:{year}-{month:02d}:{version}"
+    return hashlib.sha1(raw.encode()).hexdigest()[:20]
+
+
+# ----------------------------
+# Metrics
+# ----------------------------
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    # Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR,
+    # so any worker can answer for all of them
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+# ----------------------------
+# Profiling (opt-in, see profiling.py)
+# ----------------------------
+
+
+# The middleware is only installed when profiling is configured, so it costs
+# nothing otherwise
+if profiling.ENABLED:
+    app.wsgi_app = profiling.ProfileRequests(app.wsgi_app)
+
+
+@app.route("/debug/profiles")
+def list_profiles():
+    if not profiling.authorized(request.headers.get(profiling.PROFILE_HEADER)):
+        abort(404)
+    return jsonify({"profiles": profiling.list_profiles()})
+
+
+@app.route("/debug/profiles/<name>")
+def download_profile(name):
+    if not profiling.authorized(request.headers.get(profiling.PROFILE_HEADER)):
+        abort(404)
+    path = profiling.profile_path(name)
+    if path is None:
+        abort(404)
+    return send_file(path, as_attachment=True, download_name=name)
+
+
+# ----------------------------
+# Audio uploads
+# ----------------------------
+#
+# Audio is streamed through to ai-service (see audio_upload.py). Caps come
+# from AUDIO_MAX_BYTES / AUDIO_MAX_SECONDS, or from a user's "audio_limits"
+# {"max_bytes", "max_seconds"} document field; MAX_UPLOAD_BYTES is the hard
+# ceiling for any request body. The duration cap is enforced by ai-service,
+# which is the side that decodes the audio.
+
+AUDIO_MAX_BYTES = int(os.environ.get("AUDIO_MAX_BYTES", str(25 * 1024 * 1024)))
+AUDIO_MAX_SECONDS = int(os.environ.get("AUDIO_MAX_SECONDS", "600"))
+app.config["MAX_CONTENT_LENGTH"] = int(
+    os.environ.get("MAX_UPLOAD_BYTES", str(AUDIO_MAX_BYTES + 1024 * 1024))
+)
+# Room for the multipart envelope around a file that is itself under the cap
+MULTIPART_OVERHEAD = 16 * 1024
+
+
+def audio_limits(user_id):
+    """(max_bytes, max_seconds) for this user's uploads."""
+    user = db.users.find_one({"_id": ObjectId(user_id)}, {"audio_limits": 1}) or {}
+    limits = user.get("audio_limits") or {}
+    max_bytes = min(
+        limits.get("max_bytes", AUDIO_MAX_BYTES), app.config["MAX_CONTENT_LENGTH"]
+    )
+    return max_bytes, limits.get("max_seconds", AUDIO_MAX_SECONDS)
+
+
+def open_audio_upload(max_bytes):
+    """
+    AudioUpload for this request's audio, or None if there is none.
+
+    A raw audio/* body is read straight from the socket as it arrives; a
+    multipart "audio" field (already spooled by Werkzeug) is also accepted.
+    Raises UploadRejected for oversized or non-audio uploads.
+    """
+    length = request.content_length
+    if length is not None and length > max_bytes + MULTIPART_OVERHEAD:
+        raise UploadTooLarge(
+            f"Audio upload exceeds {max_bytes // (1024 * 1024)} MB limit"
+        )
+
+    if request.mimetype.startswith("audio/") or request.mimetype == (
+        "application/octet-stream"
+    ):
+        return AudioUpload(
+            request.stream,
+            request.headers.get("X-Filename"),
+            request.mimetype,
+            max_bytes,
+        )
+
+    file = request.files.get("audio")
+    if file is None or file.filename == "":
+        return None
+    return AudioUpload(
+        file.stream, file.filename, file.mimetype or "audio/wav", max_bytes
+    )
+
+
+def post_audio(path, upload, params=None, timeout=60):
+    """Stream an AudioUpload to ai-service as its multipart "file" field."""
+    content_type, body = multipart_body("file", upload)
+    return ai_post(
+        path,
+        params=params,
+        data=body,
+        headers={"Content-Type": content_type},
+        timeout=timeout,
+    )
+
+
+def _upload_error(e):
+    if isinstance(e, RequestEntityTooLarge):
+        return jsonify({"error": "Upload too large"}), 413
+    return jsonify({"error": str(e)}), e.status
+
+
+# ai-service answers that are about the user's input (bad ?language= or
+# ?tier=, too long, not audio): shown to the user, nothing is stored
+USER_ERRORS = (400, 413, 415, 422)
+
+
+def _upstream_error(r):
+    try:
+        detail = r.json().get("detail")
+    except Exception:
+        return r.text
+    if isinstance(detail, list):
+        # FastAPI validation errors: [{"loc": [..., "tier"], "msg": "..."}]
+        detail = "; ".join(
+            f"{e.get('loc', ['?'])[-1]}: {e.get('msg', '')}" for e in detail
+        )
+    return detail or r.text
 
 
 # ----------------------------
@@ -184,6 +607,41 @@ def start_conversation():
     return jsonify({"conversation_id": cid, "first_message": greeting})
 
 
+def _append_turn(oid, turn_id, user_msg, ai_msg):
+    """
+    Push the turn's two messages, tagged with turn_id (generated per turn and
+    sent to ai-service, which stores the turn under it), unless it is already
+    stored.
+
+    ai-service may have stored the turn and only timed out on the way back;
+    then nothing is written and the stored texts are returned instead of
+    ours, so the user sees what the conversation holds.
+    """
+    result = db.conversations.update_one(
+        {"_id": oid, "messages.turn_id": {"$ne": turn_id}},
+        {
+            "$push": {
+                "messages": {
+                    "$each": [
+                        {"role": "user", "text": user_msg, "turn_id": turn_id},
+                        {"role": "ai", "text": ai_msg, "turn_id": turn_id},
+                    ]
+                }
+            }
+        },
+    )
+    if result.matched_count:
+        return user_msg, ai_msg
+
+    conv = db.conversations.find_one({"_id": oid}, {"messages": 1}) or {}
+    stored = {
+        m["role"]: m.get("text")
+        for m in conv.get("messages", [])
+        if m.get("turn_id") == turn_id
+    }
+    return stored.get("user", user_msg), stored.get("ai", ai_msg)
+
+
 @app.route("/api/conversations/<cid>/messages", methods=["POST"])
 def add_message(cid):
     if "user_id" not in session:
@@ -210,16 +668,27 @@ def add_message(cid):
 
     # 2. Call ai-service's /api/chat to get AI reply
     ai_msg = "Thanks for sharing! Tell me more about your day."  # fallback
+    persisted = False
+
+    # Our own ID, not the client's X-Request-ID: two turns must never share it
+    turn_id = uuid.uuid4().hex
 
     try:
         payload = {
             "user_id": session["user_id"],  # Use the current logged-in user ID
             "text": user_msg,
+            # ai-service stores the turn in this conversation itself, under
+            # turn_id so the fallback write below can't store it twice
+            "conversation_id": cid,
+            "turn_id": turn_id,
+            # Picks ai-service's local reply if Gemini is slow
+            "mood": message_mood(user_msg),
         }
-        r = requests.post(f"{AI_SERVICE_BASE}/api/chat", json=payload, timeout=10)
+        r = ai_post("/api/chat", json=payload, timeout=10)
         if r.status_code == 200:
             data = r.json()
             ai_msg = data.get("reply", ai_msg)
+            persisted = data.get("persisted", False)
         else:
             # Log the error here for future debugging
             print("AI-service error:", r.status_code, r.text)
@@ -227,20 +696,9 @@ def add_message(cid):
         # If ai-service is down, fallback to default text to ensure user experience
         print("Error calling ai-service:", e)
 
-    # 3. As before: push both user + ai messages to the current conversation
-    db.conversations.update_one(
-        {"_id": oid},
-        {
-            "$push": {
-                "messages": {
-                    "$each": [
-                        {"role": "user", "text": user_msg},
-                        {"role": "ai", "text": ai_msg},
-                    ]
-                }
-            }
-        },
-    )
+    # 3. Unless ai-service already stored the turn, push both messages here
+    if not persisted:
+        user_msg, ai_msg = _append_turn(oid, turn_id, user_msg, ai_msg)
 
     return jsonify({"user_message": user_msg, "ai_response": ai_msg})
 
@@ -259,7 +717,8 @@ def add_audio_message(cid):
       1. Check login & conversation ownership.
       2. Retrieve the file and forward it to ai-service /api/chat/audio.
       3. Extract the transcribed text + AI reply from the ai-service response.
-      4. Write to diary_db.conversations for the current conversation.
+      4. Write to diary_db.conversations for the current conversation, unless
+         ai-service already stored the turn there (persisted=True).
       5. Return results to the frontend.
     """
     if "user_id" not in session:
@@ -277,56 +736,56 @@ def add_audio_message(cid):
     if str(conv["user_id"]) != session["user_id"]:
         return jsonify({"error": "Forbidden"}), 403
 
-    # 1. Retrieve audio file from form data (frontend field name is "audio")
-    file = request.files.get("audio")
-    if file is None or file.filename == "":
+    # 1. Open the upload (raw audio body or multipart "audio" field); its
+    #    first bytes are sniffed here, before anything is sent upstream
+    max_bytes, max_seconds = audio_limits(session["user_id"])
+    try:
+        upload = open_audio_upload(max_bytes)
+    except (UploadRejected, RequestEntityTooLarge) as e:
+        return _upload_error(e)
+    if upload is None:
         return jsonify({"error": "No audio file uploaded"}), 400
 
     # 2. Call ai-service's /api/chat/audio
     user_msg = "This is a placeholder transcription of your audio."
     ai_msg = "Thanks for sharing! Tell me more about your day."
+    persisted = False
+    turn_id = uuid.uuid4().hex
 
     try:
-        # per ai-service convention: pass user_id as query param, file field in files is named "file"
-        files = {"file": (file.filename, file.stream, file.mimetype or "audio/wav")}
-        params = {"user_id": session["user_id"]}
-
-        r = requests.post(
-            f"{AI_SERVICE_BASE}/api/chat/audio",
-            params=params,
-            files=files,
-            timeout=60,
-        )
+        # per ai-service convention: pass user_id as query param, file field is named "file"
+        params = {
+            "user_id": session["user_id"],
+            "conversation_id": cid,
+            "turn_id": turn_id,
+            "max_seconds": max_seconds,
+            # Optional per-request override of the user's transcription language
+            "language": request.args.get("language"),
+            "tier": request.args.get("tier"),
+            # No mood: the transcript isn't known yet, and a template for the
+            # wrong mood is worse than ai-service's neutral one
+        }
+
+        r = post_audio("/api/chat/audio", upload, params)
 
         if r.status_code == 200:
             data = r.json()
             ai_msg = data.get("reply", ai_msg)
-
-            # Find the "last user message" in history to treat as the transcribed text
-            history = data.get("history", [])
-            for m in reversed(history):
-                if m.get("role") == "user":
-                    user_msg = m.get("text", user_msg)
-                    break
+            user_msg = data.get("transcript") or user_msg
+            persisted = data.get("persisted", False)
+        elif r.status_code in USER_ERRORS:
+            # Bad parameters, too long or not decodable: nothing to store
+            return jsonify({"error": _upstream_error(r)}), r.status_code
         else:
             print("AI-service audio error:", r.status_code, r.text)
+    except (UploadRejected, RequestEntityTooLarge) as e:
+        return _upload_error(e)
     except Exception as e:
         print("Error calling ai-service audio endpoint:", e)
 
-    # 3. Same as text endpoint: push both user + ai messages to diary_db.conversations
-    db.conversations.update_one(
-        {"_id": oid},
-        {
-            "$push": {
-                "messages": {
-                    "$each": [
-                        {"role": "user", "text": user_msg},
-                        {"role": "ai", "text": ai_msg},
-                    ]
-                }
-            }
-        },
-    )
+    # 3. Same as text endpoint: only write the turn if ai-service didn't
+    if not persisted:
+        user_msg, ai_msg = _append_turn(oid, turn_id, user_msg, ai_msg)
 
     # 4. Return to frontend
     return jsonify(
@@ -346,35 +805,79 @@ def transcribe_audio():
     if "user_id" not in session:
         return jsonify({"error": "Not logged in"}), 401
 
-    file = request.files.get("audio")
-    if file is None or file.filename == "":
+    max_bytes, max_seconds = audio_limits(session["user_id"])
+    try:
+        upload = open_audio_upload(max_bytes)
+    except (UploadRejected, RequestEntityTooLarge) as e:
+        return _upload_error(e)
+    if upload is None:
         return jsonify({"error": "No audio file uploaded"}), 400
 
     text = ""
 
     try:
-        files = {"file": (file.filename, file.stream, file.mimetype or "audio/wav")}
-
-        r = requests.post(
-            f"{AI_SERVICE_BASE}/api/transcribe",
-            files=files,
-            timeout=60,
-        )
+        params = {
+            "user_id": session["user_id"],
+            "max_seconds": max_seconds,
+            "language": request.args.get("language"),
+            "tier": request.args.get("tier"),
+        }
+        r = post_audio("/api/transcribe", upload, params)
 
         if r.status_code == 200:
             data = r.json()
             text = data.get("text", "")
+        elif r.status_code in USER_ERRORS:
+            return jsonify({"error": _upstream_error(r)}), r.status_code
         else:
             print("AI-service transcribe error:", r.status_code, r.text)
+    except (UploadRejected, RequestEntityTooLarge) as e:
+        return _upload_error(e)
     except Exception as e:
         print("Error calling ai-service transcribe endpoint:", e)
 
     return jsonify({"text": text})
 
 
+@app.route("/api/stt-language", methods=["POST"])
+def set_stt_language():
+    """
+    Pin the language used to transcribe the current user's audio.
+
+    Body: {"language": "de"}, or {"language": null} to go back to automatic
+    detection. ai-service keeps the setting alongside the languages it has
+    detected for the user.
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    language = (request.get_json(silent=True) or {}).get("language")
+    try:
+        r = ai_post(
+            f"/api/users/{session['user_id']}/stt-language",
+            json={"language": language},
+            timeout=10,
+        )
+    except Exception as e:
+        print("Error calling ai-service stt-language endpoint:", e)
+        return jsonify({"error": "AI service unavailable"}), 502
+
+    if r.status_code == 400:
+        return jsonify({"error": _upstream_error(r)}), 400
+    if r.status_code != 200:
+        print("AI-service stt-language error:", r.status_code, r.text)
+        return jsonify({"error": "AI service unavailable"}), 502
+    return jsonify(r.json())
+
+
 @app.route("/api/conversations/<cid>/complete", methods=["POST"])
 def complete_conversation(cid):
-    """Generate diary preview - does NOT save to database."""
+    """
+    Queue diary preview generation - does NOT save to database.
+
+    Returns 202 {"job_id", "status"} right away; poll
+    GET /api/diary-jobs/<job_id> for the preview.
+    """
     if "user_id" not in session:
         return jsonify({"error": "Not logged in"}), 401
 
@@ -383,26 +886,32 @@ def complete_conversation(cid):
     except Exception:
         return jsonify({"error": "Invalid id"}), 400
 
-    conv = db.conversations.find_one({"_id": oid})
+    conv = db.conversations.find_one({"_id": oid}, {"user_id": 1})
     if not conv:
         return jsonify({"error": "Not found"}), 404
     if str(conv["user_id"]) != session["user_id"]:
         return jsonify({"error": "Forbidden"}), 403
 
+    data = request.get_json() or {}
+    job_id = submit_diary_job(conv["user_id"], oid, data.get("preferences", None))
+
+    resp = jsonify({"job_id": str(job_id), "status": "queued"})
+    resp.headers["Location"] = url_for("diary_job_status", job_id=str(job_id))
+    return resp, 202
+
+
+def generate_diary_preview(cid, msgs, preferences, request_id=None):
+    """Diary preview from ai-service, or from the mood lexicon if it fails."""
     now = datetime.now(ZoneInfo("America/New_York"))
     today_str = now.strftime("%Y-%m-%d")
 
-    msgs = conv.get("messages", [])
-    data = request.get_json() or {}
-    preferences = data.get("preferences", None)
-
     try:
         payload = {"messages": msgs}
         if preferences:
             payload["preferences"] = preferences
 
-        r = requests.post(
-            f"{AI_SERVICE_BASE}/api/generate-diary", json=payload, timeout=30
+        r = ai_post(
+            "/api/generate-diary", request_id=request_id, json=payload, timeout=30
         )
         if r.status_code == 200:
             ai_diary = r.json()
@@ -411,6 +920,7 @@ def complete_conversation(cid):
             summary = ai_diary["summary"]
             mood = ai_diary["mood"]
             mood_score = ai_diary.get("mood_score", 0)
+            mood_source = "ai"
         else:
             raise Exception("AI service returned " + str(r.status_code))
     except Exception as e:
@@ -426,19 +936,142 @@ def complete_conversation(cid):
         summary = analysis["summary"]
         mood = analysis["mood"]
         mood_score = analysis["mood_score"]
+        mood_source = "lexicon"
 
-    # Return preview only - NOT saved to database yet
-    return jsonify(
+    return {
+        "conversation_id": str(cid),
+        "title": title,
+        "content": content,
+        "summary": summary,
+        "mood": mood,
+        "mood_score": mood_score,
+        "mood_source": mood_source,
+        "suggested_date": today_str,
+    }
+
+
+# ----------------------------
+# Diary generation jobs
+# ----------------------------
+#
+# One document per request in db.diary_jobs:
+#   {
+#     "user_id": ObjectId, "conversation_id": ObjectId,
+#     "preferences": {...} | None, "request_id": "...",
+#     "status": "queued" | "running" | "done" | "failed",
+#     "result": {...preview...}, "error": "...", "attempts": 1,
+#     "created_at": datetime, "updated_at": datetime
+#   }
+#
+# Jobs run on a per-process thread pool (DIARY_JOB_WORKERS at a time), so a
+# web worker thread is not held for the ai-service call and a client that
+# disconnects can poll the result later. Each run first claims the job
+# (queued -> running) with one atomic update, so a job submitted twice only
+# runs once. A job that stays queued/running past DIARY_JOB_STALE_SECONDS -
+# e.g. its process was restarted - is queued again by the next poll.
+
+DIARY_JOB_WORKERS = int(os.environ.get("DIARY_JOB_WORKERS", "4"))
+DIARY_JOB_STALE_SECONDS = int(os.environ.get("DIARY_JOB_STALE_SECONDS", "120"))
+DIARY_JOB_TTL = int(os.environ.get("DIARY_JOB_TTL", str(24 * 3600)))
+
+_diary_executor = ThreadPoolExecutor(
+    max_workers=DIARY_JOB_WORKERS, thread_name_prefix="diary-job"
+)
+
+
+def submit_diary_job(user_id, conversation_id, preferences):
+    now = datetime.utcnow()
+    job_id = db.diary_jobs.insert_one(
         {
-            "conversation_id": cid,
-            "title": title,
-            "content": content,
-            "summary": summary,
-            "mood": mood,
-            "mood_score": mood_score,
-            "suggested_date": today_str,
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "preferences": preferences,
+            "request_id": g.get("request_id"),
+            "status": "queued",
+            "attempts": 0,
+            "created_at": now,
+            "updated_at": now,
         }
+    ).inserted_id
+    _diary_executor.submit(run_diary_job, job_id)
+    return job_id
+
+
+def run_diary_job(job_id):
+    job = db.diary_jobs.find_one_and_update(
+        {"_id": job_id, "status": "queued"},
+        {
+            "$set": {"status": "running", "updated_at": datetime.utcnow()},
+            "$inc": {"attempts": 1},
+        },
+        return_document=ReturnDocument.AFTER,
+    )
+    if job is None:
+        # Already claimed by another run
+        return
+
+    try:
+        conv = db.conversations.find_one(
+            {"_id": job["conversation_id"]}, {"messages": 1}
+        )
+        # ai-service-written messages carry datetimes; only role/text are needed
+        msgs = [
+            {"role": m.get("role"), "text": m.get("text", "")}
+            for m in (conv or {}).get("messages", [])
+        ]
+        result = generate_diary_preview(
+            job["conversation_id"], msgs, job["preferences"], job.get("request_id")
+        )
+        update = {"status": "done", "result": result}
+    except Exception as e:
+        print("Diary job", job_id, "failed:", e)
+        update = {"status": "failed", "error": str(e)}
+
+    update["updated_at"] = datetime.utcnow()
+    db.diary_jobs.update_one({"_id": job_id}, {"$set": update})
+
+
+def _requeue_if_stale(job):
+    if job["status"] not in ("queued", "running"):
+        return job
+    if datetime.utcnow() - job["updated_at"] < timedelta(
+        seconds=DIARY_JOB_STALE_SECONDS
+    ):
+        return job
+    # Only one poller wins the requeue
+    requeued = db.diary_jobs.find_one_and_update(
+        {"_id": job["_id"], "status": job["status"], "updated_at": job["updated_at"]},
+        {"$set": {"status": "queued", "updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER,
     )
+    if requeued is not None:
+        _diary_executor.submit(run_diary_job, job["_id"])
+    return db.diary_jobs.find_one({"_id": job["_id"]})
+
+
+@app.route("/api/diary-jobs/<job_id>")
+def diary_job_status(job_id):
+    if "user_id" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    try:
+        oid = ObjectId(job_id)
+    except Exception:
+        return jsonify({"error": "Invalid id"}), 400
+
+    job = db.diary_jobs.find_one({"_id": oid})
+    if not job:
+        return jsonify({"error": "Not found"}), 404
+    if str(job["user_id"]) != session["user_id"]:
+        return jsonify({"error": "Forbidden"}), 403
+
+    job = _requeue_if_stale(job)
+    out = {"job_id": job_id, "status": job["status"]}
+    if job["status"] == "done":
+        out["result"] = job["result"]
+    elif job["status"] == "failed":
+        out["error"] = job.get("error", "Diary generation failed")
+    return jsonify(out)
 
 
 @app.route("/api/conversations/<cid>/save", methods=["POST"])
@@ -468,12 +1101,12 @@ def save_diary(cid):
     content = data.get("content", "")
     mood = data.get("mood", "neutral")
     mood_score = data.get("mood_score", 0)
+    # Where the mood came from: "ai", "lexicon" (fallback heuristic) or "user"
+    mood_source = data.get("mood_source")
     entry_date = data.get("entry_date", created_date)
 
     # Validate entry_date format
-    try:
-        datetime.strptime(entry_date, "%Y-%m-%d")
-    except ValueError:
+    if not _is_entry_date(entry_date):
         entry_date = created_date
 
     diary = {
@@ -486,11 +1119,13 @@ def save_diary(cid):
         "summary": content[:200] if content else "",
         "mood": mood,
         "mood_score": mood_score,
+        "mood_source": mood_source,
         "created_at": now,
         "conversation_id": oid,
     }
 
     new_id = db.diaries.insert_one(diary).inserted_id
+    apply_mood_rollup(diary)
 
     db.conversations.update_one({"_id": oid}, {"$set": {"status": "completed"}})
 
@@ -525,6 +1160,17 @@ def get_calendar_diaries(uid):
         year = year or now.year
         month = month or now.month
 
+    cache_key = (uid, year, month)
+    etag = _calendar_etag(uid, year, month)
+    if etag in request.if_none_match:
+        return _calendar_response(None, etag, status=304)
+
+    with _calendar_cache_lock:
+        cached = _calendar_cache.get(cache_key)
+        if cached and cached[0] == etag:
+            _calendar_cache.move_to_end(cache_key)
+            return _calendar_response(cached[1], etag)
+
     # Build date range for the month
     start_date = f"{year}-{month:02d}-01"
     if month == 12:
@@ -562,11 +1208,111 @@ def get_calendar_diaries(uid):
             }
         )
 
+    payload = {
+        "year": year,
+        "month": month,
+        "diaries_by_date": diaries_by_date,
+    }
+
+    with _calendar_cache_lock:
+        _calendar_cache[cache_key] = (etag, payload)
+        _calendar_cache.move_to_end(cache_key)
+        while len(_calendar_cache) > CALENDAR_CACHE_SIZE:
+            _calendar_cache.popitem(last=False)
+
+    return _calendar_response(payload, etag)
+
+
+def _calendar_response(payload, etag, status=200):
+    resp = jsonify(payload) if payload is not None else app.response_class()
+    resp.status_code = status
+    resp.set_etag(etag)
+    # Let the browser keep its copy but revalidate on every navigation
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+
+@app.route("/api/users/<uid>/diaries/year")
+def get_year_overview(uid):
+    """
+    Year-at-a-glance data for a heatmap, from a single aggregation.
+
+    Only entry_date, mood and mood_score leave the database. The response is
+    columnar: index i of each array is day i of the year (Jan 1 = 0).
+    """
+    if "user_id" not in session or session["user_id"] != uid:
+        return jsonify({"error": "Forbidden"}), 403
+
+    year = request.args.get("year", type=int)
+    if year is None:
+        year = datetime.now(ZoneInfo("America/New_York")).year
+    # The range query needs Jan 1 of the following year too
+    if not 1 <= year <= 9998:
+        return jsonify({"error": "year must be between 1 and 9998"}), 400
+
+    start = date(year, 1, 1)
+    n_days = (date(year + 1, 1, 1) - start).days
+
+    pipeline = [
+        {
+            "$match": {
+                "user_id": ObjectId(uid),
+                "entry_date": {"$gte": f"{year}-01-01", "$lt": f"{year + 1}-01-01"},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "entry_date": 1,
+                "mood": {"$ifNull": ["$mood", "neutral"]},
+                "mood_score": 1,
+            }
+        },
+        {
+            "$group": {
+                "_id": {"day": "$entry_date", "mood": "$mood"},
+                "n": {"$sum": 1},
+                "score_sum": {"$sum": "$mood_score"},
+                "scored": {"$sum": {"$cond": [{"$isNumber": "$mood_score"}, 1, 0]}},
+            }
+        },
+        # Most frequent mood first within each day
+        {"$sort": {"_id.day": 1, "n": -1, "_id.mood": 1}},
+        {
+            "$group": {
+                "_id": "$_id.day",
+                "count": {"$sum": "$n"},
+                "mood": {"$first": "$_id.mood"},
+                "score_sum": {"$sum": "$score_sum"},
+                "scored": {"$sum": "$scored"},
+            }
+        },
+    ]
+    rows = db.diaries.aggregate(pipeline, hint=[("user_id", 1), ("entry_date", 1)])
+
+    counts = [0] * n_days
+    moods = [None] * n_days
+    avg_scores = [None] * n_days
+    for row in rows:
+        try:
+            i = (datetime.strptime(row["_id"], "%Y-%m-%d").date() - start).days
+        except (TypeError, ValueError):
+            continue
+        if not 0 <= i < n_days:
+            continue
+        counts[i] = row["count"]
+        moods[i] = row["mood"]
+        if row.get("scored"):
+            avg_scores[i] = round(row["score_sum"] / row["scored"], 2)
+
     return jsonify(
         {
             "year": year,
-            "month": month,
-            "diaries_by_date": diaries_by_date,
+            "start": start.isoformat(),
+            "days": n_days,
+            "counts": counts,
+            "moods": moods,
+            "avg_mood_scores": avg_scores,
         }
     )
 
@@ -658,15 +1404,24 @@ def diary_detail(diary_id):
         if "title" in data:
             update_fields["title"] = data["title"]
         if "entry_date" in data:
+            if not _is_entry_date(data["entry_date"]):
+                return jsonify({"error": "entry_date must be YYYY-MM-DD"}), 400
             update_fields["entry_date"] = data["entry_date"]
         if "mood" in data:
             update_fields["mood"] = data["mood"]
+            update_fields["mood_source"] = "user"
         if "mood_score" in data:
             update_fields["mood_score"] = data["mood_score"]
 
         if update_fields:
             db.diaries.update_one({"_id": oid}, {"$set": update_fields})
+            old = dict(doc)
             doc.update(update_fields)
+            if _rollups_differ(old, doc):
+                apply_mood_rollup(old, -1)
+                apply_mood_rollup(doc)
+            else:
+                touch_month(doc)
 
         # Re-fetch for response
         entry_date = doc.get("entry_date") or doc.get("date")
@@ -690,6 +1445,7 @@ def diary_detail(diary_id):
     # DELETE
     if request.method == "DELETE":
         db.diaries.delete_one({"_id": oid})
+        apply_mood_rollup(doc, -1)
         return jsonify({"deleted": True})
 
 
@@ -731,5 +1487,140 @@ def search_diaries(uid):
     return jsonify({"diaries": arr})
 
 
+@app.route("/api/users/<uid>/mood-stats")
+def mood_stats(uid):
+    """
+    Mood trends served straight from the monthly rollups.
+
+    Query params: from / to as "YYYY-MM" (defaults to the last 12 months).
+    Returns monthly and ISO-weekly mood_score averages plus the mood
+    distribution for the range.
+    """
+    if "user_id" not in session or session["user_id"] != uid:
+        return jsonify({"error": "Forbidden"}), 403
+
+    now = datetime.now(ZoneInfo("America/New_York"))
+    end_month = request.args.get("to") or now.strftime("%Y-%m")
+    start_month = request.args.get("from")
+    if not start_month:
+        y, m = now.year, now.month - 11
+        if m < 1:
+            y, m = y - 1, m + 12
+        start_month = f"{y}-{m:02d}"
+
+    try:
+        datetime.strptime(start_month, "%Y-%m")
+        datetime.strptime(end_month, "%Y-%m")
+    except ValueError:
+        return jsonify({"error": "Invalid month, expected YYYY-MM"}), 400
+
+    cur = db.mood_rollups.find(
+        {"user_id": ObjectId(uid), "month": {"$gte": start_month, "$lte": end_month}}
+    ).sort("month", 1)
+
+    months = []
+    weeks = {}
+    totals = {mood: 0 for mood in MOODS}
+    for r in cur:
+        count = r.get("count", 0)
+        if count <= 0:
+            continue
+        moods = {mood: n for mood, n in r.get("moods", {}).items() if n > 0}
+        for mood, n in moods.items():
+            totals[mood] = totals.get(mood, 0) + n
+        months.append(
+            {
+                "month": r["month"],
+                "count": count,
+                "avg_mood_score": round(r.get("score_sum", 0) / count, 2),
+                "moods": moods,
+            }
+        )
+
+        year, month = int(r["month"][:4]), int(r["month"][5:7])
+        for day, bucket in r.get("days", {}).items():
+            if bucket.get("count", 0) <= 0:
+                continue
+            iso_year, iso_week, _ = date(year, month, int(day)).isocalendar()
+            week = weeks.setdefault(
+                f"{iso_year}-W{iso_week:02d}", {"count": 0, "score_sum": 0}
+            )
+            week["count"] += bucket["count"]
+            week["score_sum"] += bucket.get("score_sum", 0)
+
+    return jsonify(
+        {
+            "from": start_month,
+            "to": end_month,
+            "months": months,
+            "weeks": [
+                {
+                    "week": key,
+                    "count": w["count"],
+                    "avg_mood_score": round(w["score_sum"] / w["count"], 2),
+                }
+                for key, w in sorted(weeks.items())
+            ],
+            "moods": totals,
+        }
+    )
+
+
+# ----------------------------
+# CLI jobs
+# ----------------------------
+
+
+@app.cli.command("rebuild-mood-rollups")
+@click.option("--user", "username", default=None, help="Only rebuild this user.")
+def rebuild_mood_rollups_command(username):
+    """Recompute db.mood_rollups from db.diaries."""
+    user_id = None
+    if username:
+        user = db.users.find_one({"username": username})
+        if not user:
+            raise click.ClickException(f"No such user: {username}")
+        user_id = user["_id"]
+    written = rebuild_mood_rollups(user_id)
+    click.echo(f"Wrote {written} mood rollup documents.")
+
+
+@app.cli.command("rescore-moods")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--workers", type=int, default=None, help="Pool size (0 = inline).")
+@click.option("--dry-run", is_flag=True, help="Print diffs without writing.")
+@click.option(
+    "--include-unlabelled",
+    is_flag=True,
+    help="Also re-score diaries saved before mood_source was recorded.",
+)
+@click.option("--restart", is_flag=True, help="Ignore the saved checkpoint.")
+def rescore_moods_command(batch_size, workers, dry_run, include_unlabelled, restart):
+    """Re-score heuristic diary moods after the lexicon changes."""
+    result = rescore_moods(
+        db,
+        batch_size=batch_size,
+        workers=workers,
+        dry_run=dry_run,
+        include_unlabelled=include_unlabelled,
+        restart=restart,
+        echo=click.echo,
+    )
+    click.echo(f"Scanned {result['scanned']} diaries, {result['changed']} changed.")
+    if result["changed"] and not dry_run:
+        written = rebuild_mood_rollups()
+        click.echo(f"Rebuilt {written} mood rollup documents.")
+
+
+@app.cli.command("backfill-entry-dates")
+def backfill_entry_dates_command():
+    """Copy the legacy "date" field into entry_date so indexed queries see it."""
+    result = db.diaries.update_many(
+        {"entry_date": {"$exists": False}, "date": {"$exists": True}},
+        [{"$set": {"entry_date": "$date"}}],
+    )
+    click.echo(f"Backfilled entry_date on {result.modified_count} diaries.")
+
+
 if __name__ == "__main__":
     app.run(debug=True)
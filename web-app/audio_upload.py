@@ -0,0 +1,116 @@
+"""
+Streaming audio uploads: web-app -> ai-service without buffering the file.
+
+The browser posts the recording either as the raw request body
+(Content-Type: audio/*) or as multipart form data with an "audio" field.
+Either way AudioUpload reads it in CHUNK_SIZE pieces:
+
+- the first bytes are sniffed for a known audio container before anything
+  is forwarded (sniff_audio), so non-audio is rejected up front;
+- the running total is checked against the caller's byte cap, and
+  UploadTooLarge is raised as soon as it is exceeded;
+- multipart_body() wraps the chunks in a multipart/form-data envelope for
+  ai-service's "file" field, and requests sends that generator with chunked
+  transfer encoding, so neither process holds the whole upload.
+"""
+
+import uuid
+from typing import Iterable, Iterator, Optional
+
+CHUNK_SIZE = 64 * 1024
+
+# Bytes needed to recognize every container below
+SNIFF_BYTES = 12
+
+
+class UploadRejected(Exception):
+    status = 400
+
+
+class UploadTooLarge(UploadRejected):
+    status = 413
+
+
+class NotAudio(UploadRejected):
+    status = 415
+
+
+def sniff_audio(head: bytes) -> Optional[str]:
+    """Container name for the first bytes of an audio file, or None.
+
+    Kept in sync with ai-service/app/audio_upload.py.
+    """
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm"  # EBML: WebM / Matroska
+    if head[:4] == b"OggS":
+        return "ogg"
+    if head[:4] == b"fLaC":
+        return "flac"
+    if head[4:8] == b"ftyp":
+        return "mp4"  # MP4 / M4A / 3GP
+    if head[:3] == b"ID3":
+        return "mp3"
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        # MPEG audio frame sync; 0xFFF* also covers ADTS AAC
+        return "aac" if head[1] & 0xF6 == 0xF0 else "mp3"
+    return None
+
+
+class AudioUpload:
+    """A size-capped stream of audio chunks whose format was sniffed up front."""
+
+    def __init__(
+        self, stream, filename: Optional[str], content_type: str, max_bytes: int
+    ):
+        self.content_type = content_type
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._stream = stream
+
+        head = b""
+        while len(head) < SNIFF_BYTES:
+            data = stream.read(SNIFF_BYTES - len(head))
+            if not data:
+                break
+            head += data
+        self.format = sniff_audio(head)
+        if self.format is None:
+            raise NotAudio("Uploaded file is not a supported audio format")
+        self.filename = filename or f"audio.{self.format}"
+        self._head = head
+        self._count(len(head))
+
+    def _count(self, n: int):
+        self.size += n
+        if self.size > self.max_bytes:
+            raise UploadTooLarge(
+                f"Audio upload exceeds {self.max_bytes // (1024 * 1024)} MB limit"
+            )
+
+    def chunks(self) -> Iterator[bytes]:
+        yield self._head
+        while True:
+            data = self._stream.read(CHUNK_SIZE)
+            if not data:
+                return
+            self._count(len(data))
+            yield data
+
+
+def multipart_body(field: str, upload: AudioUpload, boundary: str = None):
+    """(content_type, body generator) for a one-file multipart/form-data body."""
+    boundary = boundary or uuid.uuid4().hex
+    filename = upload.filename.replace('"', "")
+
+    def body() -> Iterable[bytes]:
+        yield (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f"Content-Type: {upload.content_type}\r\n\r\n"
+        ).encode()
+        yield from upload.chunks()
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+    return f"multipart/form-data; boundary={boundary}", body()
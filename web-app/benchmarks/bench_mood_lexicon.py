@@ -0,0 +1,60 @@
+"""
+Micro-benchmark: fallback mood scoring cost vs. lexicon size.
+
+Compares the old approach (one str.count() scan of the text per lexicon
+word) with the compiled single-pass MoodLexicon on the same text.
+
+    cd web-app && python benchmarks/bench_mood_lexicon.py
+"""
+
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mood_lexicon import MoodLexicon, load_lexicon  # noqa: E402
+
+SIZES = [23, 230, 2_300, 23_000]
+
+TEXT = (
+    "Today was long. I woke up tired and a bit stressed about the exam, "
+    "but lunch with friends was fun and I didn't feel bad afterwards. "
+    "We talked about a trip next month and I am honestly excited. "
+) * 8  # ~1.5 KB, a long voice diary
+
+
+def _synthetic_words(n, rng):
+    base = dict(load_lexicon().weights)
+    words = dict(list(base.items())[:n])
+    while len(words) < n:
+        w = "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10)))
+        words[w] = rng.choice((-1, 1))
+    return words
+
+
+def legacy_score(words, text):
+    full = text.lower()
+    return sum(full.count(w) * weight for w, weight in words.items())
+
+
+def main():
+    rng = random.Random(0)
+    print(f"text: {len(TEXT)} chars")
+    print(f"{'lexicon':>8} | {'str.count() per word':>21} | {'single pass':>12}")
+    print("-" * 48)
+    for n in SIZES:
+        words = _synthetic_words(n, rng)
+        lexicon = MoodLexicon(words)
+        runs = 200
+        legacy = min(timeit.repeat(lambda: legacy_score(words, TEXT), number=runs, repeat=3))
+        compiled = min(timeit.repeat(lambda: lexicon.analyze(TEXT), number=runs, repeat=3))
+        print(
+            f"{n:>8} | {legacy / runs * 1e6:>18.1f} us | {compiled / runs * 1e6:>9.1f} us"
+        )
+
+
+if __name__ == "__main__":
+    main()
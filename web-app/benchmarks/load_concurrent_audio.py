@@ -0,0 +1,160 @@
+"""
+Load test: do concurrent audio turns serialize in web-app?
+
+N users log in, open a conversation each, and then all post an audio turn
+at the same moment. While those turns wait on ai-service, a probe keeps
+fetching /login. With a single sync worker the turns finish one after
+another (wall time ~ N x turn time) and the probe stalls; with threaded
+workers the wall time stays close to a single turn.
+
+To measure web-app's serving model rather than Whisper/Gemini, start the
+stub ai-service (every call sleeps --delay seconds) and point web-app at it:
+
+    python benchmarks/load_concurrent_audio.py stub --port 8099 --delay 2
+    AI_SERVICE_URL=http://localhost:8099 gunicorn -c gunicorn.conf.py app:app
+    python benchmarks/load_concurrent_audio.py run --base-url http://localhost:5000 -n 8
+
+Compare against the old serving mode (one sync worker; the flags override
+gunicorn.conf.py, which gunicorn also loads from the working directory) with
+    AI_SERVICE_URL=http://localhost:8099 gunicorn -b 0.0.0.0:5000 \
+        --worker-class sync --workers 1 --threads 1 app:app
+"""
+
+import argparse
+import io
+import json
+import struct
+import threading
+import time
+import uuid
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+def _silent_wav(seconds=1.0, rate=16000):
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(struct.pack("<h", 0) * int(seconds * rate))
+    return buf.getvalue()
+
+
+# ---------- stub ai-service ----------
+
+
+def serve_stub(port, delay):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            self.rfile.read(length)
+            time.sleep(delay)
+            if self.path.startswith("/api/transcribe"):
+                body = {"text": "stub transcript"}
+            else:
+                body = {
+                    "reply": "stub reply",
+                    "transcript": "stub transcript",
+                    "messages": [],
+                    "persisted": False,
+                }
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    print(f"stub ai-service on :{port}, {delay}s per call")
+    server.serve_forever()
+
+
+# ---------- load test ----------
+
+
+def _user_session(base_url, name):
+    s = requests.Session()
+    s.post(
+        f"{base_url}/login",
+        data={"username": name, "password": "loadtest"},
+        allow_redirects=False,
+    ).raise_for_status()
+    r = s.post(f"{base_url}/api/conversations", json={})
+    r.raise_for_status()
+    return s, r.json()["conversation_id"]
+
+
+def run(base_url, n, audio):
+    prefix = uuid.uuid4().hex[:8]
+    users = [_user_session(base_url, f"load-{prefix}-{i}") for i in range(n)]
+    start_gate = threading.Barrier(n + 1)
+
+    def turn(user):
+        s, cid = user
+        start_gate.wait()
+        t0 = time.perf_counter()
+        r = s.post(
+            f"{base_url}/api/conversations/{cid}/audio",
+            files={"audio": ("turn.wav", audio, "audio/wav")},
+            timeout=300,
+        )
+        r.raise_for_status()
+        return time.perf_counter() - t0
+
+    probe_times = []
+    done = threading.Event()
+
+    def probe():
+        start_gate.wait()
+        while not done.is_set():
+            t0 = time.perf_counter()
+            requests.get(f"{base_url}/login", timeout=300)
+            probe_times.append(time.perf_counter() - t0)
+            time.sleep(0.1)
+
+    with ThreadPoolExecutor(n + 1) as pool:
+        futures = [pool.submit(turn, u) for u in users]
+        pool.submit(probe)
+        t0 = time.perf_counter()
+        latencies = sorted(f.result() for f in futures)
+        wall = time.perf_counter() - t0
+        done.set()
+
+    print(f"{n} concurrent audio turns")
+    print(f"  wall time        {wall:7.2f} s")
+    print(f"  fastest turn     {latencies[0]:7.2f} s")
+    print(f"  slowest turn     {latencies[-1]:7.2f} s")
+    print(f"  serialization    {wall / latencies[0]:7.2f}x a single turn")
+    if probe_times:
+        print(f"  /login while busy: max {max(probe_times):.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    stub = sub.add_parser("stub", help="run a stub ai-service")
+    stub.add_argument("--port", type=int, default=8099)
+    stub.add_argument("--delay", type=float, default=2.0)
+
+    load = sub.add_parser("run", help="run the load test")
+    load.add_argument("--base-url", default="http://localhost:5000")
+    load.add_argument("-n", "--concurrency", type=int, default=8)
+
+    args = parser.parse_args()
+    if args.cmd == "stub":
+        serve_stub(args.port, args.delay)
+    else:
+        run(args.base_url.rstrip("/"), args.concurrency, _silent_wav())
+
+
+if __name__ == "__main__":
+    main()
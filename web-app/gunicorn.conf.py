@@ -0,0 +1,56 @@
+"""
+Gunicorn settings for web-app (loaded by the Dockerfile's CMD).
+
+web-app spends most of a chat turn waiting on ai-service (up to 60 s for an
+audio turn), so it runs threaded workers: a waiting request holds one
+thread, and the worker's other threads keep serving logins, calendars and
+other users' turns. Total concurrency is workers * threads.
+
+    WEB_CONCURRENCY    worker processes (default: CPU count, at least 2)
+    GUNICORN_THREADS   threads per worker (default 16)
+    GUNICORN_TIMEOUT   seconds before a silent worker is restarted (default
+                       120; must stay above the 60 s ai-service timeout)
+    PROMETHEUS_MULTIPROC_DIR
+                       where workers write their metric samples so /metrics
+                       on any worker reports all of them (default: a
+                       directory under the system temp dir; emptied at
+                       startup)
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", max(2, multiprocessing.cpu_count())))
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = "-"
+# Request time and the X-Request-ID web-app sent upstream, for correlating
+# with ai-service's log lines
+access_log_format = '%(h)s "%(r)s" %(s)s %(b)s %(M)sms rid=%({x-request-id}o)s'
+
+# Set before any worker imports prometheus_client
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "web-app-metrics")
+)
+
+
+def on_starting(server):
+    # Samples left by a previous run would be summed into this one's
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
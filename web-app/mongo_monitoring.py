@@ -0,0 +1,175 @@
+"""
+MongoDB connection pool settings and driver instrumentation.
+
+client_options() turns MONGO_* environment variables into MongoClient
+keyword arguments, including the listeners below:
+
+- CommandTimer records mongo_command_duration_seconds per database,
+  collection and command, and prints a slow-query line for commands slower
+  than MONGO_SLOW_MS.
+- PoolMonitor records how long callers wait to check a connection out of
+  the pool, checkout failures, and open / checked-out connection gauges.
+
+Metrics use prometheus_client; under gunicorn they are aggregated across
+workers (see gunicorn.conf.py). ai-service has the same listeners under
+ai_mongo_* names (ai-service/app/mongo_monitoring.py).
+"""
+
+import os
+import threading
+from typing import Any, Dict, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+from pymongo import monitoring
+
+# env var -> MongoClient option; only variables that are set are passed
+POOL_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": "maxPoolSize",
+    "MONGO_MIN_POOL_SIZE": "minPoolSize",
+    "MONGO_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS",
+    "MONGO_CONNECT_TIMEOUT_MS": "connectTimeoutMS",
+    "MONGO_SOCKET_TIMEOUT_MS": "socketTimeoutMS",
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": "serverSelectionTimeoutMS",
+}
+
+SLOW_MS = float(os.getenv("MONGO_SLOW_MS", "100"))
+
+# Seconds; most commands finish well under prometheus_client's 5 ms bucket
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COMMAND_SECONDS = Histogram(
+    "mongo_command_duration_seconds",
+    "MongoDB command latency as seen by the driver.",
+    ["database", "collection", "command"],
+    buckets=BUCKETS,
+)
+COMMAND_FAILURES = Counter(
+    "mongo_command_failures_total",
+    "MongoDB commands that returned an error.",
+    ["database", "collection", "command"],
+)
+CHECKOUT_WAIT_SECONDS = Histogram(
+    "mongo_pool_checkout_wait_seconds",
+    "Time spent waiting to check a connection out of the pool.",
+    buckets=BUCKETS,
+)
+CHECKOUT_FAILURES = Counter(
+    "mongo_pool_checkout_failures_total",
+    "Connection checkouts that failed, by reason.",
+    ["reason"],
+)
+CONNECTIONS_OPEN = Gauge(
+    "mongo_pool_connections_open",
+    "Connections currently open in the pool.",
+    multiprocess_mode="livesum",
+)
+CONNECTIONS_CHECKED_OUT = Gauge(
+    "mongo_pool_connections_checked_out",
+    "Connections currently checked out of the pool.",
+    multiprocess_mode="livesum",
+)
+
+# Commands whose first value isn't a collection name
+_NO_COLLECTION = {"getMore": "collection"}
+
+
+def _collection_of(command: Dict[str, Any]) -> str:
+    if not command:
+        return ""
+    name = next(iter(command))
+    if name in _NO_COLLECTION:
+        value = command.get(_NO_COLLECTION[name])
+    else:
+        value = command[name]
+    return value if isinstance(value, str) else ""
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Times every command; succeeded/failed events don't carry the command
+    body, so the collection is remembered from the started event."""
+
+    def __init__(self, slow_ms: float = SLOW_MS):
+        self.slow_ms = slow_ms
+        self._pending: Dict[Tuple[Any, int], Tuple[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        key = (event.connection_id, event.request_id)
+        with self._lock:
+            self._pending[key] = (event.database_name, _collection_of(event.command))
+
+    def _finish(self, event):
+        with self._lock:
+            database, collection = self._pending.pop(
+                (event.connection_id, event.request_id),
+                (event.database_name, ""),
+            )
+        labels = dict(
+            database=database, collection=collection, command=event.command_name
+        )
+        COMMAND_SECONDS.labels(**labels).observe(event.duration_micros / 1e6)
+        return labels
+
+    def succeeded(self, event):
+        labels = self._finish(event)
+        ms = event.duration_micros / 1000
+        if ms >= self.slow_ms:
+            print(
+                f"Slow MongoDB command: {labels['command']} "
+                f"{labels['database']}.{labels['collection']} took {ms:.1f} ms"
+            )
+
+    def failed(self, event):
+        labels = self._finish(event)
+        COMMAND_FAILURES.labels(**labels).inc()
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        CONNECTIONS_OPEN.inc()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        CONNECTIONS_OPEN.dec()
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        if event.duration is not None:
+            CHECKOUT_WAIT_SECONDS.observe(event.duration)
+        CHECKOUT_FAILURES.labels(reason=event.reason).inc()
+
+    def connection_checked_out(self, event):
+        if event.duration is not None:
+            CHECKOUT_WAIT_SECONDS.observe(event.duration)
+        CONNECTIONS_CHECKED_OUT.inc()
+
+    def connection_checked_in(self, event):
+        CONNECTIONS_CHECKED_OUT.dec()
+
+
+def client_options() -> Dict[str, Any]:
+    """Keyword arguments for MongoClient / AsyncMongoClient."""
+    options: Dict[str, Any] = {}
+    for env, option in POOL_OPTIONS.items():
+        value = os.getenv(env)
+        if value:
+            options[option] = int(value)
+    options["event_listeners"] = [CommandTimer(), PoolMonitor()]
+    return options
@@ -0,0 +1,154 @@
+"""
+Lexicon-based mood scoring used when ai-service is unavailable.
+
+The lexicon (weighted words, negators, title rules) lives in
+data/mood_lexicon.json and is compiled once into plain dict lookups, so
+scoring a text is a single pass over its tokens no matter how large the
+lexicon grows.
+
+app.py also sends each text chat message's mood (message_mood) to ai-service,
+which picks its local reply by it when Gemini is slow, so the lexicon only
+lives here.
+"""
+
+from functools import lru_cache
+import json
+import os
+import re
+
+DEFAULT_LEXICON_PATH = os.environ.get(
+    "MOOD_LEXICON_PATH",
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "data", "mood_lexicon.json"
+    ),
+)
+
+# Words (with an optional apostrophe part, e.g. "didn't") and clause breaks
+_TOKEN_RE = re.compile(r"[a-z]+(?:'[a-z]+)?|[.!?;,]")
+_CLAUSE_BREAKS = frozenset(".!?;,")
+
+
+def tokenize(text):
+    """Lowercase and split text into word and clause-break tokens."""
+    return _TOKEN_RE.findall(text.lower().replace("’", "'"))
+
+
+class MoodLexicon:
+    def __init__(self, words, negators=(), negation_window=3, titles=()):
+        """
+        Args:
+            words: {word: weight}, positive weights for positive words
+            negators: words that flip the sign of the next few scored words
+            negation_window: how many tokens a negator reaches
+            titles: ordered [(title, [trigger words])], first matching rule wins
+        """
+        self.weights = {w.lower(): weight for w, weight in words.items()}
+        self.negators = frozenset(n.lower() for n in negators)
+        self.negation_window = negation_window
+        self.titles = [title for title, _ in titles]
+
+        # token -> index of the highest-priority title rule it triggers
+        self.title_index = {}
+        for i, (_, triggers) in enumerate(titles):
+            for w in triggers:
+                self.title_index.setdefault(w.lower(), i)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(
+            words=data["words"],
+            negators=data.get("negators", []),
+            negation_window=data.get("negation_window", 3),
+            titles=[(t["title"], t["words"]) for t in data.get("titles", [])],
+        )
+
+    def analyze(self, text):
+        """
+        Score text in one pass over its tokens.
+
+        Returns (score, title_rule) where title_rule is the matched rule's
+        title or None.
+        """
+        weights = self.weights
+        negators = self.negators
+        title_index = self.title_index
+
+        score = 0
+        best_rule = len(self.titles)
+        negated_for = 0
+
+        for tok in tokenize(text):
+            if tok in _CLAUSE_BREAKS:
+                negated_for = 0
+                continue
+
+            w = weights.get(tok)
+            if w is not None:
+                score += -w if negated_for else w
+            elif tok in negators:
+                negated_for = self.negation_window + 1
+
+            rule = title_index.get(tok)
+            if rule is not None and rule < best_rule:
+                best_rule = rule
+
+            if negated_for:
+                negated_for -= 1
+
+        title = self.titles[best_rule] if best_rule < len(self.titles) else None
+        return score, title
+
+
+@lru_cache(maxsize=None)
+def load_lexicon(path=DEFAULT_LEXICON_PATH):
+    """Load and compile a lexicon file (cached per path)."""
+    return MoodLexicon.from_file(path)
+
+
+def message_mood(text):
+    """Mood of one chat message. A single message carries little signal, so
+    any lean counts (the diary below needs more than +-1 over the day)."""
+    score, _ = load_lexicon().analyze(text)
+    if score > 0:
+        return "positive"
+    if score < 0:
+        return "negative"
+    return "neutral"
+
+
+def analyze_mood_and_summary(user_texts):
+    """Heuristic title / summary / mood for a list of user messages."""
+    full = " ".join(user_texts)
+    score, title_rule = load_lexicon().analyze(full)
+
+    if score > 1:
+        mood = "positive"
+    elif score < -1:
+        mood = "negative"
+    else:
+        mood = "neutral"
+
+    if user_texts:
+        summary = user_texts[0].strip()
+        if len(summary) > 220:
+            summary = summary[:217] + "..."
+    else:
+        summary = "You had a short conversation with your AI diary today."
+
+    if title_rule:
+        title = title_rule
+    elif mood == "positive":
+        title = "A good day"
+    elif mood == "negative":
+        title = "A tough day"
+    else:
+        title = "A regular day"
+
+    return {
+        "title": title,
+        "summary": summary,
+        "mood": mood,
+        "mood_score": score,
+    }
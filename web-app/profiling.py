@@ -0,0 +1,127 @@
+"""
+Opt-in per-request cProfile.
+
+Disabled unless PROFILE_TOKEN or PROFILE_SAMPLE_RATE is set; app.py only
+wraps the WSGI app in ProfileRequests when ENABLED is true, so a disabled
+profiler costs nothing per request.
+
+A request is profiled when it carries ``X-Profile: <PROFILE_TOKEN>`` or is
+picked by PROFILE_SAMPLE_RATE (0-1). Only one request is profiled at a time
+per process; others run normally. The profiling itself is Werkzeug's
+ProfilerMiddleware (cProfile on the request's thread). Profiles are written
+to PROFILE_DIR as <request id>.prof (the newest PROFILE_KEEP are kept, open
+with pstats or snakeviz), named in the X-Profile-Id response header, and can
+be downloaded from /debug/profiles/<id> with the same X-Profile header.
+
+ai-service takes the same variables, header and endpoints but samples the
+stacks of all threads instead (ai-service/app/profiling.py), because its
+time is spent in thread pools a cProfile wouldn't see.
+"""
+
+import hmac
+import os
+import random
+import re
+import tempfile
+import threading
+import uuid
+from typing import List, Optional
+
+from werkzeug.middleware.profiler import ProfilerMiddleware
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+TOKEN = os.getenv("PROFILE_TOKEN", "")
+SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR") or os.path.join(
+    tempfile.gettempdir(), "profiles"
+)
+KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+
+ENABLED = bool(TOKEN) or SAMPLE_RATE > 0
+
+_NAME_RE = re.compile(r"^[A-Za-z0-9._-]{1,64}\.prof$")
+
+# Python allows one cProfile per thread (one per process from 3.12)
+_busy = threading.Lock()
+
+# environ key holding the profile's file name once the response has started
+_NAME_KEY = "profiling.name"
+
+
+def authorized(header_value: Optional[str]) -> bool:
+    return bool(TOKEN) and hmac.compare_digest(header_value or "", TOKEN)
+
+
+def wanted(header_value: Optional[str]) -> bool:
+    """Should this request be profiled?"""
+    if authorized(header_value):
+        return True
+    return SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE
+
+
+class ProfileRequests:
+    """WSGI middleware running the requests picked by wanted() under cProfile."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        # Downloads carry the token too; don't let them overwrite the profile
+        if environ.get("PATH_INFO", "").startswith("/debug/profiles"):
+            return self.app(environ, start_response)
+        if not wanted(environ.get("HTTP_X_PROFILE")):
+            return self.app(environ, start_response)
+        if not _busy.acquire(blocking=False):
+            return self.app(environ, start_response)
+
+        def named_start_response(status, headers, exc_info=None):
+            # Named after the X-Request-ID app.py puts on every response
+            rid = next(
+                (v for k, v in headers if k.lower() == "x-request-id"),
+                uuid.uuid4().hex,
+            )
+            environ[_NAME_KEY] = f"{rid}.prof"
+            headers.append((PROFILE_ID_HEADER, environ[_NAME_KEY]))
+            return start_response(status, headers, exc_info)
+
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiled = ProfilerMiddleware(
+                self.app,
+                stream=None,
+                profile_dir=PROFILE_DIR,
+                filename_format=lambda env: env[_NAME_KEY],
+            )
+            return profiled(environ, named_start_response)
+        finally:
+            _busy.release()
+            _prune()
+
+
+def _prune():
+    names = list_profiles()
+    for name in names[KEEP:]:
+        try:
+            os.unlink(os.path.join(PROFILE_DIR, name))
+        except OSError:
+            pass
+
+
+def list_profiles() -> List[str]:
+    """Saved profile names, newest first."""
+    try:
+        entries = [e for e in os.scandir(PROFILE_DIR) if _NAME_RE.match(e.name)]
+    except FileNotFoundError:
+        return []
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    return [e.name for e in entries]
+
+
+def profile_path(name: str) -> Optional[str]:
+    """Path of a saved profile, or None for unknown / malformed names."""
+    if not _NAME_RE.match(name):
+        return None
+    path = os.path.join(PROFILE_DIR, name)
+    return path if os.path.isfile(path) else None
@@ -0,0 +1,190 @@
+"""
+Offline job: re-score diary moods with the current fallback heuristic.
+
+Diaries are read in _id order with keyset pagination (one short query per
+batch, no long-lived cursor), scored on a process pool, and written back
+with unordered bulk writes. Progress is checkpointed in
+db.job_checkpoints after every batch, so an interrupted run resumes where
+it stopped. Only a bounded number of batches is ever in memory.
+
+Run through the Flask CLI:  flask --app app rescore-moods --help
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import os
+
+from pymongo import UpdateOne
+
+from mood_lexicon import analyze_mood_and_summary
+
+JOB_ID = "rescore_moods"
+
+# Only diaries whose mood came from the heuristic are re-scored by default;
+# AI- and user-chosen moods are never overwritten.
+DEFAULT_SOURCES = ("lexicon",)
+
+_PROJECTION = {"_id": 1, "content": 1, "mood": 1, "mood_score": 1}
+
+
+def score_batch(docs):
+    """
+    Re-score one batch. Runs in a pool worker, so it only gets plain tuples.
+
+    Args:
+        docs: [(diary_id, content, old_mood, old_score)]
+    Returns:
+        [(diary_id, old_mood, old_score, new_mood, new_score)] for the
+        diaries whose mood or score changed
+    """
+    changed = []
+    for diary_id, content, old_mood, old_score in docs:
+        analysis = analyze_mood_and_summary([content] if content else [])
+        if analysis["mood"] != old_mood or analysis["mood_score"] != old_score:
+            changed.append(
+                (
+                    diary_id,
+                    old_mood,
+                    old_score,
+                    analysis["mood"],
+                    analysis["mood_score"],
+                )
+            )
+    return changed
+
+
+def _batches(diaries, flt, batch_size, after_id):
+    while True:
+        page = dict(flt)
+        if after_id is not None:
+            page["_id"] = {"$gt": after_id}
+        docs = list(diaries.find(page, _PROJECTION).sort("_id", 1).limit(batch_size))
+        if not docs:
+            return
+        after_id = docs[-1]["_id"]
+        yield after_id, [
+            (d["_id"], d.get("content", ""), d.get("mood"), d.get("mood_score"))
+            for d in docs
+        ]
+
+
+class _InlineExecutor:
+    """Stand-in for a process pool when workers=0 (debugging, tests)."""
+
+    class _Done:
+        def __init__(self, value):
+            self._value = value
+
+        def result(self):
+            return self._value
+
+    def submit(self, fn, *args):
+        return self._Done(fn(*args))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def rescore_moods(
+    db,
+    batch_size=500,
+    workers=None,
+    dry_run=False,
+    sources=DEFAULT_SOURCES,
+    include_unlabelled=False,
+    restart=False,
+    echo=print,
+):
+    """
+    Re-score diaries and write back changed moods.
+
+    Args:
+        db: the diary_db database
+        batch_size: diaries per query / bulk write
+        workers: pool size (None = CPU count, 0 = score inline)
+        dry_run: print the diffs instead of writing; checkpoint untouched
+        sources: mood_source values eligible for re-scoring
+        include_unlabelled: also re-score diaries saved before mood_source existed
+        restart: ignore any saved checkpoint
+        echo: output function for progress and diffs
+    Returns:
+        {"scanned": n, "changed": n}
+    """
+    allowed = [{"mood_source": {"$in": list(sources)}}]
+    if include_unlabelled:
+        # Matches both a missing field and an explicit null
+        allowed.append({"mood_source": None})
+    flt = {"$or": allowed}
+
+    checkpoint = (
+        None if (restart or dry_run) else db.job_checkpoints.find_one({"_id": JOB_ID})
+    )
+    after_id = checkpoint.get("last_id") if checkpoint else None
+    scanned = checkpoint.get("scanned", 0) if checkpoint else 0
+    changed = checkpoint.get("changed", 0) if checkpoint else 0
+    if after_id is not None:
+        echo(f"Resuming after {after_id} ({scanned} already scanned)")
+
+    executor = _InlineExecutor() if workers == 0 else ProcessPoolExecutor(workers)
+    # Keep every worker busy while the next batch is fetched, but no more
+    max_in_flight = 1 if workers == 0 else 2 * (workers or os.cpu_count() or 1)
+
+    with executor:
+        pending = deque()
+        batches = _batches(db.diaries, flt, batch_size, after_id)
+
+        def drain_one():
+            nonlocal scanned, changed
+            last_id, n_docs, future = pending.popleft()
+            diffs = future.result()
+            scanned += n_docs
+            changed += len(diffs)
+
+            if dry_run:
+                for diary_id, old_mood, old_score, new_mood, new_score in diffs:
+                    echo(
+                        f"{diary_id}: {old_mood} ({old_score}) -> {new_mood} ({new_score})"
+                    )
+                return
+
+            if diffs:
+                db.diaries.bulk_write(
+                    [
+                        UpdateOne(
+                            {"_id": diary_id},
+                            {"$set": {"mood": new_mood, "mood_score": new_score}},
+                        )
+                        for diary_id, _, _, new_mood, new_score in diffs
+                    ],
+                    ordered=False,
+                )
+            # Batches are drained in order, so last_id is a safe resume point
+            db.job_checkpoints.update_one(
+                {"_id": JOB_ID},
+                {
+                    "$set": {
+                        "last_id": last_id,
+                        "scanned": scanned,
+                        "changed": changed,
+                        "updated_at": datetime.utcnow(),
+                    }
+                },
+                upsert=True,
+            )
+            echo(f"scanned {scanned}, changed {changed}")
+
+        for last_id, docs in batches:
+            pending.append((last_id, len(docs), executor.submit(score_batch, docs)))
+            if len(pending) >= max_in_flight:
+                drain_one()
+        while pending:
+            drain_one()
+
+    if not dry_run:
+        # A finished run starts from the beginning next time
+        db.job_checkpoints.delete_one({"_id": JOB_ID})
+    return {"scanned": scanned, "changed": changed}
@@ -163,14 +163,21 @@ function stopVoiceInput() {
     }
 }
 
+// Recordings are sent as the raw request body so web-app can stream them
+// on to ai-service without parsing a multipart form first.
+function audioHeaders(blob, filename) {
+    return {
+        "Content-Type": blob.type || "audio/webm",
+        "X-Filename": filename,
+    };
+}
+
 async function transcribeVoiceInput(blob) {
     try {
-        const fd = new FormData();
-        fd.append("audio", blob, "voice-input.webm");
-
         const res = await fetch("/api/transcribe", {
             method: "POST",
-            body: fd,
+            headers: audioHeaders(blob, "voice-input.webm"),
+            body: blob,
         });
 
         if (res.status === 401) {
@@ -282,14 +289,12 @@ async function sendAudioMessage(blob) {
     setConversationStatus("Sending audio...");
 
     try {
-        const fd = new FormData();
-        fd.append("audio", blob, "audio.webm");
-
         const res = await fetch(
             `/api/conversations/${currentConversationId}/audio`,
             {
                 method: "POST",
-                body: fd,
+                headers: audioHeaders(blob, "audio.webm"),
+                body: blob,
             }
         );
 
@@ -371,6 +376,48 @@ function stopRecording() {
     }
 }
 
+// Diary generation runs as a server-side job: POST .../complete queues it,
+// then poll the job until the preview is ready. Returns null on 401.
+async function requestDiaryPreview(body) {
+    const res = await fetch(
+        `/api/conversations/${currentConversationId}/complete`,
+        {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify(body)
+        }
+    );
+
+    if (res.status === 401) {
+        window.location.href = "/login";
+        return null;
+    }
+    if (!res.ok) {
+        throw new Error("HTTP " + res.status);
+    }
+
+    const { job_id } = await res.json();
+    const deadline = Date.now() + 120000;
+
+    while (Date.now() < deadline) {
+        await new Promise((resolve) => setTimeout(resolve, 1000));
+
+        const poll = await fetch(`/api/diary-jobs/${job_id}`);
+        if (poll.status === 401) {
+            window.location.href = "/login";
+            return null;
+        }
+        if (!poll.ok) {
+            throw new Error("HTTP " + poll.status);
+        }
+
+        const job = await poll.json();
+        if (job.status === "done") return job.result;
+        if (job.status === "failed") throw new Error(job.error);
+    }
+    throw new Error("Diary generation timed out");
+}
+
 async function completeConversation() {
     if (!currentConversationId) {
         setConversationStatus("No active conversation.");
@@ -389,24 +436,8 @@ async function completeConversation() {
             if (diaryPreferences.custom_instructions) body.preferences.custom_instructions = diaryPreferences.custom_instructions;
         }
 
-        const res = await fetch(
-            `/api/conversations/${currentConversationId}/complete`,
-            { 
-                method: "POST",
-                headers: { "Content-Type": "application/json" },
-                body: JSON.stringify(body)
-            }
-        );
-
-        if (res.status === 401) {
-            window.location.href = "/login";
-            return;
-        }
-        if (!res.ok) {
-            throw new Error("HTTP " + res.status);
-        }
-
-        const data = await res.json();
+        const data = await requestDiaryPreview(body);
+        if (!data) return;
 
         // Store the generated diary for editing
         generatedDiary = {
@@ -416,6 +447,7 @@ async function completeConversation() {
             summary: data.summary,
             mood: data.mood,
             mood_score: data.mood_score,
+            mood_source: data.mood_source,
             suggested_date: data.suggested_date,
         };
 
@@ -500,24 +532,8 @@ async function regenerateDiary() {
             body.preferences.custom_instructions = customInstr;
         }
 
-        const res = await fetch(
-            `/api/conversations/${currentConversationId}/complete`,
-            { 
-                method: "POST",
-                headers: { "Content-Type": "application/json" },
-                body: JSON.stringify(body)
-            }
-        );
-
-        if (res.status === 401) {
-            window.location.href = "/login";
-            return;
-        }
-        if (!res.ok) {
-            throw new Error("HTTP " + res.status);
-        }
-
-        const data = await res.json();
+        const data = await requestDiaryPreview(body);
+        if (!data) return;
 
         // Update stored diary
         generatedDiary = {
@@ -527,6 +543,7 @@ async function regenerateDiary() {
             summary: data.summary,
             mood: data.mood,
             mood_score: data.mood_score,
+            mood_source: data.mood_source,
             suggested_date: data.suggested_date,
         };
 
@@ -579,6 +596,7 @@ async function saveDiary() {
                     content: content,
                     mood: mood,
                     mood_score: generatedDiary.mood_score || 0,
+                    mood_source: mood === generatedDiary.mood ? generatedDiary.mood_source : "user",
                     entry_date: entryDate,
                 }),
             }
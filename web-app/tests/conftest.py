@@ -31,9 +31,20 @@ class FakeCursor:
 class FakeCollection:
     def __init__(self):
         self.docs = []
+        # aggregate() can't evaluate pipelines; tests set the rows it returns
+        self.aggregate_result = []
+        self.aggregate_calls = []
+        self.bulk_write_calls = []
 
     # ---- helpers ----
     def _match_simple(self, doc, key, value):
+        if "." in key:
+            # Dotted path into an array of subdocuments, e.g. "messages.turn_id"
+            field, sub = key.split(".", 1)
+            values = [m.get(sub) for m in doc.get(field) or [] if isinstance(m, dict)]
+            if isinstance(value, dict) and "$ne" in value:
+                return value["$ne"] not in values
+            return value in values
         # Handle comparison operators
         if isinstance(value, dict):
             doc_val = doc.get(key)
@@ -73,9 +84,21 @@ class FakeCollection:
             if "$ne" in value:
                 if doc_val == value["$ne"]:
                     return False
+
+            if "$in" in value:
+                if doc_val not in value["$in"]:
+                    return False
+
+            if "$nin" in value:
+                if doc_val in value["$nin"]:
+                    return False
+
+            if "$exists" in value:
+                if (key in doc) != value["$exists"]:
+                    return False
             
             # If we had operators and all passed
-            if any(op in value for op in ["$gte", "$gt", "$lte", "$lt", "$ne"]):
+            if any(op in value for op in ["$gte", "$gt", "$lte", "$lt", "$ne", "$in", "$nin", "$exists"]):
                 return True
         
         return doc.get(key) == value
@@ -97,22 +120,41 @@ class FakeCollection:
         self.docs.append(doc.copy())
         return SimpleNamespace(inserted_id=doc["_id"])
 
-    def find_one(self, flt):
+    def insert_many(self, docs):
+        ids = [self.insert_one(d).inserted_id for d in docs]
+        return SimpleNamespace(inserted_ids=ids)
+
+    def create_index(self, keys, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        return "_".join(f"{k}_{v}" for k, v in keys)
+
+    def find_one(self, flt, projection=None):
         for d in self.docs:
             if self._matches_filter(d, flt):
                 return d.copy()
         return None
 
-    def find(self, flt):
-        matched = [d for d in self.docs if self._matches_filter(d, flt)]
+    def find(self, flt=None, projection=None):
+        matched = [d for d in self.docs if self._matches_filter(d, flt or {})]
         return FakeCursor(matched)
 
+    @staticmethod
+    def _inc_path(doc, path, amount):
+        *parents, leaf = path.split(".")
+        for p in parents:
+            doc = doc.setdefault(p, {})
+        doc[leaf] = doc.get(leaf, 0) + amount
+
     def update_one(self, flt, update, upsert=False):
         for d in self.docs:
             if self._matches_filter(d, flt):
                 if "$set" in update:
                     for k, v in update["$set"].items():
                         d[k] = v
+                if "$inc" in update:
+                    for k, v in update["$inc"].items():
+                        self._inc_path(d, k, v)
                 if "$push" in update:
                     for k, v in update["$push"].items():
                         if isinstance(v, dict) and "$each" in v:
@@ -121,7 +163,50 @@ class FakeCollection:
                         else:
                             d.setdefault(k, [])
                             d[k].append(v)
-                return
+                return SimpleNamespace(matched_count=1, modified_count=1)
+        if upsert:
+            doc = {k: v for k, v in flt.items() if not k.startswith("$")}
+            self.insert_one(doc)
+            self.update_one({"_id": doc["_id"]}, update)
+        return SimpleNamespace(matched_count=0, modified_count=0)
+
+    def replace_one(self, flt, replacement, upsert=False):
+        for i, d in enumerate(self.docs):
+            if self._matches_filter(d, flt):
+                self.docs[i] = dict(replacement, _id=d["_id"])
+                return SimpleNamespace(matched_count=1, modified_count=1)
+        if upsert:
+            self.insert_one(dict(replacement))
+        return SimpleNamespace(matched_count=0, modified_count=0)
+
+    def find_one_and_update(
+        self, flt, update, projection=None, upsert=False, return_document=False
+    ):
+        for d in self.docs:
+            if self._matches_filter(d, flt):
+                before = d.copy()
+                self.update_one({"_id": d["_id"]}, update)
+                # ReturnDocument.AFTER is True
+                return d.copy() if return_document else before
+        return None
+
+    def update_many(self, flt, update):
+        # Only the aggregation-pipeline form used by the backfill job
+        matched = [d for d in self.docs if self._matches_filter(d, flt)]
+        for d in matched:
+            for stage in update:
+                for k, v in stage["$set"].items():
+                    d[k] = d.get(v[1:]) if isinstance(v, str) and v.startswith("$") else v
+        return SimpleNamespace(modified_count=len(matched))
+
+    def bulk_write(self, requests, ordered=True):
+        self.bulk_write_calls.append((len(requests), ordered))
+        for op in requests:
+            if any(k.startswith("$") for k in op._doc):
+                self.update_one(op._filter, op._doc, upsert=op._upsert)
+            else:
+                self.replace_one(op._filter, op._doc, upsert=op._upsert)
+        return SimpleNamespace(modified_count=len(requests))
 
     def delete_one(self, flt):
         for i, d in enumerate(self.docs):
@@ -129,6 +214,15 @@ class FakeCollection:
                 del self.docs[i]
                 return
 
+    def delete_many(self, flt):
+        before = len(self.docs)
+        self.docs = [d for d in self.docs if not self._matches_filter(d, flt)]
+        return SimpleNamespace(deleted_count=before - len(self.docs))
+
+    def aggregate(self, pipeline, **kwargs):
+        self.aggregate_calls.append((pipeline, kwargs))
+        return iter([r.copy() for r in self.aggregate_result])
+
     def count_documents(self, flt):
         return sum(1 for d in self.docs if self._matches_filter(d, flt))
 
@@ -139,6 +233,17 @@ class FakeDB:
         self.users = FakeCollection()
         self.conversations = FakeCollection()
         self.diaries = FakeCollection()
+        self.mood_rollups = FakeCollection()
+        self.job_checkpoints = FakeCollection()
+        self.diary_jobs = FakeCollection()
+
+
+class InlineExecutor:
+    """Runs submitted work immediately, so background jobs finish before the
+    request that queued them returns."""
+
+    def submit(self, fn, *args, **kwargs):
+        fn(*args, **kwargs)
 
 
 @pytest.fixture
@@ -151,11 +256,13 @@ def fake_db(monkeypatch):
 
 
 @pytest.fixture
-def app(fake_db): 
+def app(fake_db, monkeypatch):
+    monkeypatch.setattr(webapp, "_diary_executor", InlineExecutor())
     webapp.app.config.update(
         TESTING=True,
         SECRET_KEY="test-secret-key",
     )
+    webapp.clear_calendar_cache()
     return webapp.app
 
 
@@ -2,8 +2,16 @@ from types import SimpleNamespace
 from datetime import datetime
 from io import BytesIO
 from bson import ObjectId
+import os
+import subprocess
+import sys
+import time
 
 import app as webapp
+import audio_upload
+
+# Smallest thing that sniffs as audio: a RIFF/WAVE header
+WAV = b"RIFF\x24\x00\x00\x00WAVEfmt " + b"\x00" * 32
 
 
 # --------- unit test: analyze_mood_and_summary ---------
@@ -86,6 +94,56 @@ def test_logout_clears_session(client, login_user):
     assert "/login" in res2.headers["Location"]
 
 
+def test_metrics_endpoint_serves_prometheus_text(client):
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/plain"
+    body = resp.get_data(as_text=True)
+    assert "# TYPE mongo_command_duration_seconds histogram" in body
+    assert "# TYPE mongo_pool_checkout_wait_seconds histogram" in body
+
+
+def test_metrics_endpoint_sums_worker_processes(client, tmp_path, monkeypatch):
+    # Two "workers" each count a failed find; any worker's /metrics sees both
+    worker = (
+        "from prometheus_client import Counter; "
+        "Counter('mongo_command_failures', '', ['database', 'collection', 'command'])"
+        ".labels('diary_db', 'diaries', 'find').inc()"
+    )
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}
+    for _ in range(2):
+        subprocess.run([sys.executable, "-c", worker], env=env, check=True)
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+
+    body = client.get("/metrics").get_data(as_text=True)
+
+    assert (
+        'mongo_command_failures_total{collection="diaries",command="find",'
+        'database="diary_db"} 2.0' in body
+    )
+
+
+def test_profiled_request_can_be_downloaded(app, client, tmp_path, monkeypatch):
+    monkeypatch.setattr(webapp.profiling, "TOKEN", "s3cret")
+    monkeypatch.setattr(webapp.profiling, "PROFILE_DIR", str(tmp_path))
+    headers = {"X-Profile": "s3cret", "X-Request-ID": "slow-1"}
+
+    # The middleware is only installed when profiling is configured at startup
+    monkeypatch.setattr(app, "wsgi_app", webapp.profiling.ProfileRequests(app.wsgi_app))
+
+    resp = client.get("/login", headers=headers)
+    assert resp.headers["X-Profile-Id"] == "slow-1.prof"
+    assert "X-Profile-Id" not in client.get("/login").headers
+
+    assert client.get("/debug/profiles").status_code == 404
+    listing = client.get("/debug/profiles", headers=headers).get_json()
+    assert listing == {"profiles": ["slow-1.prof"]}
+    res = client.get("/debug/profiles/slow-1.prof", headers=headers)
+    assert res.status_code == 200
+    assert res.data == (tmp_path / "slow-1.prof").read_bytes()
+    assert client.get("/debug/profiles/..%2Fapp.py", headers=headers).status_code == 404
+
+
 # --------- conversations ---------
 
 
@@ -141,10 +199,12 @@ def test_add_message_success(client, fake_db, login_user, monkeypatch):
         def json(self):
             return {"reply": "AI reply"}
 
-    def fake_post(url, json=None, timeout=None):
+    def fake_post(url, json=None, headers=None, timeout=None):
         assert "/api/chat" in url
         assert json["user_id"] == str(user_id)
         assert json["text"] == "hi"
+        assert json["conversation_id"] == str(cid)
+        assert json["mood"] == "neutral"
         return FakeResp()
 
     monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
@@ -164,6 +224,182 @@ def test_add_message_success(client, fake_db, login_user, monkeypatch):
     assert conv["messages"][1]["role"] == "ai"
 
 
+def test_add_message_not_written_twice_when_ai_service_persisted(
+    client, fake_db, login_user, monkeypatch
+):
+    user_id = login_user()
+    cid = fake_db.conversations.insert_one(
+        {
+            "user_id": user_id,
+            "created_at": datetime.utcnow(),
+            "messages": [],
+            "status": "active",
+        }
+    ).inserted_id
+
+    class FakeResp:
+        status_code = 200
+        text = "ok"
+
+        def json(self):
+            # ai-service wrote the turn to the shared conversation itself
+            fake_db.conversations.update_one(
+                {"_id": cid},
+                {"$push": {"messages": {"$each": [{"role": "user"}, {"role": "ai"}]}}},
+            )
+            return {"reply": "AI reply", "persisted": True}
+
+    monkeypatch.setattr(
+        webapp, "requests", SimpleNamespace(post=lambda *a, **k: FakeResp())
+    )
+
+    res = client.post(f"/api/conversations/{cid}/messages", json={"text": "hi"})
+    assert res.status_code == 200
+    assert res.get_json()["ai_response"] == "AI reply"
+
+    conv = fake_db.conversations.find_one({"_id": cid})
+    assert len(conv["messages"]) == 2
+
+
+def test_add_message_timeout_after_ai_service_stored_turn(
+    client, fake_db, login_user, monkeypatch
+):
+    user_id = login_user()
+    cid = fake_db.conversations.insert_one(
+        {
+            "user_id": user_id,
+            "created_at": datetime.utcnow(),
+            "messages": [],
+            "status": "active",
+        }
+    ).inserted_id
+
+    def fake_post(url, json=None, headers=None, timeout=None):
+        # ai-service stores the turn under web-app's turn ID, then we time out
+        turn = json["turn_id"]
+        fake_db.conversations.update_one(
+            {"_id": cid},
+            {
+                "$push": {
+                    "messages": {
+                        "$each": [
+                            {"role": "user", "text": "hi", "turn_id": turn},
+                            {"role": "ai", "text": "Gemini reply", "turn_id": turn},
+                        ]
+                    }
+                }
+            },
+        )
+        raise TimeoutError("read timed out")
+
+    monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
+
+    res = client.post(
+        f"/api/conversations/{cid}/messages",
+        json={"text": "hi"},
+        headers={"X-Request-ID": "turn-42"},
+    )
+    assert res.status_code == 200
+    # The stored reply is shown instead of the fallback, and not stored twice
+    assert res.get_json()["ai_response"] == "Gemini reply"
+    conv = fake_db.conversations.find_one({"_id": cid})
+    assert [m["text"] for m in conv["messages"]] == ["hi", "Gemini reply"]
+
+
+def test_turns_sharing_a_request_id_are_both_stored(
+    client, fake_db, login_user, monkeypatch
+):
+    user_id = login_user()
+    cid = fake_db.conversations.insert_one(
+        {"user_id": user_id, "messages": [], "status": "active"}
+    ).inserted_id
+    turn_ids = []
+
+    def fake_post(url, json=None, headers=None, timeout=None):
+        turn_ids.append(json["turn_id"])
+        raise ConnectionError("ai-service down")
+
+    monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
+
+    for text in ("first message", "second message"):
+        res = client.post(
+            f"/api/conversations/{cid}/messages",
+            json={"text": text},
+            headers={"X-Request-ID": "fixed"},
+        )
+        assert res.get_json()["user_message"] == text
+
+    # The client's request ID is for logs only; each turn gets its own ID
+    assert turn_ids[0] != turn_ids[1]
+    conv = fake_db.conversations.find_one({"_id": cid})
+    assert [m["text"] for m in conv["messages"] if m["role"] == "user"] == [
+        "first message",
+        "second message",
+    ]
+
+
+def test_add_message_forwards_request_id_and_server_timing(
+    client, fake_db, login_user, monkeypatch
+):
+    user_id = login_user()
+    cid = fake_db.conversations.insert_one(
+        {"user_id": user_id, "messages": [], "status": "active"}
+    ).inserted_id
+    sent = {}
+
+    class FakeResp:
+        status_code = 200
+        text = "ok"
+        headers = {"Server-Timing": "stt;dur=0.0, gemini_reply;dur=640.5, bogus"}
+
+        def json(self):
+            return {"reply": "AI reply"}
+
+    def fake_post(url, json=None, headers=None, timeout=None):
+        sent.update(headers or {})
+        return FakeResp()
+
+    monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
+
+    res = client.post(
+        f"/api/conversations/{cid}/messages",
+        json={"text": "hi"},
+        headers={"X-Request-ID": "trace-42"},
+    )
+    assert res.status_code == 200
+    assert sent["X-Request-ID"] == "trace-42"
+    # The 10 s chat timeout, less the time spent so far, is ai-service's deadline
+    assert 9000 < int(sent["X-Deadline-Ms"]) <= 10000
+    assert res.headers["X-Request-ID"] == "trace-42"
+
+    timing = res.headers["Server-Timing"]
+    assert "ai;dur=" in timing
+    assert "ai-gemini_reply;dur=640.5" in timing
+    assert "ai-stt;dur=0.0" in timing
+    assert "bogus" not in timing
+    assert "app;dur=" in timing
+
+
+def test_deadline_uses_read_timeout_less_elapsed_time():
+    assert webapp._deadline_ms(None, False) is None
+    assert webapp._deadline_ms(30, False) == 30000
+    # (connect, read): ai-service only sees the read part
+    assert webapp._deadline_ms((3.05, 10), False) == 10000
+
+    with webapp.app.test_request_context():
+        webapp.g.request_started = time.perf_counter() - 4
+        assert 5900 < webapp._deadline_ms((3.05, 10), True) <= 6000
+        webapp.g.request_started = time.perf_counter() - 20
+        assert webapp._deadline_ms(10, True) == 0
+
+
+def test_request_id_generated_when_missing_or_invalid(client):
+    res = client.get("/login", headers={"X-Request-ID": "<script>"})
+    rid = res.headers["X-Request-ID"]
+    assert rid != "<script>"
+    assert len(rid) == 32
+
+
 def test_add_message_forbidden_for_other_user(client, fake_db, login_user):
     user1 = login_user("user1", "pw")   # logged in user
 
@@ -222,20 +458,28 @@ def test_add_audio_success_branch(client, fake_db, login_user, monkeypatch):
         def json(self):
             return {
                 "reply": "Audio AI reply",
-                "history": [
-                    {"role": "ai", "text": "Hi"},
+                "transcript": "Transcribed text",
+                "messages": [
                     {"role": "user", "text": "Transcribed text"},
+                    {"role": "ai", "text": "Audio AI reply"},
                 ],
             }
 
-    def fake_post(url, params=None, files=None, timeout=None):
+    sent = {}
+
+    def fake_post(url, params=None, data=None, headers=None, timeout=None):
         assert "/api/chat/audio" in url
         assert params["user_id"] == str(user_id)
+        assert params["conversation_id"] == str(cid)
+        assert params["max_seconds"] == webapp.AUDIO_MAX_SECONDS
+        assert len(params["turn_id"]) == 32
+        sent["body"] = b"".join(data)
+        sent["content_type"] = headers["Content-Type"]
         return FakeResp()
 
     monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
 
-    data = {"audio": (BytesIO(b"fake-audio"), "voice.wav")}
+    data = {"audio": (BytesIO(WAV + b"samples"), "voice.wav")}
     res = client.post(
         f"/api/conversations/{cid}/audio",
         data=data,
@@ -246,6 +490,10 @@ def test_add_audio_success_branch(client, fake_db, login_user, monkeypatch):
     js = res.get_json()
     assert js["user_message"] == "Transcribed text"
     assert js["ai_response"] == "Audio AI reply"
+    # Re-wrapped as ai-service's multipart "file" field
+    assert sent["content_type"].startswith("multipart/form-data; boundary=")
+    assert b'name="file"; filename="voice.wav"' in sent["body"]
+    assert WAV + b"samples" in sent["body"]
 
     conv = fake_db.conversations.find_one({"_id": cid})
     assert len(conv["messages"]) == 2
@@ -253,6 +501,227 @@ def test_add_audio_success_branch(client, fake_db, login_user, monkeypatch):
     assert conv["messages"][1]["role"] == "ai"
 
 
+def _audio_conversation(fake_db, user_id):
+    return fake_db.conversations.insert_one(
+        {"user_id": user_id, "messages": [], "status": "active"}
+    ).inserted_id
+
+
+def test_add_audio_streams_raw_body(client, fake_db, login_user, monkeypatch):
+    user_id = login_user()
+    cid = _audio_conversation(fake_db, user_id)
+    chunks = []
+
+    class FakeResp:
+        status_code = 200
+        text = "ok"
+
+        def json(self):
+            return {"reply": "r", "transcript": "t"}
+
+    def fake_post(url, params=None, data=None, headers=None, timeout=None):
+        chunks.extend(data)
+        return FakeResp()
+
+    monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
+    monkeypatch.setattr(audio_upload, "CHUNK_SIZE", 1024)
+    body = WAV + bytes(5000)
+
+    res = client.post(
+        f"/api/conversations/{cid}/audio",
+        data=body,
+        content_type="audio/wav",
+        headers={"X-Filename": "rec.wav"},
+    )
+
+    assert res.status_code == 200
+    assert b"".join(chunks[1:-1]) == body
+    # Forwarded piece by piece, not as one buffer
+    assert len(chunks) > 5
+    assert b'filename="rec.wav"' in chunks[0]
+
+
+def test_add_audio_sends_no_mood(client, fake_db, login_user, monkeypatch):
+    user_id = login_user()
+    cid = fake_db.conversations.insert_one(
+        {
+            "user_id": user_id,
+            "messages": [
+                {"role": "user", "text": "Today was great, I'm so happy!"},
+                {"role": "ai", "text": "That sounds wonderful!"},
+            ],
+            "status": "active",
+        }
+    ).inserted_id
+    sent = {}
+
+    class FakeResp:
+        status_code = 200
+        text = "ok"
+
+        def json(self):
+            return {"reply": "r", "transcript": "t"}
+
+    def fake_post(url, params=None, data=None, headers=None, timeout=None):
+        sent.update(params)
+        b"".join(data)
+        return FakeResp()
+
+    monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
+
+    res = client.post(
+        f"/api/conversations/{cid}/audio",
+        data=WAV + bytes(100),
+        content_type="audio/wav",
+    )
+
+    assert res.status_code == 200
+    # Earlier messages say nothing about this recording: ai-service falls
+    # back to its neutral replies
+    assert "mood" not in sent
+
+
+def test_add_audio_rejects_non_audio_before_forwarding(
+    client, fake_db, login_user, monkeypatch
+):
+    user_id = login_user()
+    cid = _audio_conversation(fake_db, user_id)
+
+    def fake_post(*a, **k):
+        raise AssertionError("nothing should be sent to ai-service")
+
+    monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
+
+    res = client.post(
+        f"/api/conversations/{cid}/audio",
+        data={"audio": (BytesIO(b"<html>not audio</html>"), "x.wav")},
+        content_type="multipart/form-data",
+    )
+    assert res.status_code == 415
+    assert fake_db.conversations.find_one({"_id": cid})["messages"] == []
+
+
+def test_add_audio_enforces_per_user_size_cap(client, fake_db, login_user, monkeypatch):
+    user_id = login_user()
+    fake_db.users.update_one(
+        {"_id": user_id}, {"$set": {"audio_limits": {"max_bytes": 1000}}}
+    )
+    cid = _audio_conversation(fake_db, user_id)
+    consumed = []
+
+    def fake_post(url, params=None, data=None, headers=None, timeout=None):
+        for chunk in data:
+            consumed.append(chunk)
+
+    monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
+
+    # Declared length over the cap: rejected without reading the body
+    res = client.post(
+        f"/api/conversations/{cid}/audio",
+        data=WAV + bytes(50_000),
+        content_type="audio/wav",
+    )
+    assert res.status_code == 413
+    assert consumed == []
+
+    # Multipart slack lets this through the length check; the stream cap stops it
+    res = client.post(
+        f"/api/conversations/{cid}/audio",
+        data={"audio": (BytesIO(WAV + bytes(5000)), "x.wav")},
+        content_type="multipart/form-data",
+    )
+    assert res.status_code == 413
+    assert sum(len(c) for c in consumed) < 5000
+
+
+def test_add_audio_passes_through_duration_rejection(
+    client, fake_db, login_user, monkeypatch
+):
+    user_id = login_user()
+    fake_db.users.update_one(
+        {"_id": user_id}, {"$set": {"audio_limits": {"max_seconds": 30}}}
+    )
+    cid = _audio_conversation(fake_db, user_id)
+
+    class FakeResp:
+        status_code = 413
+        text = "too long"
+
+        def json(self):
+            return {"detail": "Audio is longer than 30 s"}
+
+    def fake_post(url, params=None, data=None, headers=None, timeout=None):
+        assert params["max_seconds"] == 30
+        list(data)
+        return FakeResp()
+
+    monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
+
+    res = client.post(
+        f"/api/conversations/{cid}/audio", data=WAV, content_type="audio/wav"
+    )
+    assert res.status_code == 413
+    assert res.get_json()["error"] == "Audio is longer than 30 s"
+
+
+def test_add_audio_passes_through_bad_parameters(
+    client, fake_db, login_user, monkeypatch
+):
+    user_id = login_user()
+    cid = _audio_conversation(fake_db, user_id)
+    answers = iter(
+        [
+            (400, {"detail": "Unsupported language: xx"}),
+            (
+                422,
+                {
+                    "detail": [
+                        {
+                            "loc": ["query", "tier"],
+                            "msg": "Input should be 'fast' or 'accurate'",
+                        }
+                    ]
+                },
+            ),
+        ]
+    )
+
+    def fake_post(url, params=None, data=None, headers=None, timeout=None):
+        list(data)
+        status, body = next(answers)
+        return SimpleNamespace(status_code=status, text="", json=lambda: body)
+
+    monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
+
+    res = client.post(
+        f"/api/conversations/{cid}/audio?language=xx",
+        data=WAV,
+        content_type="audio/wav",
+    )
+    assert res.status_code == 400
+    assert res.get_json()["error"] == "Unsupported language: xx"
+
+    res = client.post(
+        f"/api/conversations/{cid}/audio?tier=slow",
+        data=WAV,
+        content_type="audio/wav",
+    )
+    assert res.status_code == 422
+    assert res.get_json()["error"] == "tier: Input should be 'fast' or 'accurate'"
+
+    # No placeholder turn was stored
+    assert fake_db.conversations.find_one({"_id": cid})["messages"] == []
+
+
+def _complete(client, cid, body):
+    """POST .../complete and fetch the finished job's preview."""
+    res = client.post(f"/api/conversations/{cid}/complete", json=body)
+    assert res.status_code == 202
+    job = client.get(res.headers["Location"]).get_json()
+    assert job["status"] == "done"
+    return job["result"]
+
+
 def test_complete_conversation_invalid_id(client, login_user):
     login_user()
     res = client.post("/api/conversations/not-an-id/complete", json={})
@@ -271,7 +740,11 @@ def test_complete_conversation_uses_fallback_when_ai_service_fails(
             "created_at": datetime.utcnow(),
             "messages": [
                 {"role": "ai", "text": "Hi! How was your day?"},
-                {"role": "user", "text": "I am happy but a bit tired today."},
+                {
+                    "role": "user",
+                    "text": "I am happy but a bit tired today.",
+                    "timestamp": datetime.utcnow(),
+                },
             ],
             "status": "active",
         }
@@ -282,12 +755,11 @@ def test_complete_conversation_uses_fallback_when_ai_service_fails(
 
     monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
 
-    res = client.post(f"/api/conversations/{conv_id}/complete", json={})
-    assert res.status_code == 200
-    data = res.get_json()
+    data = _complete(client, conv_id, {})
 
     # Now complete returns preview only, not saved yet
     assert data["mood"] == "neutral"
+    assert data["mood_source"] == "lexicon"
     assert data["title"]
     assert data["conversation_id"] == str(conv_id)
     assert "suggested_date" in data
@@ -302,7 +774,7 @@ def test_complete_conversation_uses_ai_diary(client, fake_db, login_user, monkey
             "created_at": datetime.utcnow(),
             "messages": [
                 {"role": "ai", "text": "Hi"},
-                {"role": "user", "text": "I am happy."},
+                {"role": "user", "text": "I am happy.", "timestamp": datetime.utcnow()},
             ],
             "status": "active",
         }
@@ -322,22 +794,22 @@ def test_complete_conversation_uses_ai_diary(client, fake_db, login_user, monkey
                 "mood_score": 0.9,
             }
 
-    def fake_post(url, json=None, timeout=None):
+    def fake_post(url, json=None, headers=None, timeout=None):
         assert "/api/generate-diary" in url
-        assert "messages" in json
+        # Stored timestamps are not sent (and would not be JSON-serializable)
+        assert json["messages"] == [
+            {"role": "ai", "text": "Hi"},
+            {"role": "user", "text": "I am happy."},
+        ]
         return FakeResp()
 
     monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
 
     # Step 1: Complete returns preview only
-    res = client.post(
-        f"/api/conversations/{cid}/complete",
-        json={"preferences": {"tone": "casual"}},
-    )
-    assert res.status_code == 200
-    data = res.get_json()
+    data = _complete(client, cid, {"preferences": {"tone": "casual"}})
     assert data["title"] == "AI diary title"
     assert data["mood"] == "positive"
+    assert data["mood_source"] == "ai"
     assert data["conversation_id"] == str(cid)
 
     # Step 2: Save the diary
@@ -348,6 +820,7 @@ def test_complete_conversation_uses_ai_diary(client, fake_db, login_user, monkey
             "content": data["content"],
             "mood": data["mood"],
             "mood_score": data["mood_score"],
+            "mood_source": data["mood_source"],
             "entry_date": data["suggested_date"],
         },
     )
@@ -359,6 +832,94 @@ def test_complete_conversation_uses_ai_diary(client, fake_db, login_user, monkey
     diary = fake_db.diaries.find_one({"_id": diary_id})
     assert diary is not None
     assert diary["title"] == "AI diary title"
+    assert diary["mood_source"] == "ai"
+
+
+def test_complete_conversation_queues_job(client, fake_db, login_user, monkeypatch):
+    user_id = login_user()
+    cid = fake_db.conversations.insert_one(
+        {"user_id": user_id, "messages": [{"role": "user", "text": "hi"}]}
+    ).inserted_id
+    submitted = []
+    monkeypatch.setattr(
+        webapp, "_diary_executor", SimpleNamespace(submit=lambda *a: submitted.append(a))
+    )
+
+    res = client.post(
+        f"/api/conversations/{cid}/complete",
+        json={"preferences": {"style": "poetic"}},
+        headers={"X-Request-ID": "req-7"},
+    )
+
+    assert res.status_code == 202
+    job_id = res.get_json()["job_id"]
+    assert res.headers["Location"].endswith(f"/api/diary-jobs/{job_id}")
+    job = fake_db.diary_jobs.find_one({"_id": ObjectId(job_id)})
+    assert job["status"] == "queued"
+    assert job["preferences"] == {"style": "poetic"}
+    assert job["request_id"] == "req-7"
+    assert submitted == [(webapp.run_diary_job, ObjectId(job_id))]
+
+    poll = client.get(f"/api/diary-jobs/{job_id}").get_json()
+    assert poll == {"job_id": job_id, "status": "queued"}
+
+
+def test_diary_job_runs_once(fake_db, monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        webapp,
+        "generate_diary_preview",
+        lambda *a: calls.append(a) or {"title": "T"},
+    )
+    cid = fake_db.conversations.insert_one({"messages": []}).inserted_id
+    job_id = fake_db.diary_jobs.insert_one(
+        {"conversation_id": cid, "preferences": None, "status": "queued"}
+    ).inserted_id
+
+    webapp.run_diary_job(job_id)
+    webapp.run_diary_job(job_id)  # duplicate submission
+
+    assert len(calls) == 1
+    job = fake_db.diary_jobs.find_one({"_id": job_id})
+    assert job["status"] == "done"
+    assert job["attempts"] == 1
+    assert job["result"] == {"title": "T"}
+
+
+def test_stale_diary_job_is_requeued_on_poll(client, fake_db, login_user, monkeypatch):
+    user_id = login_user()
+    cid = fake_db.conversations.insert_one({"user_id": user_id, "messages": []})
+    monkeypatch.setattr(
+        webapp, "generate_diary_preview", lambda *a: {"title": "recovered"}
+    )
+    long_ago = datetime.utcnow() - webapp.timedelta(hours=1)
+    job_id = fake_db.diary_jobs.insert_one(
+        {
+            "user_id": user_id,
+            "conversation_id": cid.inserted_id,
+            "preferences": None,
+            # Its process died mid-run
+            "status": "running",
+            "attempts": 1,
+            "updated_at": long_ago,
+        }
+    ).inserted_id
+
+    job = client.get(f"/api/diary-jobs/{job_id}").get_json()
+
+    assert job["status"] == "done"
+    assert job["result"] == {"title": "recovered"}
+    assert fake_db.diary_jobs.find_one({"_id": job_id})["attempts"] == 2
+
+
+def test_diary_job_forbidden_for_other_user(client, fake_db, login_user):
+    login_user()
+    job_id = fake_db.diary_jobs.insert_one(
+        {"user_id": ObjectId(), "status": "queued"}
+    ).inserted_id
+
+    res = client.get(f"/api/diary-jobs/{job_id}")
+    assert res.status_code == 403
 
 
 def test_save_diary_invalid_entry_date(client, fake_db, login_user):
@@ -418,13 +979,14 @@ def test_transcribe_success(client, login_user, monkeypatch):
         def json(self):
             return {"text": "hello world"}
 
-    def fake_post(url, files=None, timeout=None):
+    def fake_post(url, params=None, data=None, headers=None, timeout=None):
         assert "/api/transcribe" in url
+        assert WAV in b"".join(data)
         return FakeResp()
 
     monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
 
-    data = {"audio": (BytesIO(b"fake"), "voice.wav")}
+    data = {"audio": (BytesIO(WAV), "voice.wav")}
     res = client.post(
         "/api/transcribe",
         data=data,
@@ -434,6 +996,72 @@ def test_transcribe_success(client, login_user, monkeypatch):
     assert res.get_json()["text"] == "hello world"
 
 
+def test_transcribe_forwards_user_and_language(client, login_user, monkeypatch):
+    user_id = login_user()
+    sent = {}
+
+    class FakeResp:
+        status_code = 200
+        text = "ok"
+
+        def json(self):
+            return {"text": "hallo"}
+
+    def fake_post(url, params=None, data=None, headers=None, timeout=None):
+        sent.update(params)
+        list(data)
+        return FakeResp()
+
+    monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
+
+    res = client.post("/api/transcribe?language=de", data=WAV, content_type="audio/wav")
+
+    assert res.status_code == 200
+    assert sent["user_id"] == str(user_id)
+    assert sent["language"] == "de"
+
+
+def test_set_stt_language(client, login_user, monkeypatch):
+    user_id = login_user()
+    calls = []
+
+    class FakeResp:
+        def __init__(self, status_code, body):
+            self.status_code = status_code
+            self.text = str(body)
+            self._body = body
+
+        def json(self):
+            return self._body
+
+    def fake_post(url, json=None, headers=None, timeout=None):
+        calls.append((url, json))
+        if json["language"] == "xx":
+            return FakeResp(400, {"detail": "Unsupported language"})
+        return FakeResp(
+            200, {"override": json["language"], "pinned": None, "recent": []}
+        )
+
+    monkeypatch.setattr(webapp, "requests", SimpleNamespace(post=fake_post))
+
+    res = client.post("/api/stt-language", json={"language": "de"})
+    assert res.status_code == 200
+    assert res.get_json()["override"] == "de"
+    assert calls[0] == (
+        f"{webapp.AI_SERVICE_BASE}/api/users/{user_id}/stt-language",
+        {"language": "de"},
+    )
+
+    res = client.post("/api/stt-language", json={"language": "xx"})
+    assert res.status_code == 400
+    assert res.get_json()["error"] == "Unsupported language"
+
+
+def test_set_stt_language_requires_login(client):
+    res = client.post("/api/stt-language", json={"language": "de"})
+    assert res.status_code == 401
+
+
 # --------- diaries list / detail / edit / delete / search ---------
 
 
@@ -647,3 +1275,332 @@ def test_get_calendar_diaries_default_current_month(client, fake_db, login_user)
     assert "year" in data
     assert "month" in data
     assert "diaries_by_date" in data
+
+
+# --------- mood analytics rollups ---------
+
+
+def _save_diary(client, fake_db, user_id, entry_date, mood, mood_score):
+    cid = fake_db.conversations.insert_one(
+        {
+            "user_id": user_id,
+            "created_at": datetime.utcnow(),
+            "messages": [],
+            "status": "active",
+        }
+    ).inserted_id
+    res = client.post(
+        f"/api/conversations/{cid}/save",
+        json={
+            "title": "T",
+            "content": "C",
+            "mood": mood,
+            "mood_score": mood_score,
+            "entry_date": entry_date,
+        },
+    )
+    assert res.status_code == 200
+    return res.get_json()["diary_id"]
+
+
+def test_mood_rollups_follow_save_edit_and_delete(client, fake_db, login_user):
+    user_id = login_user()
+
+    d1 = _save_diary(client, fake_db, user_id, "2025-01-13", "positive", 3)
+    _save_diary(client, fake_db, user_id, "2025-01-14", "negative", -2)
+    _save_diary(client, fake_db, user_id, "2025-02-03", "positive", 4)
+
+    jan = fake_db.mood_rollups.find_one({"user_id": user_id, "month": "2025-01"})
+    assert jan["count"] == 2
+    assert jan["score_sum"] == 1
+    assert jan["moods"] == {"positive": 1, "negative": 1}
+    assert jan["days"]["13"] == {"count": 1, "score_sum": 3}
+
+    # Changing mood and moving the entry to February updates both months
+    client.put(
+        f"/api/diaries/{d1}",
+        json={"mood": "neutral", "mood_score": 0, "entry_date": "2025-02-04"},
+    )
+    jan = fake_db.mood_rollups.find_one({"user_id": user_id, "month": "2025-01"})
+    feb = fake_db.mood_rollups.find_one({"user_id": user_id, "month": "2025-02"})
+    assert jan["count"] == 1
+    assert jan["moods"]["positive"] == 0
+    assert feb["count"] == 2
+    assert feb["moods"] == {"positive": 1, "neutral": 1}
+
+    # Content-only edits do not touch the rollups
+    before = dict(feb)
+    client.put(f"/api/diaries/{d1}", json={"content": "edited"})
+    feb = fake_db.mood_rollups.find_one({"user_id": user_id, "month": "2025-02"})
+    assert feb["count"] == before["count"]
+
+    client.delete(f"/api/diaries/{d1}")
+    feb = fake_db.mood_rollups.find_one({"user_id": user_id, "month": "2025-02"})
+    assert feb["count"] == 1
+    assert feb["score_sum"] == 4
+
+
+def test_update_diary_rejects_bad_entry_date(client, fake_db, login_user):
+    user_id = login_user()
+    d1 = _save_diary(client, fake_db, user_id, "2025-01-13", "positive", 3)
+
+    for bad in (20250113, ["2025-01-13"], "2025-13-01", None):
+        res = client.put(f"/api/diaries/{d1}", json={"entry_date": bad, "mood": "negative"})
+        assert res.status_code == 400
+
+    # Nothing was applied: the diary and its rollup are unchanged
+    jan = fake_db.mood_rollups.find_one({"user_id": user_id, "month": "2025-01"})
+    assert jan["count"] == 1
+    assert jan["moods"] == {"positive": 1}
+    assert fake_db.diaries.find_one({"_id": ObjectId(d1)})["entry_date"] == "2025-01-13"
+
+    # On create a non-string date falls back to today, like a malformed one
+    d2 = _save_diary(client, fake_db, user_id, 20250113, "neutral", 0)
+    assert isinstance(fake_db.diaries.find_one({"_id": ObjectId(d2)})["entry_date"], str)
+
+
+def test_mood_stats_served_from_rollups(client, fake_db, login_user):
+    user_id = login_user()
+
+    _save_diary(client, fake_db, user_id, "2025-01-13", "positive", 3)
+    _save_diary(client, fake_db, user_id, "2025-01-14", "negative", -2)
+    _save_diary(client, fake_db, user_id, "2025-01-20", "positive", 2)
+
+    # The endpoint must not need the raw diaries
+    fake_db.diaries.docs = []
+
+    res = client.get(f"/api/users/{user_id}/mood-stats?from=2025-01&to=2025-03")
+    assert res.status_code == 200
+    data = res.get_json()
+
+    assert data["months"] == [
+        {
+            "month": "2025-01",
+            "count": 3,
+            "avg_mood_score": 1.0,
+            "moods": {"positive": 2, "negative": 1},
+        }
+    ]
+    assert data["weeks"] == [
+        {"week": "2025-W03", "count": 2, "avg_mood_score": 0.5},
+        {"week": "2025-W04", "count": 1, "avg_mood_score": 2.0},
+    ]
+    assert data["moods"] == {"positive": 2, "negative": 1, "neutral": 0}
+
+
+def test_mood_stats_forbidden_and_invalid_month(client, login_user):
+    user_id = login_user()
+    res = client.get(f"/api/users/{ObjectId()}/mood-stats")
+    assert res.status_code == 403
+
+    res = client.get(f"/api/users/{user_id}/mood-stats?from=2025-13")
+    assert res.status_code == 400
+
+
+def test_rebuild_mood_rollups(client, fake_db, login_user):
+    user_id = login_user()
+    _insert_diary(fake_db, user_id, date="2025-03-01", mood="positive")
+    _insert_diary(fake_db, user_id, date="2025-03-02", mood="negative")
+    _insert_diary(fake_db, user_id, date="2025-04-01", mood="weird")
+    fake_db.mood_rollups.insert_one(
+        {"user_id": user_id, "month": "2025-03", "count": 99}
+    )
+
+    assert webapp.rebuild_mood_rollups(user_id) == 2
+
+    march = fake_db.mood_rollups.find_one({"user_id": user_id, "month": "2025-03"})
+    april = fake_db.mood_rollups.find_one({"user_id": user_id, "month": "2025-04"})
+    assert march["count"] == 2
+    assert march["moods"] == {"positive": 1, "negative": 1}
+    assert april["moods"] == {"neutral": 1}
+
+
+def test_rebuild_mood_rollups_upserts_and_drops_empty_months(
+    client, fake_db, login_user
+):
+    user_id = login_user()
+    other_id = ObjectId()
+    _insert_diary(fake_db, user_id, date="2025-03-01", mood="positive")
+    # Written by a diary save while the rebuild runs, and a month whose
+    # diaries are all gone
+    fake_db.mood_rollups.insert_one({"user_id": user_id, "month": "2025-03", "count": 1})
+    fake_db.mood_rollups.insert_one({"user_id": user_id, "month": "2025-01", "count": -1})
+    fake_db.mood_rollups.insert_one({"user_id": other_id, "month": "2025-01", "count": 1})
+
+    assert webapp.rebuild_mood_rollups(user_id) == 1
+
+    assert fake_db.mood_rollups.bulk_write_calls[-1] == (1, False)
+    rollups = list(fake_db.mood_rollups.find({"user_id": user_id}))
+    assert [(r["month"], r["count"]) for r in rollups] == [("2025-03", 1)]
+    # Other users are left alone by a per-user rebuild
+    assert fake_db.mood_rollups.find_one({"user_id": other_id})
+
+    assert webapp.rebuild_mood_rollups() == 1
+    assert fake_db.mood_rollups.find_one({"user_id": other_id}) is None
+
+
+def test_rebuild_mood_rollups_cli(app, fake_db, login_user):
+    user_id = login_user()
+    _insert_diary(fake_db, user_id, date="2025-03-01", mood="positive")
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["rebuild-mood-rollups", "--user", "alice"])
+    assert result.exit_code == 0
+    assert "Wrote 1 mood rollup" in result.output
+
+    result = runner.invoke(args=["rebuild-mood-rollups", "--user", "nobody"])
+    assert result.exit_code != 0
+
+
+# --------- calendar cache / ETags ---------
+
+
+def test_calendar_is_cached_until_a_write_touches_the_month(
+    client, fake_db, login_user
+):
+    user_id = login_user()
+    _save_diary(client, fake_db, user_id, "2025-01-15", "positive", 2)
+
+    url = f"/api/users/{user_id}/diaries/calendar?year=2025&month=1"
+    res = client.get(url)
+    assert res.status_code == 200
+    etag = res.headers["ETag"]
+    assert res.headers["Cache-Control"] == "private, no-cache"
+    assert len(res.get_json()["diaries_by_date"]["2025-01-15"]) == 1
+
+    # Served from cache: a change made behind the app's back is not seen
+    _insert_diary(fake_db, user_id, date="2025-01-16")
+    res = client.get(url)
+    assert res.headers["ETag"] == etag
+    assert "2025-01-16" not in res.get_json()["diaries_by_date"]
+
+    # Browser revalidation gets a 304 with no body
+    res = client.get(url, headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.data == b""
+
+    # A save in the month invalidates it
+    _save_diary(client, fake_db, user_id, "2025-01-20", "neutral", 0)
+    res = client.get(url, headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert res.headers["ETag"] != etag
+    assert "2025-01-20" in res.get_json()["diaries_by_date"]
+
+
+def test_calendar_cache_invalidated_by_edit_and_delete(client, fake_db, login_user):
+    user_id = login_user()
+    diary_id = _save_diary(client, fake_db, user_id, "2025-01-15", "positive", 2)
+
+    jan = f"/api/users/{user_id}/diaries/calendar?year=2025&month=1"
+    feb = f"/api/users/{user_id}/diaries/calendar?year=2025&month=2"
+    jan_etag = client.get(jan).headers["ETag"]
+    feb_etag = client.get(feb).headers["ETag"]
+
+    # Title-only edit changes the cached month
+    client.put(f"/api/diaries/{diary_id}", json={"title": "Renamed"})
+    res = client.get(jan, headers={"If-None-Match": jan_etag})
+    assert res.status_code == 200
+    assert res.get_json()["diaries_by_date"]["2025-01-15"][0]["title"] == "Renamed"
+    jan_etag = res.headers["ETag"]
+
+    # Moving the entry invalidates both months; untouched months stay valid
+    mar_etag = client.get(
+        f"/api/users/{user_id}/diaries/calendar?year=2025&month=3"
+    ).headers["ETag"]
+    client.put(f"/api/diaries/{diary_id}", json={"entry_date": "2025-02-01"})
+    assert client.get(jan, headers={"If-None-Match": jan_etag}).status_code == 200
+    res = client.get(feb, headers={"If-None-Match": feb_etag})
+    assert res.status_code == 200
+    assert "2025-02-01" in res.get_json()["diaries_by_date"]
+    res = client.get(
+        f"/api/users/{user_id}/diaries/calendar?year=2025&month=3",
+        headers={"If-None-Match": mar_etag},
+    )
+    assert res.status_code == 304
+
+    feb_etag = client.get(feb).headers["ETag"]
+    client.delete(f"/api/diaries/{diary_id}")
+    res = client.get(feb, headers={"If-None-Match": feb_etag})
+    assert res.status_code == 200
+    assert res.get_json()["diaries_by_date"] == {}
+
+
+# --------- year overview ---------
+
+
+def test_year_overview_single_aggregation(client, fake_db, login_user):
+    user_id = login_user()
+    fake_db.diaries.aggregate_result = [
+        {"_id": "2024-01-01", "count": 2, "mood": "positive", "score_sum": 5, "scored": 2},
+        {"_id": "2024-12-31", "count": 1, "mood": "negative", "score_sum": 0, "scored": 0},
+        {"_id": "garbage", "count": 1, "mood": "neutral", "score_sum": 0, "scored": 0},
+    ]
+
+    res = client.get(f"/api/users/{user_id}/diaries/year?year=2024")
+    assert res.status_code == 200
+    data = res.get_json()
+
+    # 2024 is a leap year
+    assert data["days"] == 366
+    assert len(data["counts"]) == len(data["moods"]) == 366
+    assert data["counts"][0] == 2
+    assert data["moods"][0] == "positive"
+    assert data["avg_mood_scores"][0] == 2.5
+    assert data["counts"][365] == 1
+    assert data["avg_mood_scores"][365] is None
+    assert sum(data["counts"]) == 3
+
+    assert len(fake_db.diaries.aggregate_calls) == 1
+    pipeline, kwargs = fake_db.diaries.aggregate_calls[0]
+    assert kwargs["hint"] == [("user_id", 1), ("entry_date", 1)]
+    assert pipeline[0]["$match"] == {
+        "user_id": user_id,
+        "entry_date": {"$gte": "2024-01-01", "$lt": "2025-01-01"},
+    }
+    # Diary bodies never leave the database
+    projected = pipeline[1]["$project"]
+    assert "content" not in projected and "summary" not in projected
+
+
+def test_year_overview_rejects_out_of_range_year(client, fake_db, login_user):
+    user_id = login_user()
+    for year in ("0", "-5", "9999", "100000"):
+        res = client.get(f"/api/users/{user_id}/diaries/year?year={year}")
+        assert res.status_code == 400
+    assert fake_db.diaries.aggregate_calls == []
+
+
+def test_year_overview_forbidden(client, login_user):
+    login_user()
+    res = client.get(f"/api/users/{ObjectId()}/diaries/year")
+    assert res.status_code == 403
+
+
+def test_backfill_entry_dates_cli(app, fake_db, login_user):
+    user_id = login_user()
+    legacy = fake_db.diaries.insert_one(
+        {"user_id": user_id, "date": "2023-05-01", "title": "old"}
+    ).inserted_id
+    _insert_diary(fake_db, user_id, date="2025-01-01")
+
+    result = app.test_cli_runner().invoke(args=["backfill-entry-dates"])
+    assert result.exit_code == 0
+    assert "on 1 diaries" in result.output
+    assert fake_db.diaries.find_one({"_id": legacy})["entry_date"] == "2023-05-01"
+
+
+# --------- serving model ---------
+
+
+def test_gunicorn_config_uses_threaded_workers(monkeypatch):
+    import runpy
+    from pathlib import Path
+
+    monkeypatch.delenv("GUNICORN_TIMEOUT", raising=False)
+    conf = runpy.run_path(str(Path(webapp.__file__).with_name("gunicorn.conf.py")))
+
+    assert conf["worker_class"] == "gthread"
+    assert conf["workers"] >= 2
+    assert conf["threads"] > 1
+    # A worker waiting on a 60 s ai-service call must not be killed
+    assert conf["timeout"] > 60
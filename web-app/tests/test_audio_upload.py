@@ -0,0 +1,70 @@
+from io import BytesIO
+
+import pytest
+
+from audio_upload import (
+    AudioUpload,
+    NotAudio,
+    UploadTooLarge,
+    multipart_body,
+    sniff_audio,
+)
+
+
+@pytest.mark.parametrize(
+    "head, expected",
+    [
+        (b"RIFF\x24\x00\x00\x00WAVEfmt ", "wav"),
+        (b"\x1a\x45\xdf\xa3\x9f\x42\x86\x81\x01\x42\xf7\x81", "webm"),
+        (b"OggS\x00\x02\x00\x00\x00\x00\x00\x00", "ogg"),
+        (b"fLaC\x00\x00\x00\x22\x10\x00\x10\x00", "flac"),
+        (b"\x00\x00\x00\x20ftypM4A \x00\x00", "mp4"),
+        (b"ID3\x04\x00\x00\x00\x00\x00\x00\x00\x00", "mp3"),
+        (b"\xff\xfb\x90\x64\x00\x00\x00\x00\x00\x00\x00\x00", "mp3"),
+        (b"\xff\xf1\x50\x80\x00\x1f\xfc\x00\x00\x00\x00\x00", "aac"),
+        (b"<!DOCTYPE html>", None),
+        (b"%PDF-1.7\n%\xe2\xe3", None),
+        (b"RIFF\x24\x00\x00\x00AVI LIST", None),
+        (b"", None),
+    ],
+)
+def test_sniff_audio(head, expected):
+    assert sniff_audio(head) == expected
+
+
+def test_upload_reads_in_chunks_and_counts(monkeypatch):
+    monkeypatch.setattr("audio_upload.CHUNK_SIZE", 4)
+    data = b"OggS" + b"x" * 20
+    upload = AudioUpload(BytesIO(data), None, "audio/ogg", max_bytes=100)
+
+    chunks = list(upload.chunks())
+
+    assert upload.filename == "audio.ogg"
+    assert b"".join(chunks) == data
+    assert max(len(c) for c in chunks[1:]) == 4
+    assert upload.size == len(data)
+
+
+def test_upload_stops_at_cap():
+    upload = AudioUpload(BytesIO(b"OggS" + b"x" * 100), "a.ogg", "audio/ogg", 50)
+    with pytest.raises(UploadTooLarge):
+        list(upload.chunks())
+
+
+def test_non_audio_rejected_on_open():
+    with pytest.raises(NotAudio):
+        AudioUpload(BytesIO(b"MZ\x90\x00 windows exe"), "a.wav", "audio/wav", 100)
+
+
+def test_multipart_body_envelope():
+    upload = AudioUpload(BytesIO(b"fLaC1234567890"), 'we"ird.flac', "audio/flac", 100)
+    content_type, body = multipart_body("file", upload, boundary="b0undary")
+
+    assert content_type == "multipart/form-data; boundary=b0undary"
+    assert b"".join(body) == (
+        b"--b0undary\r\n"
+        b'Content-Disposition: form-data; name="file"; filename="weird.flac"\r\n'
+        b"Content-Type: audio/flac\r\n\r\n"
+        b"fLaC1234567890"
+        b"\r\n--b0undary--\r\n"
+    )
@@ -0,0 +1,64 @@
+import json
+
+import app as webapp
+from mood_lexicon import MoodLexicon, load_lexicon, message_mood, tokenize
+
+
+def test_tokenize_keeps_contractions_and_clause_breaks():
+    assert tokenize("I didn’t go. Fun!") == ["i", "didn't", "go", ".", "fun", "!"]
+
+
+def test_whole_words_only():
+    score, title = load_lexicon().analyze("Badminton after the funeral, then a latest update")
+    assert score == 0
+    assert title is None
+
+
+def test_negation_flips_within_window_and_stops_at_clause_break():
+    lexicon = load_lexicon()
+    assert lexicon.analyze("not bad")[0] == 1
+    assert lexicon.analyze("I didn't have a good day")[0] == -1
+    # "good" is four tokens after the negator, outside the window
+    assert lexicon.analyze("never thought it would be good")[0] == 1
+    assert lexicon.analyze("not today, happy")[0] == 1
+
+
+def test_message_mood_counts_any_lean():
+    assert message_mood("Today was great, I'm so happy!") == "positive"
+    assert message_mood("I feel exhausted and stressed") == "negative"
+    assert message_mood("I was not happy about it") == "negative"
+    assert message_mood("I had lunch at noon") == "neutral"
+
+
+def test_title_rules_follow_file_order():
+    lexicon = load_lexicon()
+    assert lexicon.analyze("a trip before my exams")[1] == "Thinking about exams"
+    assert lexicon.analyze("planning a vacation")[1] == "Thinking about a trip"
+
+
+def test_weighted_lexicon_from_file(tmp_path):
+    path = tmp_path / "lexicon.json"
+    path.write_text(
+        json.dumps(
+            {
+                "words": {"stellar": 3, "meh": -1},
+                "negators": ["not"],
+                "negation_window": 1,
+                "titles": [{"title": "Space day", "words": ["rocket"]}],
+            }
+        )
+    )
+    lexicon = MoodLexicon.from_file(str(path))
+    assert lexicon.analyze("A stellar rocket launch, meh food") == (2, "Space day")
+    assert lexicon.analyze("not really stellar") == (3, None)
+
+
+def test_analyze_mood_and_summary_uses_lexicon():
+    result = webapp.analyze_mood_and_summary(["We played badminton, no fun at all"])
+    assert result["mood"] == "neutral"
+    assert result["mood_score"] == -1
+    assert result["title"] == "A regular day"
+
+    result = webapp.analyze_mood_and_summary(["Not bad. Really great and relaxed day"])
+    assert result["mood"] == "positive"
+    assert result["mood_score"] == 3
@@ -0,0 +1,99 @@
+from bson import ObjectId
+
+from rescore_moods import JOB_ID, rescore_moods, score_batch
+
+
+def _diary(fake_db, content, mood="neutral", mood_score=0, source="lexicon", **extra):
+    doc = {
+        "user_id": ObjectId(),
+        "entry_date": "2025-01-01",
+        "content": content,
+        "mood": mood,
+        "mood_score": mood_score,
+        **extra,
+    }
+    if source is not None:
+        doc["mood_source"] = source
+    return fake_db.diaries.insert_one(doc).inserted_id
+
+
+def test_score_batch_returns_only_changes():
+    diffs = score_batch(
+        [
+            ("a", "great fun, amazing", "neutral", 0),
+            ("b", "nothing much", "neutral", 0),
+        ]
+    )
+    assert diffs == [("a", "neutral", 0, "positive", 3)]
+
+
+def test_rescore_writes_changed_heuristic_moods_only(fake_db):
+    changed = _diary(fake_db, "happy and relaxed, great day")
+    unchanged = _diary(fake_db, "went to work")
+    ai = _diary(fake_db, "happy happy happy", source="ai")
+    user = _diary(fake_db, "sad and tired and upset", source="user")
+    legacy = _diary(fake_db, "sad and tired and upset", source=None)
+
+    result = rescore_moods(fake_db, batch_size=2, workers=0, echo=lambda *_: None)
+
+    assert result == {"scanned": 2, "changed": 1}
+    assert fake_db.diaries.find_one({"_id": changed})["mood"] == "positive"
+    assert fake_db.diaries.find_one({"_id": unchanged})["mood"] == "neutral"
+    assert fake_db.diaries.find_one({"_id": ai})["mood"] == "neutral"
+    assert fake_db.diaries.find_one({"_id": user})["mood"] == "neutral"
+    assert fake_db.diaries.find_one({"_id": legacy})["mood"] == "neutral"
+    assert fake_db.diaries.bulk_write_calls == [(1, False)]
+    # A completed run clears its checkpoint
+    assert fake_db.job_checkpoints.find_one({"_id": JOB_ID}) is None
+
+    result = rescore_moods(
+        fake_db, workers=0, include_unlabelled=True, echo=lambda *_: None
+    )
+    assert result["changed"] == 1
+    assert fake_db.diaries.find_one({"_id": legacy})["mood"] == "negative"
+
+
+def test_rescore_dry_run_prints_diffs_without_writing(fake_db):
+    diary_id = _diary(fake_db, "awful, terrible day")
+    lines = []
+
+    result = rescore_moods(fake_db, workers=0, dry_run=True, echo=lines.append)
+
+    assert result == {"scanned": 1, "changed": 1}
+    assert lines == [f"{diary_id}: neutral (0) -> negative (-4)"]
+    assert fake_db.diaries.find_one({"_id": diary_id})["mood"] == "neutral"
+    assert fake_db.diaries.bulk_write_calls == []
+    assert fake_db.job_checkpoints.docs == []
+
+
+def test_rescore_resumes_from_checkpoint(fake_db):
+    first = _diary(fake_db, "great fun, amazing")
+    second = _diary(fake_db, "great fun, amazing")
+    fake_db.job_checkpoints.insert_one(
+        {"_id": JOB_ID, "last_id": first, "scanned": 1, "changed": 0}
+    )
+
+    result = rescore_moods(fake_db, workers=0, echo=lambda *_: None)
+
+    assert result == {"scanned": 2, "changed": 1}
+    assert fake_db.diaries.find_one({"_id": first})["mood"] == "neutral"
+    assert fake_db.diaries.find_one({"_id": second})["mood"] == "positive"
+
+
+def test_rescore_on_process_pool(fake_db):
+    ids = [_diary(fake_db, "great fun, amazing") for _ in range(5)]
+
+    result = rescore_moods(fake_db, batch_size=2, workers=2, echo=lambda *_: None)
+
+    assert result == {"scanned": 5, "changed": 5}
+    assert all(fake_db.diaries.find_one({"_id": i})["mood"] == "positive" for i in ids)
+
+
+def test_rescore_cli_rebuilds_rollups(app, fake_db):
+    _diary(fake_db, "great fun, amazing")
+
+    result = app.test_cli_runner().invoke(args=["rescore-moods", "--workers", "0"])
+
+    assert result.exit_code == 0
+    assert "Scanned 1 diaries, 1 changed." in result.output
+    assert "Rebuilt 1 mood rollup" in result.output